@@ -1,25 +1,44 @@
+import click
 from flask import Flask
 from flask_graphql_auth import GraphQLAuth
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
-from API.config import Config
+from API.config import Config, ProductionConfig
+from API.database import RoutingSQLAlchemy
 
 
-db = SQLAlchemy()
-migrate = Migrate()
+db = RoutingSQLAlchemy()
 graph_auth = GraphQLAuth()
 
 
 def create_app(config_class=None):
     from API.routes import bp as route_bp
+    from API.appointments.cache import init_appointments_cache, relay_cache_invalidations
+    from API.appointments.catalog import init_reference_catalog
+    from API.appointments.feed import init_change_feed
+    from API.backend import document_backend
+    from API.authentication import init_token_cache
+    from API.database import init_sqlite_pragmas, init_read_engine
+    from API.metrics import init_metrics
 
     if config_class is None:
         raise ValueError("A Config Class Must Be Provided to 'create_app'")
     app = Flask(__name__)
     app.config.from_object(config_class)
     db.init_app(app)
-    migrate.init_app(app, db)
+    init_sqlite_pragmas(app)
+    init_read_engine(app)
+    # Flask-Migrate pulls in Alembic - a quarter of the app's import time - and is only used by the `flask db`
+    # commands, so it is only set up when the app is loaded by the flask CLI
+    if click.get_current_context(silent=True) is not None:
+        from flask_migrate import Migrate
+        Migrate(app, db)
     graph_auth.init_app(app)
+    init_appointments_cache(app)
+    init_reference_catalog(app)
+    init_change_feed(app)
+    relay_cache_invalidations(app)
+    init_token_cache(app)
+    document_backend.init_app(app)
+    init_metrics(app)
     app.register_blueprint(route_bp)
 
 
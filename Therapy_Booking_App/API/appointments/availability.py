@@ -0,0 +1,123 @@
+from collections import defaultdict
+
+from flask import current_app
+from graphql import GraphQLError
+from sqlalchemy import func, select
+from sqlalchemy.orm import aliased
+
+from API import db
+from API.models import Appointment as AppointmentModel
+from API.models import Therapist as TherapistModel
+from API.appointments.catalog import get_reference_catalog
+
+
+# Clients used to fetch every appointment in a date range and work out the gaps themselves. free_slots does this on
+# the server and only returns the gaps.
+#   1. The therapists to search are narrowed down in the reference catalog, so therapists the filters leave out cost
+#      nothing - their appointments are never read
+#   2. For each remaining therapist we read the appointments starting inside the window, plus the latest end of the
+#      appointments starting before it - any of which may run into the window, not only the last one (overlapping
+#      appointments are allowed unless REJECT_OVERLAPPING_APPOINTMENTS is set). Nothing running into the window can
+#      start before rangeStart minus the therapist's longest duration, which the (therapist_id, duration_seconds)
+#      index answers with one seek per therapist. Both reads are range searches of the (therapist_id,
+#      start_time_unix_seconds, ...) index so the work is linear in the therapist's appointments in (and just before)
+#      the window - another therapist's long appointments don't widen it
+#   3. A sweep line over each therapist's appointments (in start time order, as the index returns them) emits the gaps
+
+
+def find_gaps(intervals, range_start, range_end, min_duration_seconds):
+    """
+    Sweeps over a therapist's appointments and returns the free time between them
+    :param intervals: Iterable of (start, end) tuples ordered by start
+    :param range_start: Integer - unix seconds
+    :param range_end: Integer - unix seconds
+    :param min_duration_seconds: Integer - shorter gaps are not returned
+    :return: List of (start, end) tuples
+    """
+    gaps = []
+    free_from = range_start
+    for start, end in intervals:
+        if start >= range_end:
+            break
+        if start - free_from >= min_duration_seconds and start > free_from:
+            gaps.append((free_from, start))
+        free_from = max(free_from, end)
+
+    if range_end - free_from >= min_duration_seconds and range_end > free_from:
+        gaps.append((free_from, range_end))
+    return gaps
+
+
+def candidate_therapist_ids(therapist_ids, specialisms):
+    """
+    :param therapist_ids: List of Integers or None - only search these therapists
+    :param specialisms: List of specialism names or None - only search therapists holding any of these
+    :return: Sorted list of the ids of the therapists to search
+    """
+    catalog = get_reference_catalog()
+    candidates = set(catalog.therapists) if therapist_ids is None else set(therapist_ids) & set(catalog.therapists)
+    if specialisms is not None:
+        candidates &= catalog.therapist_ids_with_any(specialisms)
+    return sorted(candidates)
+
+
+def appointment_intervals(therapist_ids, range_start, range_end):
+    """
+    Reads every appointment that may overlap the window for the given therapists
+    :return: Dict mapping therapist_id to a list of (start, end) tuples ordered by start
+    """
+    start_time = AppointmentModel.start_time_unix_seconds
+    duration_seconds = func.coalesce(AppointmentModel.duration_seconds, 0)
+
+    # the latest end of each therapist's appointments starting before the window, searching back as far as that
+    # therapist's longest appointment. Both correlated subqueries are single index searches per therapist
+    longest = aliased(AppointmentModel)
+    longest_duration = select(func.coalesce(func.max(longest.duration_seconds), 0)).where(
+        longest.therapist_id == TherapistModel.therapist_id).correlate(TherapistModel).scalar_subquery()
+    latest_end = select(func.max(start_time + duration_seconds)).where(
+        AppointmentModel.therapist_id == TherapistModel.therapist_id, start_time < range_start,
+        start_time >= range_start - longest_duration).correlate(TherapistModel).scalar_subquery()
+    carried_in = db.session.execute(select(TherapistModel.therapist_id, latest_end).where(
+        TherapistModel.therapist_id.in_(therapist_ids))).all()
+
+    intervals = defaultdict(list)
+    for therapist_id, end in carried_in:
+        if end is not None:
+            # the therapist is busy from the start of the window until end
+            intervals[therapist_id].append((range_start, end))
+
+    rows = db.session.execute(select(AppointmentModel.therapist_id, start_time, duration_seconds).where(
+        AppointmentModel.therapist_id.in_(therapist_ids), start_time >= range_start, start_time < range_end).order_by(
+        AppointmentModel.therapist_id, start_time)).all()
+    for therapist_id, start, duration in rows:
+        intervals[therapist_id].append((start, start + duration))
+    return intervals
+
+
+def free_slots(therapist_ids, specialisms, range_start, range_end, min_duration_seconds):
+    """
+    :param therapist_ids: List of Integers or None
+    :param specialisms: List of specialism names or None
+    :param range_start: Integer - unix seconds
+    :param range_end: Integer - unix seconds
+    :param min_duration_seconds: Integer
+    :return: List of (therapist_id, start, end) tuples ordered by therapist then start
+    """
+    if range_end <= range_start:
+        raise GraphQLError({"code": "invalid_range", "description": "'rangeEnd' must be after 'rangeStart'"}, 400)
+    if min_duration_seconds < 0:
+        raise GraphQLError({"code": "invalid_duration",
+                            "description": "'minDurationSeconds' must not be negative"}, 400)
+
+    candidates = candidate_therapist_ids(therapist_ids, specialisms)
+    # each therapist id is sent as a bound parameter
+    chunk_size = current_app.config["REFERENCE_CATALOG_MAX_IN_LIST"]
+
+    slots = []
+    for chunk_start in range(0, len(candidates), chunk_size):
+        chunk = candidates[chunk_start:chunk_start + chunk_size]
+        intervals = appointment_intervals(chunk, range_start, range_end)
+        for therapist_id in chunk:
+            slots.extend((therapist_id, start, end) for start, end in
+                         find_gaps(intervals.get(therapist_id, ()), range_start, range_end, min_duration_seconds))
+    return slots
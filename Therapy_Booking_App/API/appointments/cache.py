@@ -0,0 +1,437 @@
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+from sqlalchemy import inspect
+
+from API.pagination import KeysetConnectionField
+from API.appointments.catalog import get_reference_catalog
+from API.appointments.feed import EVENT_FIELDS
+from API.appointments.loaders import get_loaders
+from API.selection import selected_paths, selection_signature
+
+
+# Clients poll the same appointments(filters: {...}) shapes over and over. AppointmentsCache keeps the resolved page
+# for each distinct (filters, sort, pagination, selection set) in a bounded LRU with a TTL. Entries are snapshots -
+# plain transient copies of the rows - so they can be shared between requests after the session which loaded them is
+# gone.
+# The cache lives in process memory so each worker has its own. Creating an appointment invalidates the entries in
+# this worker whose filters match it. Other workers hear of it through the change feed's bus (CHANGE_FEED_BUS_PATH,
+# see feed.py) and invalidate theirs within CHANGE_FEED_POLL_SECONDS - without a bus they rely on the TTL
+#
+# totalCount is the same for every page (and sort order) of a query. A second, shorter lived AppointmentsCache keeps
+# the counts keyed on the normalized filters alone so a client paging through results counts them once. It is
+# invalidated alongside the page cache
+
+# Selections the snapshots can't serve as they'd need relationships we don't copy
+UNCACHEABLE_PATHS = ("edges.node.therapists.appointments", "edges.node.therapists.specialisms.edges.node.therapists")
+
+# An appointment created by another worker, rebuilt from its change feed event
+RelayedAppointment = namedtuple("RelayedAppointment", EVENT_FIELDS)
+
+# Filter keys AppointmentsFilter produces which we know how to test an appointment against for invalidation
+FOOTPRINT_FILTERS = {"start_time_unix_seconds_range", "type", "type_in", "has_specialisms", "has_all_specialisms"}
+
+
+class FilterFootprint(namedtuple("FilterFootprint", "start_time_range types specialisms all_specialisms")):
+    """
+    The set of appointments a cached query could contain. A field of None means "any"
+    """
+
+    @classmethod
+    def from_filters(cls, filters):
+        if not filters:
+            return cls(None, None, None, None)
+        if set(filters) - FOOTPRINT_FILTERS:
+            # and/or/not combinations - be conservative and treat the entry as matching every appointment
+            return cls(None, None, None, None)
+
+        start_time_range = None
+        if filters.get("start_time_unix_seconds_range") is not None:
+            start_time_range = (filters["start_time_unix_seconds_range"]["begin"],
+                                filters["start_time_unix_seconds_range"]["end"])
+
+        types = None
+        if filters.get("type") is not None:
+            types = {filters["type"]}
+        if filters.get("type_in") is not None:
+            types = set(filters["type_in"]) if types is None else types & set(filters["type_in"])
+
+        specialisms = set(filters["has_specialisms"]) if filters.get("has_specialisms") is not None else None
+        all_specialisms = None
+        if filters.get("has_all_specialisms") is not None:
+            all_specialisms = set(filters["has_all_specialisms"])
+
+        return cls(start_time_range, types, specialisms, all_specialisms)
+
+    def matches(self, appointment, therapist_specialisms):
+        """
+        :param appointment: Appointment - a newly created appointment
+        :param therapist_specialisms: Callable returning the set of specialism names of the appointments therapist
+        :return: True if the appointment could appear in the results of a query with this footprint
+        """
+        if self.start_time_range is not None and appointment.start_time_unix_seconds is not None:
+            # an appointment without a start time is treated as matching every range
+            begin, end = self.start_time_range
+            if not begin <= appointment.start_time_unix_seconds <= end:
+                return False
+        if self.types is not None and appointment.type not in self.types:
+            return False
+        if self.specialisms is not None and not self.specialisms & therapist_specialisms():
+            return False
+        if self.all_specialisms is not None and not self.all_specialisms <= therapist_specialisms():
+            return False
+        return True
+
+    def overlaps(self, summary):
+        """
+        :param summary: AppointmentsSummary - a batch of newly created appointments
+        :return: True if any appointment in the batch could appear in the results of a query with this footprint
+        """
+        if self.start_time_range is not None and summary.start_time_range is not None:
+            begin, end = self.start_time_range
+            if summary.start_time_range[1] < begin or summary.start_time_range[0] > end:
+                return False
+        if self.types is not None and not self.types & summary.types:
+            return False
+        if self.specialisms is not None and not self.specialisms & summary.specialisms:
+            return False
+        if self.all_specialisms is not None and not self.all_specialisms <= summary.specialisms:
+            return False
+        return True
+
+
+class AppointmentsSummary(object):
+    """
+    The time range, types and therapist specialisms covered by a batch of appointments
+    """
+
+    def __init__(self, appointments, specialisms=None):
+        """
+        :param appointments: List of Appointment
+        :param specialisms: Set of the names of the therapists' specialisms if already known. Looked up otherwise
+        """
+        start_times = [appointment.start_time_unix_seconds for appointment in appointments]
+        # None (any range) if an appointment has no start time
+        self.start_time_range = None if None in start_times else (min(start_times), max(start_times))
+        self.types = {appointment.type for appointment in appointments}
+        self.therapist_ids = {appointment.therapist_id for appointment in appointments}
+        self._specialisms = specialisms
+
+    @property
+    def specialisms(self):
+        # only queried if an entry filters on specialisms - and then only once
+        if self._specialisms is None:
+            self._specialisms = therapists_specialism_names(self.therapist_ids)
+        return self._specialisms
+
+
+def snapshot(instance):
+    """
+    :param instance: A SQLAlchemy model instance
+    :return: A transient copy of the instance's loaded column values which is safe to share between sessions.
+    Columns which weren't selected (see projection.py) are left out rather than loaded
+    """
+    state = inspect(instance)
+    unloaded = state.unloaded
+    return state.mapper.class_(**{attribute.key: getattr(instance, attribute.key)
+                                  for attribute in state.mapper.column_attrs if attribute.key not in unloaded})
+
+
+class CachedPage(object):
+    """
+    A snapshot of a resolved appointments connection plus the therapists + specialisms its nodes reference
+    """
+
+    def __init__(self, connection, therapists, specialisms):
+        self.connection = connection
+        self.therapists = therapists
+        self.specialisms = specialisms
+
+    @classmethod
+    def from_connection(cls, connection, paths, loaders):
+        """
+        :param connection: The connection returned by KeysetConnectionField
+        :param paths: Set of the fields selected beneath appointments (see API.selection.selected_paths)
+        :param loaders: RequestLoaders - nested rows are fetched (and primed) through these so the current request
+                        doesn't load them a second time
+        :return: CachedPage
+        """
+        edges = [type(connection).Edge(node=snapshot(edge.node), cursor=edge.cursor) for edge in connection.edges]
+        therapist_ids = []
+        if "edges.node.therapists" in paths:
+            therapist_ids = sorted({edge.node.therapist_id for edge in edges if edge.node.therapist_id is not None})
+
+        therapists, specialisms = {}, {}
+        if "edges.node.therapists" in paths and therapist_ids:
+            for therapist in loaders.therapists.load_many(therapist_ids).get():
+                if therapist is not None:
+                    therapists[therapist.therapist_id] = snapshot(therapist)
+        if "edges.node.therapists.specialisms" in paths and therapist_ids:
+            for therapist_id, therapist_specialisms in zip(therapist_ids,
+                                                           loaders.specialisms.load_many(therapist_ids).get()):
+                specialisms[therapist_id] = [snapshot(specialism) for specialism in therapist_specialisms]
+
+        cached_connection = type(connection)(edges=edges, page_info=connection.page_info)
+        cached_connection.iterable = [edge.node for edge in edges]
+        cached_connection.length = len(edges)
+        return cls(cached_connection, therapists, specialisms)
+
+    def connection_for_request(self, count_total):
+        """
+        :param count_total: Callable returning the totalCount for the current request
+        :return: A copy of the cached connection - the cached one is shared between requests so is never modified
+        """
+        connection = type(self.connection)(edges=self.connection.edges, page_info=self.connection.page_info)
+        connection.iterable = self.connection.iterable
+        connection.length = self.connection.length
+        connection.count_total = count_total
+        return connection
+
+    def prime(self, loaders):
+        """
+        Primes the current request's DataLoaders so the nested therapist + specialism fields resolve without SQL
+        """
+        for therapist_id, therapist in self.therapists.items():
+            loaders.therapists.prime(therapist_id, therapist)
+        for therapist_id, specialisms in self.specialisms.items():
+            loaders.specialisms.prime(therapist_id, specialisms)
+
+
+def normalize(value):
+    """
+    Puts argument values into a canonical form so equivalent requests share a cache key e.g typeIn: ["a","b"] and
+    typeIn: ["b","a"]
+    """
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        items = [normalize(item) for item in value]
+        if all(isinstance(item, (str, int, float)) for item in items):
+            return sorted(items, key=lambda item: (type(item).__name__, item))
+        return items
+    return value
+
+
+def cache_key(info, args):
+    """
+    :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+    :param args: The arguments passed to the appointments field (filters, sort, first, last, after, before)
+    :return: str - the cache key for this request
+    """
+    sort = args.get("sort")
+    if sort is not None and not isinstance(sort, (list, tuple)):
+        sort = [sort]
+
+    return json.dumps({
+        "filters": normalize(args.get("filters")),
+        # sort order matters - a list of sort keys is not normalized
+        "sort": [str(sort_value) for sort_value in sort] if sort is not None else None,
+        "pagination": [args.get("first"), args.get("last"), args.get("after"), args.get("before")],
+        "selection": selection_signature(info),
+        "variables": info.variable_values,
+    }, sort_keys=True, default=str)
+
+
+def count_key(args):
+    """
+    :param args: The arguments passed to the appointments field
+    :return: str - the count cache key. Only the filters decide the count
+    """
+    return json.dumps({"filters": normalize(args.get("filters"))}, sort_keys=True, default=str)
+
+
+class AppointmentsCache(object):
+    """
+    A thread safe LRU with a TTL on every entry. Memory is bounded by max_entries (and each entry by MAX_PAGE_SIZE)
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # bumped by every invalidation so a page computed before an appointment was created is never stored after it
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, footprint, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value, footprint)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, appointment):
+        """
+        Removes every entry whose filters match a newly created appointment. Entries for other time ranges, types or
+        therapists are left alone
+        :param appointment: Appointment - the appointment which has just been committed
+        """
+        specialism_names = []
+
+        def therapist_specialisms():
+            # only queried if an entry filters on specialisms - and then only once
+            if not specialism_names:
+                specialism_names.append(therapist_specialism_names(appointment.therapist_id))
+            return specialism_names[0]
+
+        with self._lock:
+            stale_keys = [key for key, (_, _, footprint) in self._entries.items()
+                          if footprint.matches(appointment, therapist_specialisms)]
+            for key in stale_keys:
+                del self._entries[key]
+            self.invalidations += len(stale_keys)
+            self.generation += 1
+
+    def invalidate_many(self, appointments, specialisms=None):
+        """
+        Removes every entry which any of the appointments could appear in. The appointments are summarised (overall
+        time range, types and therapists) so this costs one pass over the entries however many were created
+        :param appointments: List of Appointment - appointments which have just been committed
+        :param specialisms: See AppointmentsSummary
+        """
+        if not appointments:
+            return
+
+        summary = AppointmentsSummary(appointments, specialisms)
+        with self._lock:
+            stale_keys = [key for key, (_, _, footprint) in self._entries.items() if footprint.overlaps(summary)]
+            for key in stale_keys:
+                del self._entries[key]
+            self.invalidations += len(stale_keys)
+            self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def therapist_specialism_names(therapist_id):
+    return therapists_specialism_names({therapist_id})
+
+
+def therapists_specialism_names(therapist_ids):
+    """
+    :param therapist_ids: Set of Integers
+    :return: Set of the names of every specialism held by any of the therapists
+    """
+    return get_reference_catalog().specialism_names(therapist_ids)
+
+
+def init_appointments_cache(app):
+    app.extensions["appointments_cache"] = AppointmentsCache(
+        max_entries=app.config["APPOINTMENTS_CACHE_MAX_ENTRIES"],
+        ttl_seconds=app.config["APPOINTMENTS_CACHE_TTL_SECONDS"],
+    )
+    app.extensions["appointment_counts_cache"] = AppointmentsCache(
+        max_entries=app.config["APPOINTMENTS_COUNT_CACHE_MAX_ENTRIES"],
+        ttl_seconds=app.config["APPOINTMENTS_COUNT_CACHE_TTL_SECONDS"],
+    )
+
+
+def relay_cache_invalidations(app):
+    """
+    Invalidates this worker's caches for the appointments other workers create, as their events arrive over the change
+    feed's bus. Events carry the therapist's specialisms so invalidating needs neither the app nor the database
+    """
+    hub = app.extensions["change_feed"]
+    caches = (app.extensions["appointments_cache"], app.extensions["appointment_counts_cache"])
+    if hub.bus is None or not any(cache.enabled for cache in caches):
+        return
+
+    def invalidate(events):
+        appointments = [RelayedAppointment(**{field: event.get(field) for field in EVENT_FIELDS}) for event in events]
+        specialisms = set().union(*(event.get("therapist_specialisms") or () for event in events))
+        for cache in caches:
+            cache.invalidate_many(appointments, specialisms)
+
+    hub.add_listener(invalidate)
+    # the relay is started in each worker by its first request rather than here - create_app runs in gunicorn's
+    # master before it forks
+    app.before_request(hub.start_relay)
+
+
+def get_appointments_cache():
+    """
+    :return: AppointmentsCache - the cache belonging to the current flask app
+    """
+    return current_app.extensions["appointments_cache"]
+
+
+def get_appointment_counts_cache():
+    """
+    :return: AppointmentsCache - the totalCount cache belonging to the current flask app
+    """
+    return current_app.extensions["appointment_counts_cache"]
+
+
+class CachedAppointmentsConnectionField(KeysetConnectionField):
+    """
+    A KeysetConnectionField which serves repeat requests from AppointmentsCache
+    """
+
+    @classmethod
+    def total_count(cls, info, args, resolved):
+        counts = get_appointment_counts_cache()
+        if not counts.enabled:
+            return super().total_count(info, args, resolved)
+
+        key = count_key(args)
+        count = counts.get(key)
+        if count is None:
+            generation = counts.generation
+            count = super().total_count(info, args, resolved)
+            counts.set(key, count, FilterFootprint.from_filters(args.get("filters")), generation)
+        return count
+
+    @classmethod
+    def connection_resolver(cls, resolver, connection_type, model, root, info, **args):
+        cache = get_appointments_cache()
+        paths = selected_paths(info)
+        if not cache.enabled or any(path.startswith(UNCACHEABLE_PATHS) for path in paths):
+            return super().connection_resolver(resolver, connection_type, model, root, info, **args)
+
+        # The resolver is always called - it authenticates the request and only builds (doesn't run) the SQL query
+        resolved = resolver(root, info, **args)
+
+        key = cache_key(info, args)
+        loaders = get_loaders(info.context)
+        cached_page = cache.get(key)
+        if cached_page is not None:
+            cached_page.prime(loaders)
+            return cached_page.connection_for_request(lambda: cls.total_count(info, args, resolved))
+
+        generation = cache.generation
+        connection = cls.resolve_connection(connection_type, model, info, args, resolved)
+        cache.set(key, CachedPage.from_connection(connection, paths, loaders),
+                  FilterFootprint.from_filters(args.get("filters")), generation)
+        return connection
@@ -0,0 +1,212 @@
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, has_app_context
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from API import db
+from API.models import Therapist as TherapistModel
+from API.models import Specialism as SpecialismModel
+from API.models import SpecialismsForTherapists
+
+logger = logging.getLogger(__name__)
+
+
+# Therapists, specialisms and the TherapistSpecialisms mapping are small and rarely change, yet every appointments
+# query joined or loaded them from SQLite. ReferenceCatalog keeps all three in process memory so the specialism
+# filters become a plain therapist_id IN (...) and nested therapist + specialism fields resolve without SQL.
+# The catalog is loaded on first use and rebuilt when
+#   - a session in this worker commits a change to a Therapist or Specialism (including their specialisms collection)
+#   - a cheap signature of the three tables (row counts + highest ids) changes. Checked at most every
+#     REFERENCE_CATALOG_CHECK_SECONDS so rows added by other workers or scripts are picked up
+#   - it is older than REFERENCE_CATALOG_MAX_AGE_SECONDS - a backstop for rows edited in place outside of the API
+
+
+class CatalogSnapshot(object):
+    """
+    An immutable view of the reference tables. Rows are detached copies which are safe to share between sessions
+    """
+
+    def __init__(self, therapists, specialisms, therapist_specialism_ids, signature):
+        self.therapists = therapists
+        self.specialisms = specialisms
+        self.signature = signature
+        self.loaded_at = time.monotonic()
+
+        specialisms_by_therapist = defaultdict(list)
+        therapist_ids_by_specialism_name = defaultdict(set)
+        for therapist_id, specialism_id in therapist_specialism_ids:
+            specialism = specialisms[specialism_id]
+            specialisms_by_therapist[therapist_id].append(specialism)
+            therapist_ids_by_specialism_name[specialism.specialism_name].add(therapist_id)
+
+        self.specialisms_by_therapist = {therapist_id: tuple(sorted(rows, key=lambda row: row.specialism_id))
+                                         for therapist_id, rows in specialisms_by_therapist.items()}
+        self.therapist_ids_by_specialism_name = {name: frozenset(therapist_ids)
+                                                 for name, therapist_ids in therapist_ids_by_specialism_name.items()}
+
+    def therapist_ids_with_any(self, specialism_names):
+        """
+        :param specialism_names: Iterable of specialism names
+        :return: Set of the ids of therapists holding at least one of the specialisms
+        """
+        therapist_ids = set()
+        for name in set(specialism_names):
+            therapist_ids |= self.therapist_ids_by_specialism_name.get(name, frozenset())
+        return therapist_ids
+
+    def therapist_ids_with_all(self, specialism_names):
+        """
+        :param specialism_names: Iterable of specialism names. Must not be empty
+        :return: Set of the ids of therapists holding every one of the specialisms
+        """
+        therapist_id_sets = sorted((self.therapist_ids_by_specialism_name.get(name, frozenset())
+                                    for name in set(specialism_names)), key=len)
+        return set(therapist_id_sets[0]).intersection(*therapist_id_sets[1:])
+
+    def specialism_names(self, therapist_ids):
+        """
+        :param therapist_ids: Iterable of therapist ids
+        :return: Set of the names of every specialism held by any of the therapists
+        """
+        return {specialism.specialism_name for therapist_id in therapist_ids
+                for specialism in self.specialisms_by_therapist.get(therapist_id, ())}
+
+
+def detached_copy(instance):
+    """
+    :param instance: A SQLAlchemy model instance
+    :return: A detached copy of the instance's column values - it can be merged into any session without SQL
+    """
+    mapper = db.inspect(instance).mapper
+    copy = mapper.class_(**{attribute.key: getattr(instance, attribute.key) for attribute in mapper.column_attrs})
+    make_transient_to_detached(copy)
+    return copy
+
+
+def table_signature(session):
+    """
+    :return: Tuple - row counts and highest ids of the reference tables. Changes when rows are added or removed
+    """
+    return session.execute(select(
+        select(func.count()).select_from(TherapistModel.__table__).scalar_subquery(),
+        select(func.max(TherapistModel.therapist_id)).scalar_subquery(),
+        select(func.count()).select_from(SpecialismModel.__table__).scalar_subquery(),
+        select(func.max(SpecialismModel.specialism_id)).scalar_subquery(),
+        select(func.count()).select_from(SpecialismsForTherapists).scalar_subquery(),
+    )).one()
+
+
+class ReferenceCatalog(object):
+    """
+    Holds the current CatalogSnapshot for one flask app. Readers take the snapshot reference and never see a partly
+    rebuilt catalog - a refresh builds a new snapshot and swaps it in
+    """
+
+    def __init__(self, check_seconds, max_age_seconds):
+        self.check_seconds = check_seconds
+        self.max_age_seconds = max_age_seconds
+        self.refreshes = 0
+        self._snapshot = None
+        self._stale = True
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def mark_stale(self):
+        self._stale = True
+
+    def refresh(self, signature=None):
+        """
+        Loads the reference tables with three queries and swaps in the new snapshot
+        :return: CatalogSnapshot
+        """
+        # cleared first so a change committed while we load marks the new snapshot stale again
+        self._stale = False
+        session = db.session
+        if signature is None:
+            signature = table_signature(session)
+
+        # copies are taken with the relationship loaders disabled - specialisms are mapped through the id pairs
+        therapists = {therapist.therapist_id: detached_copy(therapist) for therapist in
+                      session.query(TherapistModel).options(db.lazyload(TherapistModel.specialisms))}
+        specialisms = {specialism.specialism_id: detached_copy(specialism)
+                       for specialism in session.query(SpecialismModel)}
+        therapist_specialism_ids = session.execute(select(SpecialismsForTherapists.c.therapist_id,
+                                                          SpecialismsForTherapists.c.specialism_id)).all()
+
+        self._snapshot = CatalogSnapshot(therapists, specialisms, therapist_specialism_ids, signature)
+        self._checked_at = time.monotonic()
+        self.refreshes += 1
+        logger.debug({"message": "Reference Catalog Refreshed", "therapists": len(therapists),
+                      "specialisms": len(specialisms)})
+        return self._snapshot
+
+    def snapshot(self):
+        """
+        :return: CatalogSnapshot - refreshed first if the reference tables have (or may have) changed
+        """
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and not self._stale and now - self._checked_at < self.check_seconds:
+            return snapshot
+
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or self._stale or now - snapshot.loaded_at >= self.max_age_seconds:
+                return self.refresh()
+            if now - self._checked_at < self.check_seconds:
+                return snapshot
+
+            signature = table_signature(db.session)
+            if signature != snapshot.signature:
+                return self.refresh(signature)
+            self._checked_at = now
+            return snapshot
+
+
+def init_reference_catalog(app):
+    app.extensions["reference_catalog"] = ReferenceCatalog(
+        check_seconds=app.config["REFERENCE_CATALOG_CHECK_SECONDS"],
+        max_age_seconds=app.config["REFERENCE_CATALOG_MAX_AGE_SECONDS"],
+    )
+
+
+def get_reference_catalog():
+    """
+    :return: CatalogSnapshot - the current reference catalog of the current flask app
+    """
+    return current_app.extensions["reference_catalog"].snapshot()
+
+
+def mark_reference_catalog_stale():
+    """
+    Has the current flask app's catalog reloaded on its next use e.g a therapist was found missing from it
+    """
+    current_app.extensions["reference_catalog"].mark_stale()
+
+
+REFERENCE_MODELS = (TherapistModel, SpecialismModel)
+
+
+@event.listens_for(Session, "after_flush")
+def _record_reference_changes(session, flush_context):
+    # collection changes (e.g therapist.specialisms.append) mark the owning therapist dirty
+    if any(isinstance(instance, REFERENCE_MODELS) for instance in
+           list(session.new) + list(session.dirty) + list(session.deleted)):
+        session.info["reference_catalog_changed"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _refresh_after_reference_changes(session):
+    if session.info.pop("reference_catalog_changed", False) and has_app_context():
+        catalog = current_app.extensions.get("reference_catalog")
+        if catalog is not None:
+            catalog.mark_stale()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_reference_changes(session):
+    session.info.pop("reference_catalog_changed", None)
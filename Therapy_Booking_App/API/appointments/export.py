@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+from collections import namedtuple
+from itertools import islice
+
+from graphql.execution.values import coerce_value, is_valid_value
+
+from API import db
+from API.models import Appointment as AppointmentModel
+from API.models import Therapist as TherapistModel
+from API.appointments.catalog import get_reference_catalog
+from API.appointments.filters import AppointmentsFilter
+
+
+# Reports over months of appointments used to page through Query.appointments - every edge, cursor and node is built
+# in memory before the whole document is encoded in one go. /export/appointments streams the same rows instead
+#   * Filters are the appointments(filters: ...) input as JSON e.g {"typeIn": ["one-off"]}. They are validated
+#     against the schema's AppointmentsFilter type and applied by AppointmentsFilter itself
+#   * Rows are flat tuples (appointment columns outer joined to the therapist's name) rather than ORM objects, so
+#     nothing collects in the session's identity map. Specialisms come from the ReferenceCatalog
+#   * yield_per reads EXPORT_BATCH_SIZE rows from the cursor at a time and each batch is encoded and sent before the
+#     next is read - memory stays flat however large the range is
+# https://docs.sqlalchemy.org/en/14/orm/queryguide.html#yield-per
+# https://flask.palletsprojects.com/en/2.0.x/patterns/streaming/
+
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+
+EXPORT_COLUMNS = (
+    ("appointment_id", AppointmentModel.appointment_id),
+    ("start_time_unix_seconds", AppointmentModel.start_time_unix_seconds),
+    ("duration_seconds", AppointmentModel.duration_seconds),
+    ("type", AppointmentModel.type),
+    ("therapist_id", AppointmentModel.therapist_id),
+    ("therapist_first_name", TherapistModel.first_name),
+    ("therapist_last_name", TherapistModel.last_name),
+)
+EXPORT_FIELDS = tuple(name for name, _ in EXPORT_COLUMNS) + ("therapist_specialisms",)
+
+# AppointmentsFilter.filter only reads info.context (it keeps its aliases there)
+FilterInfo = namedtuple("FilterInfo", "context")
+
+
+def parse_filters(filters_type, raw_filters):
+    """
+    :param filters_type: GraphQLInputObjectType - the schema's AppointmentsFilter input type
+    :param raw_filters: str - a JSON object in the shape of the appointments filters argument, or None
+    :return: Dict of filters as AppointmentsFilter.filter takes them (snake_case keys) or None if there are none
+    """
+    if not raw_filters:
+        return None
+    try:
+        value = json.loads(raw_filters)
+    except ValueError:
+        raise ValueError("filters must be a JSON object")
+
+    errors = is_valid_value(value, filters_type)
+    if errors:
+        raise ValueError("; ".join(errors))
+    return coerce_value(filters_type, value)
+
+
+def export_query(context, filters):
+    """
+    :param context: The request - AppointmentsFilter keeps its aliases on it
+    :param filters: Dict returned by parse_filters (or None)
+    :return: A query of flat rows (see EXPORT_COLUMNS) in start time order
+    """
+    query = db.session.query(*(column for _, column in EXPORT_COLUMNS)).select_from(AppointmentModel).outerjoin(
+        TherapistModel, TherapistModel.therapist_id == AppointmentModel.therapist_id)
+    if filters is not None:
+        query = AppointmentsFilter.filter(FilterInfo(context=context), query, filters)
+    return query.order_by(AppointmentModel.start_time_unix_seconds, AppointmentModel.appointment_id)
+
+
+def export_rows(query, batch_size):
+    """
+    :param query: Query returned by export_query
+    :param batch_size: Integer - rows read from the cursor at a time
+    :return: Generator of Lists of Dicts - one list per batch
+    """
+    catalog = get_reference_catalog()
+    rows = iter(query.yield_per(batch_size))
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        records = []
+        for row in batch:
+            record = dict(zip(EXPORT_FIELDS, row))
+            record["therapist_specialisms"] = [specialism.specialism_name for specialism in
+                                               catalog.specialisms_by_therapist.get(row.therapist_id, ())]
+            records.append(record)
+        yield records
+
+
+def ndjson_chunks(batches):
+    """
+    :return: Generator of str - one JSON object per line, one chunk per batch
+    """
+    for records in batches:
+        yield "".join(json.dumps(record) + "\n" for record in records)
+
+
+def csv_chunks(batches):
+    """
+    :return: Generator of str - a header line then one chunk of CSV rows per batch. Specialisms are joined with ";"
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    yield buffer.getvalue()
+
+    for records in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        for record in records:
+            writer.writerow([";".join(record[field]) if field == "therapist_specialisms" else record[field]
+                             for field in EXPORT_FIELDS])
+        yield buffer.getvalue()
+
+
+def export_chunks(export_format, query, batch_size):
+    """
+    :param export_format: str - a key of EXPORT_FORMATS
+    :return: Generator of str - the encoded export
+    """
+    batches = export_rows(query, batch_size)
+    return csv_chunks(batches) if export_format == "csv" else ndjson_chunks(batches)
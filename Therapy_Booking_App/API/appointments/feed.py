@@ -0,0 +1,382 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from API.appointments.catalog import get_reference_catalog
+
+logger = logging.getLogger(__name__)
+
+
+# Clients polled Query.appointments every few seconds to find new bookings. /events/appointments instead holds a
+# Server-Sent Events stream open and pushes an event for each appointment created from then on
+#   * ChangeFeedHub fans each event out to the subscribers (open streams) in this worker whose filters (therapist,
+#     type, specialism) match it. Every subscriber has a bounded queue - a subscriber too slow to keep up is dropped
+#     (its stream is told and closed) rather than holding up publishing or growing without bound
+#   * Events are published by the appointment mutations once their transaction has committed
+#   * A stream can be served by any worker. SQLiteEventBus relays events between the workers on a host through a
+#     small SQLite file (CHANGE_FEED_BUS_PATH) - each event is appended to it and every worker with subscribers
+#     polls it for events published by other workers. Without a bus path events only reach streams in the publishing
+#     worker
+#   * With a bus every event is sent with its bus event_id as the SSE id. A client reconnecting with Last-Event-ID
+#     (as browsers' EventSource does) is first sent the matching events published after it - up to
+#     CHANGE_FEED_RETENTION_SECONDS ago - so a dropped or slow client doesn't miss events
+#   * Listeners (see add_listener) are also given the events relayed from other workers - the appointments caches use
+#     them to drop entries the new appointments belong in
+# https://html.spec.whatwg.org/multipage/server-sent-events.html
+
+EVENT_FIELDS = ("appointment_id", "start_time_unix_seconds", "duration_seconds", "type", "therapist_id")
+
+
+def appointment_event(appointment):
+    """
+    :param appointment: Appointment - a newly created appointment
+    :return: Dict - the event published for it. Carries the therapist's specialisms so subscribers can filter on them
+    """
+    event = {field: getattr(appointment, field) for field in EVENT_FIELDS}
+    event["therapist_specialisms"] = sorted(get_reference_catalog().specialism_names({appointment.therapist_id}))
+    return event
+
+
+class Subscription(object):
+    """
+    An open stream's filters and its queue of events waiting to be sent. A filter of None matches every event
+    """
+
+    def __init__(self, therapist_ids=None, types=None, specialisms=None, queue_size=100):
+        self.therapist_ids = therapist_ids
+        self.types = types
+        self.specialisms = specialisms
+        # (event_id, event) tuples. event_id is None without a bus
+        self.events = queue.Queue(queue_size)
+        self.dropped = False
+
+    def matches(self, event):
+        if self.therapist_ids is not None and event["therapist_id"] not in self.therapist_ids:
+            return False
+        if self.types is not None and event["type"] not in self.types:
+            return False
+        if self.specialisms is not None and not self.specialisms.intersection(event["therapist_specialisms"]):
+            return False
+        return True
+
+    def get(self, timeout):
+        """
+        :param timeout: Number - seconds to wait for an event
+        :return: (event_id, event) tuple - the next event, or None if there wasn't one within the timeout (or the
+        subscriber was dropped)
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class SQLiteEventBus(object):
+    """
+    Relays events between the processes on a host through a SQLite file
+    """
+
+    def __init__(self, path, poll_seconds=0.5, retention_seconds=300):
+        """
+        :param path: str - the SQLite file. Created if it doesn't exist
+        :param poll_seconds: Number - how often a relaying worker checks for new events
+        :param retention_seconds: Number - events older than this are deleted
+        """
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self.retention_seconds = retention_seconds
+        self._local = threading.local()
+        self._pid = None
+        self.origin = None
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            # a forked worker gets its own connections and origin - sqlite3 connections can't cross a fork
+            self._pid = os.getpid()
+            self._local = threading.local()
+            self.origin = uuid.uuid4().hex
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode = wal")
+            connection.execute("CREATE TABLE IF NOT EXISTS events (event_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "origin TEXT NOT NULL, created_at REAL NOT NULL, payload TEXT NOT NULL)")
+            self._local.connection = connection
+        return connection
+
+    def publish(self, events):
+        """
+        :param events: List of Dicts - appended in one transaction, so a bulk mutation commits (and syncs) the file once
+        :return: List of the events' event_ids
+        """
+        connection = self._connection()
+        created_at = time.time()
+        # IMMEDIATE takes the write lock up front - no other process inserts in between so the ids are consecutive
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT INTO events (origin, created_at, payload) VALUES (?, ?, ?)",
+                                   [(self.origin, created_at, json.dumps(event)) for event in events])
+            last_id = connection.execute("SELECT last_insert_rowid()").fetchone()[0]
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            raise
+        return list(range(last_id - len(events) + 1, last_id + 1))
+
+    def last_event_id(self):
+        return self._connection().execute("SELECT coalesce(max(event_id), 0) FROM events").fetchone()[0]
+
+    def read_after(self, event_id, include_own=False):
+        """
+        :param event_id: Integer - the last event already read
+        :param include_own: bool - also return the events this process published
+        :return: List of (event_id, event) tuples published by other processes since event_id, and the new last id
+        """
+        rows = self._connection().execute("SELECT event_id, origin, payload FROM events WHERE event_id > ? "
+                                          "ORDER BY event_id", (event_id,)).fetchall()
+        last_id = rows[-1][0] if rows else event_id
+        return [(row_id, json.loads(payload)) for row_id, origin, payload in rows
+                if include_own or origin != self.origin], last_id
+
+    def prune(self):
+        self._connection().execute("DELETE FROM events WHERE created_at < ?", (time.time() - self.retention_seconds,))
+
+
+class ChangeFeedHub(object):
+    """
+    Fans appointment events out to this worker's subscribers. Thread safe
+    """
+
+    def __init__(self, queue_size=100, max_subscribers=100, bus=None):
+        """
+        :param queue_size: Integer - events a subscriber may have waiting before it is dropped
+        :param max_subscribers: Integer - open streams per worker. Each holds a worker thread
+        :param bus: SQLiteEventBus or None - relays events to and from the other workers
+        """
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.bus = bus
+        self.published = 0
+        self.dropped_subscribers = 0
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._relay = None
+        self._relay_pid = None
+        self._stop_relay = threading.Event()
+
+    def subscribe(self, therapist_ids=None, types=None, specialisms=None):
+        """
+        :return: Subscription - or None if this worker already has max_subscribers
+        """
+        subscription = Subscription(therapist_ids, types, specialisms, self.queue_size)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            self._subscribers.add(subscription)
+        self.start_relay()
+        return subscription
+
+    def replay(self, subscription, last_event_id):
+        """
+        :param last_event_id: Integer - the id of the last event the client received
+        :return: List of (event_id, event) tuples - the events since last_event_id matching the subscription, read
+        from the bus. Empty without one
+        """
+        if self.bus is None:
+            return []
+        try:
+            events, _ = self.bus.read_after(last_event_id, include_own=True)
+        except sqlite3.Error:
+            logger.exception({"message": "Change Feed Events Could Not Be Replayed"})
+            return []
+        return [(event_id, event) for event_id, event in events if subscription.matches(event)]
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def publish(self, *events):
+        """
+        Sends events to this worker's subscribers and, through the bus, to every other worker's
+        :param events: Dicts returned by appointment_event
+        """
+        event_ids = [None] * len(events)
+        if self.bus is not None and events:
+            try:
+                event_ids = self.bus.publish(events)
+            except sqlite3.Error:
+                logger.exception({"message": "Change Feed Events Could Not Be Relayed", "events": events})
+        for event_id, event in zip(event_ids, events):
+            self.deliver(event, event_id)
+
+    def deliver(self, event, event_id=None):
+        """
+        :param event_id: Integer - the event's id on the bus, or None without one
+        """
+        with self._lock:
+            self.published += 1
+            slow_subscribers = []
+            for subscription in self._subscribers:
+                if not subscription.matches(event):
+                    continue
+                try:
+                    subscription.events.put_nowait((event_id, event))
+                except queue.Full:
+                    slow_subscribers.append(subscription)
+
+            for subscription in slow_subscribers:
+                subscription.dropped = True
+                self._subscribers.discard(subscription)
+            self.dropped_subscribers += len(slow_subscribers)
+
+    @property
+    def listening(self):
+        """
+        :return: bool - False if nothing could receive an event i.e no bus and no subscribers in this worker
+        """
+        return self.bus is not None or bool(self._subscribers)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def add_listener(self, listener):
+        """
+        :param listener: Callable given each list of events relayed from other workers. Called on the relay thread
+        """
+        self._listeners.append(listener)
+
+    def start_relay(self):
+        """
+        Starts this process's relay thread if it isn't running. Called by the first subscriber (or request - see
+        API.appointments.cache.relay_cache_invalidations) in each process - a thread started before gunicorn forks
+        isn't copied
+        """
+        if self.bus is None or (self._relay is not None and self._relay_pid == os.getpid()):
+            return
+        with self._lock:
+            if self._relay is not None and self._relay_pid == os.getpid():
+                return
+            self._relay_pid = os.getpid()
+            self._stop_relay = threading.Event()
+            self._relay = threading.Thread(target=self._run_relay, args=(self._stop_relay,), name="change-feed-relay",
+                                           daemon=True)
+            self._relay.start()
+
+    def _run_relay(self, stop):
+        last_id = self.bus.last_event_id()
+        pruned_at = time.monotonic()
+        while not stop.wait(self.bus.poll_seconds):
+            try:
+                events, last_id = self.bus.read_after(last_id)
+                for event_id, event in events:
+                    self.deliver(event, event_id)
+                if events:
+                    self._notify_listeners([event for _, event in events])
+                if time.monotonic() - pruned_at >= self.bus.retention_seconds:
+                    self.bus.prune()
+                    pruned_at = time.monotonic()
+            except sqlite3.Error:
+                logger.exception({"message": "Change Feed Relay Failed"})
+
+    def _notify_listeners(self, events):
+        for listener in self._listeners:
+            try:
+                listener(events)
+            except Exception:
+                logger.exception({"message": "Change Feed Listener Failed", "listener": repr(listener)})
+
+    def stop(self):
+        """
+        Stops this process's relay thread
+        """
+        self._stop_relay.set()
+        if self._relay is not None and self._relay_pid == os.getpid():
+            self._relay.join()
+        self._relay = None
+
+
+def max_subscribers(app):
+    """
+    :return: Integer - CHANGE_FEED_MAX_SUBSCRIBERS, lowered to leave at least one of the worker's threads for requests
+    other than streams
+    """
+    limit = max(app.config["WORKER_THREADS"] - 1, 0)
+    if app.config["CHANGE_FEED_MAX_SUBSCRIBERS"] > limit:
+        logger.warning({"message": "Change Feed Subscribers Limited By Worker Threads", "limit": limit,
+                        "configured": app.config["CHANGE_FEED_MAX_SUBSCRIBERS"]})
+        return limit
+    return app.config["CHANGE_FEED_MAX_SUBSCRIBERS"]
+
+
+def init_change_feed(app):
+    bus = None
+    if app.config["CHANGE_FEED_BUS_PATH"]:
+        bus = SQLiteEventBus(app.config["CHANGE_FEED_BUS_PATH"], poll_seconds=app.config["CHANGE_FEED_POLL_SECONDS"],
+                             retention_seconds=app.config["CHANGE_FEED_RETENTION_SECONDS"])
+    app.extensions["change_feed"] = ChangeFeedHub(
+        queue_size=app.config["CHANGE_FEED_QUEUE_SIZE"],
+        max_subscribers=max_subscribers(app),
+        bus=bus,
+    )
+
+
+def get_change_feed():
+    """
+    :return: ChangeFeedHub - the hub belonging to the current flask app
+    """
+    return current_app.extensions["change_feed"]
+
+
+def publish_appointments(appointments):
+    """
+    Publishes an event for each newly committed appointment
+    :param appointments: List of Appointment
+    """
+    hub = get_change_feed()
+    if not hub.listening:
+        # events needn't be built - building one looks up the therapist's specialisms
+        return
+    hub.publish(*(appointment_event(appointment) for appointment in appointments))
+
+
+def event_frame(event_id, event):
+    """
+    :return: str - the Server-Sent Event for an appointment event. Its id is the bus event_id when there is one
+    """
+    frame = f"event: appointment.created\ndata: {json.dumps(event)}\n\n"
+    return frame if event_id is None else f"id: {event_id}\n{frame}"
+
+
+def stream_events(subscription, keepalive_seconds, replay=()):
+    """
+    :param replay: List of (event_id, event) tuples returned by ChangeFeedHub.replay - sent first
+    :return: Generator of str - the Server-Sent Events for the subscription. A comment is sent every
+    keepalive_seconds without an event so proxies keep the connection open
+    """
+    yield ": connected\n\n"
+    # the subscription was opened before the replay was read so an event may be in both
+    replayed_ids = set()
+    for event_id, event in replay:
+        replayed_ids.add(event_id)
+        yield event_frame(event_id, event)
+
+    while True:
+        queued = subscription.get(keepalive_seconds)
+        if subscription.dropped:
+            yield 'event: dropped\ndata: {"reason": "slow_consumer"}\n\n'
+            return
+        if queued is None:
+            yield ": keep-alive\n\n"
+            continue
+        event_id, event = queued
+        if event_id is None or event_id not in replayed_ids:
+            yield event_frame(event_id, event)
@@ -1,10 +1,13 @@
 import graphene
+from flask import current_app
 from graphene_sqlalchemy_filter import FilterSet
 
+from API import db
 from API.models import Appointment as AppointmentModel
-from API.models import Therapist as TherapistModel
 from API.models import Specialism as SpecialismModel
-from sqlalchemy import and_
+from API.models import SpecialismsForTherapists
+from API.appointments.catalog import get_reference_catalog
+from sqlalchemy import func, true
 
 
 class AppointmentsFilter(FilterSet):
@@ -12,6 +15,7 @@ class AppointmentsFilter(FilterSet):
     # details on each filter operation can be found here
     # https://github.com/art1415926535/graphene-sqlalchemy-filter#automatically-generated-filters
     has_specialisms = graphene.List(of_type=graphene.String)
+    has_all_specialisms = graphene.List(of_type=graphene.String)
 
     class Meta:
         model = AppointmentModel
@@ -20,12 +24,63 @@ class AppointmentsFilter(FilterSet):
             'type': ['eq','in'],
         }
 
+    # Joining appointments to their therapists specialisms returns one row per matching specialism - an appointment
+    # whose therapist holds two of the requested specialisms came back twice, which also threw out the page sizes of
+    # our connection. Both specialism filters are instead semi-joins: an appointment is kept if its therapist is in the
+    # set of matching therapists and is never multiplied.
+    # A correlated EXISTS would have SQLite scan every appointment and probe TherapistSpecialisms for each one. Written
+    # as therapist_id IN (subquery) SQLite builds the (small) set of therapists once from the specialism_name and
+    # TherapistSpecialisms indexes and then searches appointments by therapist_id
+    # https://www.sqlite.org/optoverview.html#subquery_co_routines
+    # Usually we don't need the subquery at all - the matching therapists are looked up in the in process
+    # ReferenceCatalog and sent as therapist_id IN (1, 2, ...). The subquery is only used when there are more
+    # therapists than REFERENCE_CATALOG_MAX_IN_LIST as each id is sent as a bound parameter
+
+    @staticmethod
+    def therapist_specialisms(value):
+        """
+        :param value: List of specialism names
+        :return: A query of the therapist_id of every therapist specialism row with one of the named specialisms
+        """
+        return db.session.query(SpecialismsForTherapists.c.therapist_id).join(
+            SpecialismModel, SpecialismModel.specialism_id == SpecialismsForTherapists.c.specialism_id).filter(
+            SpecialismModel.specialism_name.in_(value))
+
+    @staticmethod
+    def therapist_id_in(therapist_ids, subquery):
+        """
+        :param therapist_ids: Set of Integers - the matching therapists according to the reference catalog
+        :param subquery: Callable returning a query of the same therapists - used when the set is too large
+        :return: A SQLAlchemy boolean clause
+        """
+        if len(therapist_ids) > current_app.config["REFERENCE_CATALOG_MAX_IN_LIST"]:
+            return AppointmentModel.therapist_id.in_(subquery())
+        return AppointmentModel.therapist_id.in_(sorted(therapist_ids))
+
     @classmethod
     def has_specialisms_filter(cls, info, query, value):
-        therapists = cls.aliased(query, TherapistModel, name='member_of')
-        specialisms = cls.aliased(query, SpecialismModel, name="specialism_of")
+        """
+        Appointments whose therapist holds ANY of the specialisms
+        therapist_id IN (...) or therapist_id IN (SELECT therapist_id FROM TherapistSpecialisms JOIN specialism ...)
+        """
+        therapist_ids = get_reference_catalog().therapist_ids_with_any(value)
+        return query, cls.therapist_id_in(therapist_ids, lambda: cls.therapist_specialisms(value))
+
+    @classmethod
+    def has_all_specialisms_filter(cls, info, query, value):
+        """
+        Appointments whose therapist holds EVERY one of the specialisms
+        therapist_id IN (...) or
+        therapist_id IN (SELECT therapist_id ... GROUP BY therapist_id HAVING count(DISTINCT specialism_name) = n)
+        """
+        specialism_names = set(value)
+        if not specialism_names:
+            return query, true()
 
-        query = query.join(therapists, and_(AppointmentModel.therapist_id == therapists.therapist_id, )).join(
-            specialisms, therapists.specialisms)
+        def therapists_with_all():
+            return cls.therapist_specialisms(specialism_names).group_by(
+                SpecialismsForTherapists.c.therapist_id).having(
+                func.count(SpecialismModel.specialism_name.distinct()) == len(specialism_names))
 
-        return query, specialisms.specialism_name.in_(value)
+        therapist_ids = get_reference_catalog().therapist_ids_with_all(specialism_names)
+        return query, cls.therapist_id_in(therapist_ids, therapists_with_all)
@@ -0,0 +1,73 @@
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from API import db
+from API.models import Therapist as TherapistModel
+from API.appointments.catalog import get_reference_catalog, mark_reference_catalog_stale
+
+
+# DataLoaders collect every key requested while resolving one level of the graph and then resolve them all at once.
+# Without them each appointment edge lazy loads its therapist and each therapist then fires its own query for its
+# specialisms. A page of N appointments would cost ~2N SQL round trips. Therapists + specialisms are now served from
+# the in process ReferenceCatalog (see catalog.py) so the loaders usually need no SQL at all. A therapist added by
+# another worker may not be in the catalog yet - it is read from the database and the catalog reloaded on next use
+# https://docs.graphene-python.org/en/latest/execution/dataloader/
+
+
+class TherapistLoader(DataLoader):
+    def batch_load_fn(self, therapist_ids):
+        """
+        Loads every therapist requested in this tick from the reference catalog
+        :param therapist_ids: List of Integers - therapist_id values collected by the loader
+        :return: A Promise resolving to a list of Therapists (or None) in the same order as therapist_ids
+        """
+        catalog = get_reference_catalog()
+        # merging the catalog's detached copies (load=False emits no SQL) attaches them to this request's session so
+        # relationships such as therapist.appointments can still be lazy loaded
+        therapists = {therapist_id: db.session.merge(catalog.therapists[therapist_id], load=False)
+                      for therapist_id in therapist_ids if therapist_id in catalog.therapists}
+
+        missing_ids = sorted(set(therapist_ids) - set(therapists))
+        if missing_ids:
+            # specialisms come from the catalog's id pairs rather than Therapist.specialisms' subquery load
+            therapists.update((therapist.therapist_id, therapist) for therapist in TherapistModel.query.options(
+                db.lazyload(TherapistModel.specialisms)).filter(TherapistModel.therapist_id.in_(missing_ids)))
+            mark_reference_catalog_stale()
+        return Promise.resolve([therapists.get(therapist_id) for therapist_id in therapist_ids])
+
+
+class SpecialismsLoader(DataLoader):
+    def batch_load_fn(self, therapist_ids):
+        """
+        Loads the specialisms for every therapist requested in this tick from the reference catalog
+        :param therapist_ids: List of Integers - therapist_id values collected by the loader
+        :return: A Promise resolving to a list of lists of Specialisms in the same order as therapist_ids
+        """
+        catalog = get_reference_catalog()
+        return Promise.resolve([[db.session.merge(specialism, load=False)
+                                 for specialism in catalog.specialisms_by_therapist.get(therapist_id, ())]
+                                for therapist_id in therapist_ids])
+
+
+class RequestLoaders(object):
+    """
+    The set of DataLoaders used while resolving a single request. Loaders cache the rows they return so they must not
+    outlive the request, otherwise a later request could be served stale data
+    """
+
+    def __init__(self):
+        self.therapists = TherapistLoader()
+        self.specialisms = SpecialismsLoader()
+
+
+def get_loaders(context):
+    """
+    Returns the DataLoaders for the current request, creating them on first use
+    :param context: info.context - the flask request object GraphQLView passes to every resolver
+    :return: RequestLoaders
+    """
+    loaders = getattr(context, "appointment_loaders", None)
+    if loaders is None:
+        loaders = RequestLoaders()
+        context.appointment_loaders = loaders
+    return loaders
@@ -1,21 +1,91 @@
 import graphene
 import logging
+from flask import current_app
+from graphql import GraphQLError
+from sqlalchemy import tuple_, select, or_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import make_transient_to_detached, aliased
+
 from API import db
 from API.authentication import header_must_have_jwt
 from API.models import Appointment as AppointmentModel
 from API.appointments.schema import AppointmentsSchema
+from API.appointments.cache import get_appointments_cache, get_appointment_counts_cache
+from API.appointments.feed import publish_appointments
+from API.selection import submitted_document
+from API.structured_logging import LazyPayload
 
 logger = logging.getLogger(__name__)
 
+# SQLite's default SQLITE_MAX_VARIABLE_NUMBER. Set based lookups are chunked so each statement stays under it
+SQLITE_MAX_VARIABLES = 999
+
+
+def insert_appointment_if_absent(values):
+    """
+    :param values: Dict - column values for the new appointment
+    :return: INSERT ... ON CONFLICT DO NOTHING statement. Its rowcount is 0 when the appointment already exists
+    """
+    return insert(AppointmentModel.__table__).values(**values).on_conflict_do_nothing(
+        index_elements=list(AppointmentModel.IDEMPOTENCY_KEY))
+
+
+# Overlap (double booking) rejection - enabled by Config.REJECT_OVERLAPPING_APPOINTMENTS
+# If a therapist's appointments don't overlap each other then a new appointment can only overlap its nearest neighbours:
+# the appointment starting at or before it (its predecessor) and the one starting at or after it (its successor). Each
+# is a single seek of the (therapist_id, start_time_unix_seconds, ...) unique index - O(log n) however many
+# appointments the therapist has - and no other appointment needs to be read.
+# The check runs AFTER our INSERT, inside the same transaction. The INSERT takes SQLite's write lock so a concurrent
+# create for the same therapist waits until we commit (or roll back) and its own check then sees our row
+# https://www.sqlite.org/lockingv3.html
+
+
+def overlapping_appointments(new_appointments):
+    """
+    :param new_appointments: A function given an aliased Appointment returning a clause matching the new appointments
+    :return: List of (appointment_id, start_time_unix_seconds) of the new appointments which overlap a neighbour
+    """
+    new, neighbour = aliased(AppointmentModel), aliased(AppointmentModel)
+    same_therapist = (neighbour.therapist_id == new.therapist_id, neighbour.appointment_id != new.appointment_id)
+
+    predecessor_end = select(neighbour.start_time_unix_seconds + neighbour.duration_seconds).where(
+        *same_therapist, neighbour.start_time_unix_seconds <= new.start_time_unix_seconds).order_by(
+        neighbour.start_time_unix_seconds.desc()).limit(1).scalar_subquery()
+    successor_start = select(neighbour.start_time_unix_seconds).where(
+        *same_therapist, neighbour.start_time_unix_seconds >= new.start_time_unix_seconds).order_by(
+        neighbour.start_time_unix_seconds).limit(1).scalar_subquery()
+
+    return db.session.execute(select(new.appointment_id, new.start_time_unix_seconds).where(
+        new_appointments(new), or_(predecessor_end > new.start_time_unix_seconds,
+                                   successor_start < new.start_time_unix_seconds + new.duration_seconds))).all()
+
+
+def reject_overlapping_appointments(new_appointments):
+    """
+    Rolls back the current transaction and raises a GraphQLError if any of the new appointments overlap another
+    appointment for the same therapist
+    :param new_appointments: See overlapping_appointments
+    """
+    overlapping = overlapping_appointments(new_appointments)
+    if overlapping:
+        db.session.rollback()
+        start_times = ", ".join(str(start_time) for _, start_time in overlapping)
+        logger.info("Rejected Overlapping Appointments Starting At %s", start_times)
+        raise GraphQLError({"code": "appointment_overlaps",
+                            "description": f"The therapist already has an appointment overlapping the appointment "
+                                           f"starting at {start_times}"}, 409)
+
 
 class AppointmentMutation(graphene.Mutation):
     appointment = graphene.Field(AppointmentsSchema)
 
     class Arguments:
-        therapist_id = graphene.Int()
-        start_time_unix_seconds = graphene.Int()
-        duration_seconds = graphene.Int()
-        type = graphene.String()
+        # Required - they make up the idempotency key and SQLite's unique index treats NULLs as distinct, so a repeated
+        # mutation with a null would create a new appointment each time
+        therapist_id = graphene.Int(required=True)
+        start_time_unix_seconds = graphene.Int(required=True)
+        duration_seconds = graphene.Int(required=True)
+        type = graphene.String(required=True)
 
     @header_must_have_jwt
     def mutate(self, info, therapist_id, start_time_unix_seconds, duration_seconds, type):
@@ -29,21 +99,122 @@ class AppointmentMutation(graphene.Mutation):
         :return: AppointmentMutation
         """
 
-        appointment = AppointmentModel.query.filter_by(therapist_id=therapist_id,
-                                                       start_time_unix_seconds=start_time_unix_seconds,
-                                                       duration_seconds=duration_seconds, type=type).first()
-        if appointment:
-            logger.info(f"Returned Existing Appointment {appointment}")
-            logger.debug({"message": "Returning Mutation", "mutation_submitted": info.context.json["query"],
-                          "appointment_returned": appointment})
+        # The unique constraint on these columns makes creation idempotent even when retries race each other. The
+        # insert is skipped if the appointment already exists - only then do we need to SELECT it
+        values = dict(therapist_id=therapist_id, start_time_unix_seconds=start_time_unix_seconds,
+                      duration_seconds=duration_seconds, type=type)
+        result = db.session.execute(insert_appointment_if_absent(values))
+        if result.rowcount and current_app.config["REJECT_OVERLAPPING_APPOINTMENTS"]:
+            new_appointment_id = result.inserted_primary_key[0]
+            reject_overlapping_appointments(lambda new: new.appointment_id == new_appointment_id)
+        db.session.commit()
+
+        if result.rowcount == 0:
+            appointment = AppointmentModel.query.filter_by(**values).first()
+            logger.info("Returned Existing Appointment %s", appointment)
+            logger.debug(LazyPayload(lambda: {"message": "Returning Mutation",
+                                              "mutation_submitted": submitted_document(info),
+                                              "appointment_returned": appointment}))
             return AppointmentMutation(appointment=appointment)
 
-        if not appointment:
-            appointment = AppointmentModel(therapist_id=therapist_id, start_time_unix_seconds=start_time_unix_seconds,
-                                           duration_seconds=duration_seconds, type=type)
-            db.session.add(appointment)
-            db.session.commit()
-        logger.info(f"Created New Appointment {appointment}")
-        logger.debug({"message": "Returning Mutation", "mutation_submitted": info.context.json["query"],
-                      "appointment_returned": appointment})
+        # We already know every column of the new row so it is attached to the session without reading it back
+        appointment = AppointmentModel(appointment_id=result.inserted_primary_key[0], **values)
+        make_transient_to_detached(appointment)
+        db.session.add(appointment)
+
+        get_appointments_cache().invalidate(appointment)
+        get_appointment_counts_cache().invalidate(appointment)
+        publish_appointments([appointment])
+        logger.info("Created New Appointment %s", appointment)
+        logger.debug(LazyPayload(lambda: {"message": "Returning Mutation",
+                                          "mutation_submitted": submitted_document(info),
+                                          "appointment_returned": appointment}))
         return AppointmentMutation(appointment=appointment)
+
+
+class AppointmentInput(graphene.InputObjectType):
+    therapist_id = graphene.Int(required=True)
+    start_time_unix_seconds = graphene.Int(required=True)
+    duration_seconds = graphene.Int(required=True)
+    type = graphene.String(required=True)
+
+
+def key_chunks(keys):
+    """
+    :param keys: List of (therapist_id, start_time_unix_seconds, duration_seconds, type) tuples
+    :return: Generator of lists of keys - each small enough to send as bound parameters in one statement
+    """
+    chunk_size = SQLITE_MAX_VARIABLES // len(AppointmentModel.IDEMPOTENCY_KEY)
+    for start in range(0, len(keys), chunk_size):
+        yield keys[start:start + chunk_size]
+
+
+def find_appointments(keys):
+    """
+    Looks up appointments by their idempotency key with one set based query per chunk of keys
+    :param keys: List of (therapist_id, start_time_unix_seconds, duration_seconds, type) tuples
+    :return: Dict mapping each key found to its Appointment
+    """
+    columns = [getattr(AppointmentModel, column_name) for column_name in AppointmentModel.IDEMPOTENCY_KEY]
+
+    found = {}
+    for chunk in key_chunks(keys):
+        for appointment in AppointmentModel.query.filter(tuple_(*columns).in_(chunk)):
+            found[tuple(getattr(appointment, name) for name in AppointmentModel.IDEMPOTENCY_KEY)] = appointment
+    return found
+
+
+class CreateAppointmentsMutation(graphene.Mutation):
+    appointments = graphene.List(AppointmentsSchema)
+
+    class Arguments:
+        input = graphene.List(graphene.NonNull(AppointmentInput), required=True)
+
+    @header_must_have_jwt
+    def mutate(self, info, input):
+        """
+        Creates many appointments in a single transaction. Like AppointmentMutation this is IDEMPOTENT - appointments
+        which already exist (or appear more than once in the input) are returned rather than created again
+        :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+        :param input: List of AppointmentInput
+        :return: CreateAppointmentsMutation - appointments are returned in the same order as the input
+        """
+        max_batch_size = current_app.config["MAX_BULK_APPOINTMENTS"]
+        if len(input) > max_batch_size:
+            raise GraphQLError({"code": "batch_too_large",
+                                "description": f"At most {max_batch_size} appointments can be created at once"}, 400)
+
+        input_keys = [tuple(appointment_input[name] for name in AppointmentModel.IDEMPOTENCY_KEY)
+                      for appointment_input in input]
+        # dict.fromkeys de-duplicates while keeping the input order
+        unique_keys = list(dict.fromkeys(input_keys))
+
+        appointments = find_appointments(unique_keys)
+        missing_keys = [key for key in unique_keys if key not in appointments]
+
+        created = []
+        if missing_keys:
+            # executemany - one prepared statement for every new row. ON CONFLICT covers rows created concurrently
+            db.session.execute(
+                insert(AppointmentModel.__table__).on_conflict_do_nothing(
+                    index_elements=list(AppointmentModel.IDEMPOTENCY_KEY)),
+                [dict(zip(AppointmentModel.IDEMPOTENCY_KEY, key)) for key in missing_keys])
+            if current_app.config["REJECT_OVERLAPPING_APPOINTMENTS"]:
+                # the whole batch is rejected if any appointment in it overlaps
+                for chunk in key_chunks(missing_keys):
+                    reject_overlapping_appointments(lambda new: tuple_(
+                        *(getattr(new, name) for name in AppointmentModel.IDEMPOTENCY_KEY)).in_(chunk))
+            db.session.commit()
+
+            # committing expires the rows we already loaded so every row is read back in one set based query
+            appointments = find_appointments(unique_keys)
+            created = [appointments[key] for key in missing_keys]
+            get_appointments_cache().invalidate_many(created)
+            get_appointment_counts_cache().invalidate_many(created)
+            publish_appointments(created)
+
+        logger.info("Bulk Appointment Creation - %s Created, %s Already Existed", len(created),
+                    len(unique_keys) - len(created))
+        logger.debug(LazyPayload(lambda: {"message": "Returning Mutation", "appointments_requested": len(input_keys),
+                                          "appointments_created": len(created)}))
+        return CreateAppointmentsMutation(appointments=[appointments[key] for key in input_keys])
@@ -0,0 +1,64 @@
+from graphene.utils.str_converters import to_snake_case
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only, selectinload
+
+from API.models import Appointment as AppointmentModel
+from API.models import Therapist as TherapistModel
+from API.pagination import KeysetConnectionField
+
+
+# AppointmentModel.query reads every column of every appointment whatever the client asked for.
+# appointment_load_options turns the selection set into loader options instead
+#   * load_only - only the columns of the selected fields are read, plus the primary key (the row's identity), the
+#     sort keys (encoded into each cursor) and therapist_id when therapists are selected (the TherapistLoader's key)
+#   * therapists { appointments } - the one nested relationship the ReferenceCatalog can't serve - is selectinloaded.
+#     The therapists' appointments are then read in one query rather than one lazy load per therapist.
+#     therapists { specialisms } needs no loader option as specialisms come from the catalog without any SQL
+# https://docs.sqlalchemy.org/en/14/orm/loading_columns.html#load-only-and-wildcard-options
+
+NODE = "edges.node."
+THERAPIST_APPOINTMENTS = NODE + "therapists.appointments"
+
+
+def selected_columns(model, paths, prefix):
+    """
+    :param model: The SQLAlchemy model the selected fields belong to
+    :param paths: Set of selected paths (see API.selection.selected_paths)
+    :param prefix: str - the path of the object whose fields are wanted e.g "edges.node."
+    :return: Set of the column attribute names of the fields selected directly beneath prefix
+    """
+    column_attrs = inspect(model).column_attrs
+    columns = set()
+    for path in paths:
+        if not path.startswith(prefix) or "." in path[len(prefix):]:
+            continue
+        key = to_snake_case(path[len(prefix):])
+        if key in column_attrs:
+            columns.add(key)
+    return columns
+
+
+def appointment_load_options(paths, sort=None):
+    """
+    :param paths: Set of the paths selected beneath the appointments field
+    :param sort: The sort argument passed to the appointments field
+    :return: List of loader options for the appointments query
+    """
+    mapper = inspect(AppointmentModel)
+    columns = selected_columns(AppointmentModel, paths, NODE)
+    columns.update(mapper.get_property_by_column(column).key
+                   for column, _ in KeysetConnectionField.get_sort_keys(AppointmentModel, sort))
+    if NODE + "therapists" in paths:
+        columns.add("therapist_id")
+    options = [load_only(*(getattr(AppointmentModel, key) for key in sorted(columns)))]
+
+    if THERAPIST_APPOINTMENTS in paths:
+        nested_columns = selected_columns(AppointmentModel, paths, THERAPIST_APPOINTMENTS + "." + NODE)
+        # appointments are matched to their therapist by therapist_id
+        nested_columns.update(("appointment_id", "therapist_id"))
+        therapists = selectinload(AppointmentModel.therapists)
+        options.append(therapists.selectinload(TherapistModel.appointments).load_only(
+            *(getattr(AppointmentModel, key) for key in sorted(nested_columns))))
+        # Therapist.specialisms is lazy="subquery" - its specialisms come from the catalog so they aren't loaded here
+        options.append(therapists.lazyload(TherapistModel.specialisms))
+    return options
@@ -5,11 +5,26 @@ from graphene_sqlalchemy import SQLAlchemyObjectType
 from API.models import Appointment as AppointmentModel
 from API.models import Therapist as TherapistModel
 from API.models import Specialism as SpecialismModel
+from API.appointments.loaders import get_loaders
+from API.pagination import CountableConnection
 
 class AppointmentsSchema(SQLAlchemyObjectType):
     class Meta:
         model = AppointmentModel
         interfaces = (graphene.relay.Node,)
+        connection_class = CountableConnection
+
+    @staticmethod
+    def resolve_therapists(parent, info):
+        """
+        Resolves the therapist for an appointment via the request scoped TherapistLoader
+        :param parent: The Appointment being resolved
+        :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+        :return: A Promise resolving to the appointments Therapist (or None)
+        """
+        if parent.therapist_id is None:
+            return None
+        return get_loaders(info.context).therapists.load(parent.therapist_id)
 
 
 class TherapistsSchema(SQLAlchemyObjectType):
@@ -17,8 +32,37 @@ class TherapistsSchema(SQLAlchemyObjectType):
         model = TherapistModel
         interfaces = (graphene.relay.Node,)
 
+    @staticmethod
+    def resolve_specialisms(parent, info, **kwargs):
+        """
+        Resolves the specialisms for a therapist via the request scoped SpecialismsLoader
+        :param parent: The Therapist being resolved
+        :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+        :param kwargs: Any connection arguments (first,after etc) - these are applied by the connection field
+        :return: A Promise resolving to a list of the therapists Specialisms
+        """
+        return get_loaders(info.context).specialisms.load(parent.therapist_id)
+
 
 class SpecialismSchema(SQLAlchemyObjectType):
     class Meta:
         model = SpecialismModel
-        interfaces = (graphene.relay.Node,)
\ No newline at end of file
+        interfaces = (graphene.relay.Node,)
+
+
+class FreeSlotSchema(graphene.ObjectType):
+    """
+    A gap in a therapists diary. Returned by the freeSlots query
+    """
+    therapist_id = graphene.Int()
+    start_time_unix_seconds = graphene.Int()
+    end_time_unix_seconds = graphene.Int()
+    duration_seconds = graphene.Int()
+    therapist = graphene.Field(TherapistsSchema)
+
+    @staticmethod
+    def resolve_therapist(parent, info):
+        """
+        Resolves the therapist for a free slot via the request scoped TherapistLoader
+        """
+        return get_loaders(info.context).therapists.load(parent.therapist_id)
@@ -1,2 +1,2 @@
 from API.authentication.mutations import RefreshMutation,AuthMutation
-from API.authentication.decorators import header_must_have_jwt
\ No newline at end of file
+from API.authentication.decorators import header_must_have_jwt, init_token_cache, get_token_cache
\ No newline at end of file
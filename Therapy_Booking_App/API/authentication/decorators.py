@@ -1,13 +1,88 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 import flask
-from flask import request
+from flask import request, current_app, _app_ctx_stack as ctx_stack
 from flask_graphql_auth.decorators import verify_jwt_in_argument, _extract_header_token_value
 from graphql import GraphQLError
 import logging
 
 logger=logging.getLogger(__name__)
 
+# Every resolver decorated with header_must_have_jwt used to verify the token's HMAC signature - several times for an
+# operation selecting more than one protected field and again on every request the client makes. The decoded token is
+# now kept on the request so it is verified once per request, and recently verified tokens are kept in a bounded LRU
+# (per worker) until they expire. Tokens are keyed by their SHA-256 digest so the cache never holds a usable token
+# https://pyjwt.readthedocs.io/en/stable/usage.html#expiration-time-claim-exp
+
+
+class VerifiedTokenCache(object):
+    """
+    A thread safe LRU of decoded access tokens. An entry is only returned while its token's exp claim is in the future
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def token_digest(token):
+        return hashlib.sha256(str(token).encode("utf8")).hexdigest()
+
+    def get(self, token):
+        """
+        :param token: str - an encoded access token
+        :return: Dict - the token's decoded claims or None if the token hasn't been verified or has since expired
+        """
+        digest = self.token_digest(token)
+        with self._lock:
+            jwt_data = self._entries.get(digest)
+            if jwt_data is not None and jwt_data["exp"] <= time.time():
+                del self._entries[digest]
+                jwt_data = None
+
+            if jwt_data is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(digest)
+            self.hits += 1
+            return jwt_data
+
+    def set(self, token, jwt_data):
+        """
+        :param token: str - an encoded access token which has just been verified
+        :param jwt_data: Dict - the token's decoded claims. Tokens without an exp claim are never cached
+        """
+        if self.max_entries <= 0 or not isinstance(jwt_data, dict) or "exp" not in jwt_data:
+            return
+        digest = self.token_digest(token)
+        with self._lock:
+            self._entries[digest] = jwt_data
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def init_token_cache(app):
+    app.extensions["verified_token_cache"] = VerifiedTokenCache(max_entries=app.config["JWT_VERIFIED_TOKEN_CACHE_SIZE"])
+
+
+def get_token_cache():
+    """
+    :return: VerifiedTokenCache - the cache belonging to the current flask app
+    """
+    return current_app.extensions["verified_token_cache"]
+
 def get_token_auth_header(auth_header):
     """
 
@@ -53,16 +128,32 @@ def header_must_have_jwt(fn):
 
         token = get_token_auth_header(request.headers.get("Authorization", None))
 
-        try:
-            verify_jwt_in_argument(token)
-        except Exception as e:
+        verified = getattr(request, "verified_token", None)
+        if verified is not None and verified[0] == token:
+            # already verified by another resolver of this request
+            ctx_stack.top.jwt = verified[1]
+            return fn(*args, **kwargs)
+
+        token_cache = get_token_cache()
+        jwt_data = token_cache.get(token)
+        if jwt_data is not None:
+            ctx_stack.top.jwt = jwt_data
+        else:
+            try:
+                verify_jwt_in_argument(token)
+            except Exception as e:
+
+                logger.error({"messages":"Token Decoding Error","error message":e})
+
+                raise GraphQLError({"code": "Invalid Token",
+                                    "description":
+                                        "Your Token Could Not Be Validated"
+                                    }, 401)
 
-            logger.error({"messages":"Token Decoding Error","error message":e})
+            jwt_data = getattr(ctx_stack.top, "jwt", None)
+            token_cache.set(token, jwt_data)
 
-            raise GraphQLError({"code": "Invalid Token",
-                                "description":
-                                    "Your Token Could Not Be Validated"
-                                }, 401)
+        request.verified_token = (token, jwt_data)
 
         return fn(*args, **kwargs)
 
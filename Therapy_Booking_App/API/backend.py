@@ -0,0 +1,139 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from graphql import parse, validate, execute
+from graphql.backend import GraphQLBackend
+from graphql.backend.base import GraphQLDocument
+from graphql.execution import ExecutionResult
+from graphql.language import ast
+from graphql.language.printer import print_ast
+
+from API.metrics import record_phase
+
+
+# GraphQL-Core's default backend parses the query string and validates it against our schema on every request. Our
+# frontend sends the same handful of documents over and over so CachedDocumentBackend does both once per document
+# and keeps the result in a bounded LRU keyed by a hash of the document
+# https://docs.graphene-python.org/en/latest/execution/queryvalidation/
+
+
+def execute_validated(schema, document_ast, validation_errors, *args, **kwargs):
+    """
+    Executes a document which has already been validated
+    :param validation_errors: List - the errors found when the document was first validated
+    """
+    kwargs.pop("validate", None)
+    if validation_errors:
+        return ExecutionResult(errors=validation_errors, invalid=True)
+    started = time.perf_counter()
+    try:
+        return execute(schema, document_ast, *args, **kwargs)
+    finally:
+        record_phase("execute", time.perf_counter() - started)
+
+
+class CachedDocumentBackend(GraphQLBackend):
+
+    def __init__(self, max_size=1000, executor=None):
+        self.max_size = max_size
+        self.execute_params = {"executor": executor}
+        self.hits = 0
+        self.misses = 0
+        # time spent parsing + validating documents on a cache miss. Used to estimate the time hits save
+        self.parse_and_validate_seconds = 0.0
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_size = app.config["GRAPHQL_DOCUMENT_CACHE_SIZE"]
+
+    @staticmethod
+    def document_key(schema, document_string):
+        return id(schema), hashlib.sha256(document_string.encode("utf8")).hexdigest()
+
+    def document_from_string(self, schema, document_string):
+        started = time.perf_counter()
+        try:
+            return self._document_from_string(schema, document_string)
+        finally:
+            record_phase("parse", time.perf_counter() - started)
+
+    def _document_from_string(self, schema, document_string):
+        if isinstance(document_string, ast.Document):
+            document_string = print_ast(document_string)
+
+        key = self.document_key(schema, document_string)
+        with self._lock:
+            document = self._documents.get(key)
+            if document is not None:
+                self._documents.move_to_end(key)
+                self.hits += 1
+                return document
+
+        # parse errors are raised to graphql_server (which returns them to the client) and are not cached
+        started = time.perf_counter()
+        document_ast = parse(document_string)
+        validation_errors = validate(schema, document_ast)
+        elapsed = time.perf_counter() - started
+
+        document = GraphQLDocument(
+            schema=schema,
+            document_string=document_string,
+            document_ast=document_ast,
+            execute=partial(execute_validated, schema, document_ast, validation_errors, **self.execute_params),
+        )
+
+        with self._lock:
+            self.misses += 1
+            self.parse_and_validate_seconds += elapsed
+            if self.max_size > 0:
+                self._documents[key] = document
+                while len(self._documents) > self.max_size:
+                    self._documents.popitem(last=False)
+
+        return document
+
+    def stats(self):
+        """
+        :return: Dict - hit/miss counters for this worker and an estimate of the parse + validate time hits saved
+        """
+        with self._lock:
+            average_seconds = self.parse_and_validate_seconds / self.misses if self.misses else 0.0
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._documents),
+                "max_size": self.max_size,
+                "parse_and_validate_seconds": self.parse_and_validate_seconds,
+                "estimated_seconds_saved": average_seconds * self.hits,
+            }
+
+
+class RequestDocumentBackend(object):
+    """
+    Hands each document of a request out once. RoutedGraphQLView reads a request's operations before GraphQLView
+    executes it - both go through this so the shared backend parses (and counts) each document once per request
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._documents = {}
+
+    def document_from_string(self, schema, document_string):
+        key = (id(schema), document_string if isinstance(document_string, str) else print_ast(document_string))
+        if key not in self._documents:
+            try:
+                self._documents[key] = (self.backend.document_from_string(schema, document_string), None)
+            except Exception as e:
+                # parse errors aren't cached by the shared backend - keep them so they're raised again without parsing
+                self._documents[key] = (None, e)
+        document, error = self._documents[key]
+        if error is not None:
+            raise error
+        return document
+
+
+document_backend = CachedDocumentBackend()
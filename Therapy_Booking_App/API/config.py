@@ -1,5 +1,7 @@
+import json
 import os
 from dotenv import load_dotenv
+from sqlalchemy.pool import QueuePool
 
 # This gives us the root directory for the project
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -15,3 +17,125 @@ class Config(object):
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY') or 'dev-jwt-secret-key'
     JWT_ACCESS_TOKEN_EXPIRES = 10
     GENERATE_MOCK_DATA= os.environ.get('GENERATE_MOCK_DATA') or False
+    # Page sizes for relay connections e.g appointments(first: 100). Requests above MAX_PAGE_SIZE are rejected
+    DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE') or 100)
+    MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE') or 500)
+    # Per worker cache of appointments query results. Setting either value to 0 disables the cache
+    APPOINTMENTS_CACHE_MAX_ENTRIES = int(os.environ.get('APPOINTMENTS_CACHE_MAX_ENTRIES') or 1024)
+    APPOINTMENTS_CACHE_TTL_SECONDS = int(os.environ.get('APPOINTMENTS_CACHE_TTL_SECONDS') or 30)
+    # Per worker cache of appointments totalCounts. Setting either value to 0 disables the cache
+    APPOINTMENTS_COUNT_CACHE_MAX_ENTRIES = int(os.environ.get('APPOINTMENTS_COUNT_CACHE_MAX_ENTRIES') or 1024)
+    APPOINTMENTS_COUNT_CACHE_TTL_SECONDS = int(os.environ.get('APPOINTMENTS_COUNT_CACHE_TTL_SECONDS') or 10)
+    # Rows /export/appointments reads from the database (and encodes) at a time
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE') or 1000)
+    # Request threads per gunicorn worker - gunicorn.conf.py reads the same variable
+    WORKER_THREADS = int(os.environ.get('GUNICORN_THREADS') or 4)
+    # Appointment change feed (/events/appointments). A stream whose client falls CHANGE_FEED_QUEUE_SIZE events behind
+    # is dropped. Each open stream holds a worker thread so each worker takes at most CHANGE_FEED_MAX_SUBSCRIBERS -
+    # half of WORKER_THREADS by default and always fewer than WORKER_THREADS, leaving threads for every other request
+    CHANGE_FEED_QUEUE_SIZE = int(os.environ.get('CHANGE_FEED_QUEUE_SIZE') or 100)
+    CHANGE_FEED_MAX_SUBSCRIBERS = int(os.environ.get('CHANGE_FEED_MAX_SUBSCRIBERS') or WORKER_THREADS // 2)
+    CHANGE_FEED_KEEPALIVE_SECONDS = float(os.environ.get('CHANGE_FEED_KEEPALIVE_SECONDS') or 15)
+    # SQLite file events are relayed between workers through. Unset, events only reach streams in the same worker
+    CHANGE_FEED_BUS_PATH = os.environ.get('CHANGE_FEED_BUS_PATH')
+    CHANGE_FEED_POLL_SECONDS = float(os.environ.get('CHANGE_FEED_POLL_SECONDS') or 0.5)
+    CHANGE_FEED_RETENTION_SECONDS = int(os.environ.get('CHANGE_FEED_RETENTION_SECONDS') or 300)
+    # Number of parsed + validated GraphQL documents each worker keeps
+    GRAPHQL_DOCUMENT_CACHE_SIZE = int(os.environ.get('GRAPHQL_DOCUMENT_CACHE_SIZE') or 1000)
+    # Largest number of operations a batched request (a JSON array of {"query": ...} objects) may contain. They run
+    # one after another on one worker thread
+    MAX_BATCH_OPERATIONS = int(os.environ.get('MAX_BATCH_OPERATIONS') or 10)
+    # Largest number of appointments createAppointments accepts in one request
+    MAX_BULK_APPOINTMENTS = int(os.environ.get('MAX_BULK_APPOINTMENTS') or 50000)
+    # Number of verified access tokens each worker remembers (until they expire). 0 verifies every request
+    JWT_VERIFIED_TOKEN_CACHE_SIZE = int(os.environ.get('JWT_VERIFIED_TOKEN_CACHE_SIZE') or 4096)
+    # In process catalog of therapists + specialisms. Rows added by other workers are noticed within CHECK_SECONDS and
+    # rows edited in place outside of the API within MAX_AGE_SECONDS
+    REFERENCE_CATALOG_CHECK_SECONDS = int(os.environ.get('REFERENCE_CATALOG_CHECK_SECONDS') or 5)
+    REFERENCE_CATALOG_MAX_AGE_SECONDS = int(os.environ.get('REFERENCE_CATALOG_MAX_AGE_SECONDS') or 300)
+    # Specialism filters send at most this many therapist ids as bound parameters before falling back to a subquery
+    REFERENCE_CATALOG_MAX_IN_LIST = int(os.environ.get('REFERENCE_CATALOG_MAX_IN_LIST') or 500)
+    # Reject new appointments which overlap another appointment for the same therapist (double bookings)
+    REJECT_OVERLAPPING_APPOINTMENTS = (os.environ.get('REJECT_OVERLAPPING_APPOINTMENTS') or 'False') == 'True'
+    # Sentry project errors and traces are sent to. Sentry is switched off unless SENTRY_DSN is set
+    SENTRY_DSN = os.environ.get('SENTRY_DSN') or None
+    # Trace sampling (see API/monitoring.py). Mutations and SENTRY_TRACES_HEAD_SAMPLE_RATE of other requests are
+    # recorded - only recorded requests pay for their spans. Recorded requests that error or take
+    # SENTRY_SLOW_REQUEST_SECONDS are always traced. Others are traced at the rate for their operation name or type -
+    # SENTRY_TRACES_SAMPLE_RATE if neither has one. At most SENTRY_MAX_SPANS_PER_SECOND spans are sent each second
+    SENTRY_TRACES_HEAD_SAMPLE_RATE = float(os.environ.get('SENTRY_TRACES_HEAD_SAMPLE_RATE') or 0.1)
+    SENTRY_TRACES_SAMPLE_RATE = float(os.environ.get('SENTRY_TRACES_SAMPLE_RATE') or 0.05)
+    SENTRY_TRACES_SAMPLE_RATES = json.loads(os.environ.get('SENTRY_TRACES_SAMPLE_RATES') or
+                                            '{"mutation": 0.5, "query": 0.05}')
+    SENTRY_SLOW_REQUEST_SECONDS = float(os.environ.get('SENTRY_SLOW_REQUEST_SECONDS') or 1.0)
+    SENTRY_MAX_SPANS_PER_SECOND = int(os.environ.get('SENTRY_MAX_SPANS_PER_SECOND') or 500)
+    SENTRY_TRACES_IGNORED_PATHS = ('/healthz', '/readyz', '/metrics', '/events/appointments')
+    # Dotted path of a Sentry transport class to use instead of sending events to Sentry's servers
+    SENTRY_TRANSPORT = os.environ.get('SENTRY_TRANSPORT')
+    # PRAGMAs run on every new database connection (see API/database.py). Empty by default - SQLite's own defaults
+    # are used
+    SQLITE_PRAGMAS = {}
+    # Run GraphQL query operations on a separate read engine (see API/database.py). Reads go to the main database
+    # through query_only connections unless SQLALCHEMY_READ_DATABASE_URI names a replica
+    ROUTE_QUERIES_TO_READ_ENGINE = (os.environ.get('ROUTE_QUERIES_TO_READ_ENGINE') or 'False') == 'True'
+    SQLALCHEMY_READ_DATABASE_URI = os.environ.get('SQLALCHEMY_READ_DATABASE_URI')
+    SQLALCHEMY_READ_ENGINE_OPTIONS = {}
+    # Logging (see API/structured_logging.py). Records are written as JSON by a background thread. LOG_LEVELS sets the
+    # level of individual loggers e.g {"API.schema": "DEBUG", "sqlalchemy.engine": "WARNING"}
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'DEBUG'
+    LOG_LEVELS = json.loads(os.environ.get('LOG_LEVELS') or '{}')
+    # Share of DEBUG records kept - overall and for individual loggers e.g {"API.schema": 0.01}
+    LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE') or 1.0)
+    LOG_DEBUG_SAMPLE_RATES = json.loads(os.environ.get('LOG_DEBUG_SAMPLE_RATES') or '{}')
+    # Records waiting to be written. Records logged while the queue is full are dropped rather than wait
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
+    # Resolver, SQL and per operation metrics served on /metrics in Prometheus' text format (see API/metrics.py)
+    METRICS_ENABLED = (os.environ.get('METRICS_ENABLED') or 'True') == 'True'
+    # Directory gunicorn workers write their metrics to so any worker can serve every worker's totals. Unset keeps
+    # each process' metrics in memory - fine for a single process
+    METRICS_MULTIPROCESS_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS') or 1.0)
+    # Bearer token scrapers may send to /metrics instead of a JWT. Unset only accepts JWTs
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN') or None
+    # Distinct operation names given their own series. Later names are counted as "other"
+    METRICS_MAX_OPERATION_NAMES = int(os.environ.get('METRICS_MAX_OPERATION_NAMES') or 100)
+
+
+class ProductionConfig(Config):
+    # WAL lets readers carry on while a writer commits. synchronous=NORMAL only syncs at checkpoints - a power loss
+    # can lose the last few commits but never corrupts the database
+    SQLITE_PRAGMAS = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        # milliseconds a connection waits for a lock before raising "database is locked"
+        "busy_timeout": int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS') or 5000),
+        # negative values are KiB - 64MiB of page cache per pooled connection
+        "cache_size": -int(os.environ.get('SQLITE_CACHE_SIZE_KIB') or 65536),
+        # bytes of the database file read through a memory map rather than read() calls
+        "mmap_size": int(os.environ.get('SQLITE_MMAP_SIZE_BYTES') or 268435456),
+        "temp_store": "memory",
+    }
+    ROUTE_QUERIES_TO_READ_ENGINE = (os.environ.get('ROUTE_QUERIES_TO_READ_ENGINE') or 'True') == 'True'
+    # DEBUG records include whole query documents - only log them from loggers named in LOG_LEVELS, and sampled
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE') or 0.1)
+    # Pools keep connections (and their page caches) open between requests. Flask-SQLAlchemy picks NullPool for
+    # SQLite files so the pool class must be given too.
+    # SQLite allows one writer at a time - mutations wait for the worker's writer connection (up to pool_timeout
+    # seconds) rather than retrying against the file lock
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "poolclass": QueuePool,
+        "pool_size": int(os.environ.get('SQLALCHEMY_WRITE_POOL_SIZE') or 1),
+        "max_overflow": 0,
+        "pool_timeout": int(os.environ.get('SQLALCHEMY_POOL_TIMEOUT') or 10),
+        # pooled connections are handed to whichever thread serves the next request
+        "connect_args": {"check_same_thread": False},
+    }
+    # Size the read pool to the threads per worker
+    SQLALCHEMY_READ_ENGINE_OPTIONS = {
+        "poolclass": QueuePool,
+        "pool_size": int(os.environ.get('SQLALCHEMY_READ_POOL_SIZE') or 8),
+        "max_overflow": int(os.environ.get('SQLALCHEMY_READ_MAX_OVERFLOW') or 4),
+        "pool_timeout": int(os.environ.get('SQLALCHEMY_POOL_TIMEOUT') or 10),
+        "connect_args": {"check_same_thread": False},
+    }
@@ -0,0 +1,192 @@
+from contextlib import contextmanager
+
+from flask import current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.engine.url import make_url
+
+
+# By default SQLite uses a rollback journal - a writer committing locks every reader out of the database - and
+# Flask-SQLAlchemy gives file databases a NullPool, so every request opens a new connection with a cold page cache.
+# Config.SQLITE_PRAGMAS are applied to every new DBAPI connection from a SQLAlchemy "connect" hook. ProductionConfig
+# uses them to switch on WAL (readers keep reading a consistent snapshot while a writer commits) and pairs them with
+# a QueuePool so connections - and their page caches - are reused between requests.
+# See https://www.sqlite.org/wal.html and https://www.sqlite.org/pragma.html
+#
+# With ROUTE_QUERIES_TO_READ_ENGINE the GraphQL view picks an engine per operation type. Query operations run on a
+# read engine - its own pool of query_only connections to the same file, or SQLALCHEMY_READ_DATABASE_URI (e.g a
+# replica) - so reads scale with the read pool. Mutations run on the writer engine whose pool is sized to serialise
+# writes in the worker rather than have them queue on SQLite's file lock
+
+READ = "read"
+WRITE = "write"
+# the config key holding each engine's create_engine options
+ENGINE_OPTIONS = {WRITE: "SQLALCHEMY_ENGINE_OPTIONS", READ: "SQLALCHEMY_READ_ENGINE_OPTIONS"}
+# QueuePool's max_overflow when the options don't give one
+DEFAULT_MAX_OVERFLOW = 10
+
+# busy_timeout goes first so switching journal_mode waits for other connections rather than failing. query_only goes
+# last - once it is on the connection can't change anything persistent
+PRAGMA_ORDER = ("busy_timeout", "journal_mode", "synchronous", "temp_store", "cache_size", "mmap_size", "query_only")
+
+
+class RoutingSession(SignallingSession):
+    """
+    Sends every statement to the read engine while the session's database route is READ
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.info.get("database_route") == READ:
+            read_engine = self.app.extensions.get("read_engine")
+            if read_engine is not None:
+                return read_engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    """
+    :param dbapi_connection: sqlite3.Connection - a newly opened connection
+    :param pragmas: Dict mapping pragma name to value e.g {"journal_mode": "wal"}
+    """
+    names = sorted(pragmas, key=lambda name: PRAGMA_ORDER.index(name) if name in PRAGMA_ORDER else len(PRAGMA_ORDER))
+    cursor = dbapi_connection.cursor()
+    try:
+        for name in names:
+            # values come from config, not from users. PRAGMA statements can't take bound parameters
+            cursor.execute(f"PRAGMA {name} = {pragmas[name]}")
+            # journal_mode returns the mode now in use
+            cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def listen_for_connections(engine, pragmas):
+    @event.listens_for(engine, "connect")
+    def _apply_pragmas(dbapi_connection, connection_record):
+        apply_sqlite_pragmas(dbapi_connection, pragmas)
+
+
+def init_sqlite_pragmas(app):
+    """
+    Registers the connect hook on the app's engine. Does nothing unless SQLITE_PRAGMAS are configured for a SQLite
+    database
+    """
+    pragmas = app.config.get("SQLITE_PRAGMAS")
+    if not pragmas or not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return
+
+    db = app.extensions["sqlalchemy"].db
+    listen_for_connections(db.get_engine(app), pragmas)
+
+
+def init_read_engine(app):
+    """
+    Creates the engine query operations are routed to when ROUTE_QUERIES_TO_READ_ENGINE is set. It is stored as
+    app.extensions["read_engine"]
+    """
+    if not app.config["ROUTE_QUERIES_TO_READ_ENGINE"]:
+        return
+
+    db = app.extensions["sqlalchemy"].db
+    uri = app.config["SQLALCHEMY_READ_DATABASE_URI"] or app.config["SQLALCHEMY_DATABASE_URI"]
+    # the same path handling + pool defaults as Flask-SQLAlchemy gives the writer engine
+    sa_url, options = db.apply_driver_hacks(app, make_url(uri), {})
+    options.update(app.config["SQLALCHEMY_READ_ENGINE_OPTIONS"])
+    engine = db.create_engine(sa_url, options)
+
+    if uri.startswith("sqlite"):
+        # a read connection that tries to write raises "attempt to write a readonly database"
+        listen_for_connections(engine, dict(app.config.get("SQLITE_PRAGMAS") or {}, query_only="ON"))
+    app.extensions["read_engine"] = engine
+
+
+def database_engines(app):
+    """
+    :return: Dict mapping WRITE (and READ when queries are routed to a read engine) to the app's engines
+    """
+    engines = {WRITE: app.extensions["sqlalchemy"].db.get_engine(app)}
+    if app.extensions.get("read_engine") is not None:
+        engines[READ] = app.extensions["read_engine"]
+    return engines
+
+
+def dispose_engines(app):
+    """
+    Closes every pooled connection. Called in each worker after a fork - SQLite connections must not be shared with
+    the process they were opened in
+    """
+    for engine in database_engines(app).values():
+        engine.dispose()
+
+
+def configured_max_overflow(app, route):
+    """
+    :param route: READ or WRITE
+    :return: Integer - the max_overflow the route's engine was created with. -1 means the pool has no limit
+    """
+    return (app.config.get(ENGINE_OPTIONS[route]) or {}).get("max_overflow", DEFAULT_MAX_OVERFLOW)
+
+
+def pool_exhausted(engine, max_overflow):
+    """
+    :param max_overflow: Integer - see configured_max_overflow
+    :return: bool - True if every connection the engine's pool may hold is checked out, so checking out another
+    would wait up to pool_timeout
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool) or max_overflow < 0:
+        return False
+    return pool.checkedout() >= pool.size() + max_overflow
+
+
+def probe_engine(engine, max_overflow):
+    """
+    Runs SELECT 1 against the engine's database. Raises if it can't be reached
+    :param max_overflow: Integer - see configured_max_overflow
+    :return: str - "ok", or "busy" if every pooled connection was serving a request. A busy pool is checked with a
+    connection opened outside of the pool rather than by waiting for one - e.g the single writer connection is held
+    by every mutation
+    """
+    if pool_exhausted(engine, max_overflow):
+        cargs, cparams = engine.dialect.create_connect_args(engine.url)
+        dbapi_connection = engine.dialect.connect(*cargs, **cparams)
+        try:
+            dbapi_connection.cursor().execute("SELECT 1")
+        finally:
+            dbapi_connection.close()
+        return "busy"
+
+    with engine.connect() as connection:
+        connection.exec_driver_sql("SELECT 1")
+    return "ok"
+
+
+def read_engine_enabled():
+    return current_app.extensions.get("read_engine") is not None
+
+
+@contextmanager
+def database_route(route):
+    """
+    Runs the block with the current session routed to the READ or WRITE engine. The session is closed afterwards so
+    the next block starts a fresh transaction (and sees the latest commits) on whichever engine it is routed to
+    :param route: READ or WRITE
+    """
+    if not read_engine_enabled():
+        yield
+        return
+
+    session = current_app.extensions["sqlalchemy"].db.session
+    session.info["database_route"] = route
+    try:
+        yield
+    finally:
+        session.close()
+        session.info.pop("database_route", None)
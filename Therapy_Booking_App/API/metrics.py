@@ -0,0 +1,455 @@
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+from flask import has_request_context, request
+from graphql.execution.middleware import MiddlewareManager
+from graphql.type import GraphQLEnumType, GraphQLScalarType
+from graphql.type.definition import get_named_type
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Request metrics in Prometheus' text format, served on /metrics. Each GraphQL request collects its numbers in a
+# RequestMetrics object (no locking while the request runs) which is folded into the app's MetricsRegistry once the
+# response is encoded
+#   * MetricsMiddleware (graphene execution middleware) times every field returning an object or a list - i.e
+#     resolvers doing real work such as resolve_appointments or AppointmentsSchema.therapists. Scalar fields are plain
+#     attribute reads and are skipped to keep the middleware's own overhead off large pages
+#   * before/after_cursor_execute hooks on every engine count the SQL statements a request runs and the time they take.
+#     Rows are the ORM objects loaded plus the rows changed by INSERT/UPDATE/DELETE - the sqlite3 driver can't report
+#     the rows a SELECT returns without fetching them
+#   * The view records time spent parsing (document cache lookups included), executing and JSON encoding
+# Per operation totals are the _sum and _count of the per operation histograms.
+# https://prometheus.io/docs/instrumenting/exposition_formats/
+#
+# Gunicorn workers are separate processes, each with its own registry. When METRICS_MULTIPROCESS_DIR is set each
+# worker writes its registry to <dir>/metrics-<pid>.json (at most every METRICS_FLUSH_SECONDS) and /metrics adds
+# together every worker's file, whichever worker serves the scrape. Requests recorded too soon after a write are
+# written by a flusher thread once the interval is up, so a worker which then goes idle doesn't hold them back. The
+# master folds the files of workers which exit into metrics-archive.json so counters never go backwards
+# (see gunicorn.conf.py)
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# name: (type, help, buckets)
+METRICS = {
+    "graphql_requests_total": (
+        "counter", "GraphQL requests by operation, operation type and status (ok or error)", None),
+    "graphql_request_seconds": (
+        "histogram", "Seconds from the request reaching the GraphQL view to its response being encoded",
+        SECONDS_BUCKETS),
+    "graphql_phase_seconds": (
+        "histogram", "Seconds each request spent parsing + validating, executing and JSON encoding", SECONDS_BUCKETS),
+    "graphql_resolver_seconds": (
+        "histogram", "Seconds spent in resolvers of object and list fields, including DataLoader batches",
+        SECONDS_BUCKETS),
+    "graphql_request_sql_statements": (
+        "histogram", "SQL statements executed per request", COUNT_BUCKETS),
+    "graphql_request_sql_rows": (
+        "histogram", "ORM objects loaded plus rows changed by INSERT, UPDATE and DELETE statements per request",
+        COUNT_BUCKETS),
+    "graphql_request_sql_seconds": (
+        "histogram", "Seconds per request spent executing SQL statements", SECONDS_BUCKETS),
+}
+
+ARCHIVE_FILE = "metrics-archive.json"
+# Operation label given to operations once METRICS_MAX_OPERATION_NAMES distinct names have been seen
+OTHER_OPERATIONS = "other"
+
+
+class RequestMetrics(object):
+    """
+    The numbers collected while serving a single GraphQL request
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        # (operation type, operation name) of each operation executed
+        self.operations = set()
+        self.resolver_seconds = defaultdict(list)
+        self.phase_seconds = defaultdict(float)
+        self.sql_statements = 0
+        self.sql_rows = 0
+        self.sql_seconds = 0.0
+
+
+def current_request_metrics():
+    """
+    :return: RequestMetrics - for the GraphQL request being served, or None
+    """
+    if not has_request_context():
+        return None
+    return getattr(request, "metrics", None)
+
+
+def record_phase(phase, seconds):
+    metrics = current_request_metrics()
+    if metrics is not None:
+        metrics.phase_seconds[phase] += seconds
+
+
+class MetricsRegistry(object):
+
+    def __init__(self, max_operation_names=100, multiprocess_dir=None, flush_seconds=1.0):
+        """
+        :param max_operation_names: Integer - distinct operation names given their own label. Clients choose the
+        names so without a cap they could create any number of series
+        :param multiprocess_dir: str - directory each process writes its metrics to. None keeps them in memory only
+        :param flush_seconds: Number - shortest interval between writes to multiprocess_dir
+        """
+        self.max_operation_names = max_operation_names
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # a forked worker starts again from nothing - anything the parent recorded is in the parent's file
+        self._pid = os.getpid()
+        self._counters = defaultdict(float)
+        # (name, labels) -> [bucket counts..., sum, count]
+        self._histograms = {}
+        self._operation_names = set()
+        self._flushed_at = None
+        # requests recorded since the last write
+        self._dirty = False
+        # threads aren't copied into a forked worker
+        self._flusher = None
+        self._stop_flusher = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def operation_label(self, operations):
+        """
+        :param operations: Set of (operation type, operation name) tuples
+        :return: Tuple of (operation label, operation type label)
+        """
+        names = "+".join(sorted(name or "anonymous" for _, name in operations)) or "unknown"
+        types = "+".join(sorted({operation_type for operation_type, _ in operations})) or "unknown"
+        with self._lock:
+            if names not in self._operation_names:
+                if len(self._operation_names) >= self.max_operation_names:
+                    return OTHER_OPERATIONS, types
+                self._operation_names.add(names)
+        return names, types
+
+    def _observe(self, name, labels, value):
+        key = (name, labels)
+        buckets = METRICS[name][2]
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * len(buckets) + [0.0, 0]
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[index] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def record_request(self, metrics, failed):
+        """
+        Folds a finished request into the registry
+        :param metrics: RequestMetrics
+        :param failed: bool - the request returned errors
+        """
+        seconds = time.perf_counter() - metrics.started_at
+        operation, operation_type = self.operation_label(metrics.operations)
+        by_operation = (("operation", operation),)
+
+        with self._lock:
+            self._check_pid()
+            self._dirty = True
+            if self.multiprocess_dir and self._flusher is None:
+                self._stop_flusher = threading.Event()
+                self._flusher = threading.Thread(target=self._run_flusher, args=(self._stop_flusher,),
+                                                 name="metrics-flusher", daemon=True)
+                self._flusher.start()
+            labels = (("operation", operation), ("status", "error" if failed else "ok"), ("type", operation_type))
+            self._counters[("graphql_requests_total", labels)] += 1
+            self._observe("graphql_request_seconds", by_operation, seconds)
+            self._observe("graphql_request_sql_statements", by_operation, metrics.sql_statements)
+            self._observe("graphql_request_sql_rows", by_operation, metrics.sql_rows)
+            self._observe("graphql_request_sql_seconds", by_operation, metrics.sql_seconds)
+            for phase, phase_seconds in metrics.phase_seconds.items():
+                self._observe("graphql_phase_seconds", (("phase", phase),), phase_seconds)
+            for field, observations in metrics.resolver_seconds.items():
+                for resolver_seconds in observations:
+                    self._observe("graphql_resolver_seconds", (("field", field),), resolver_seconds)
+
+        self.flush()
+
+    def snapshot(self):
+        """
+        :return: Dict - this process' metrics, ready to be dumped as JSON
+        """
+        with self._lock:
+            self._check_pid()
+            return {
+                "counters": [[name, list(map(list, labels)), value]
+                             for (name, labels), value in self._counters.items()],
+                "histograms": [[name, list(map(list, labels)), list(values)]
+                               for (name, labels), values in self._histograms.items()],
+            }
+
+    def _run_flusher(self, stop):
+        while not stop.wait(self.flush_seconds):
+            if not self._dirty:
+                continue
+            try:
+                self.flush(force=True)
+            except OSError:
+                logger.exception({"message": "Metrics Could Not Be Written", "path": self.process_file()})
+
+    def stop(self):
+        """
+        Stops this process' flusher thread. Requests recorded later start it again
+        """
+        with self._lock:
+            if self._flusher is None:
+                return
+            self._stop_flusher.set()
+            self._flusher = None
+
+    def process_file(self):
+        return os.path.join(self.multiprocess_dir, f"metrics-{os.getpid()}.json")
+
+    def flush(self, force=False):
+        """
+        Writes this process' metrics to the multiprocess directory. Writes closer together than flush_seconds are
+        skipped unless forced
+        """
+        if not self.multiprocess_dir:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and self._flushed_at is not None and now - self._flushed_at < self.flush_seconds:
+                return
+            self._flushed_at = now
+            self._dirty = False
+        write_snapshot(self.process_file(), self.snapshot())
+
+    def collect(self):
+        """
+        :return: Dict - the metrics of every process sharing the multiprocess directory (or of this process alone)
+        """
+        if not self.multiprocess_dir:
+            return self.snapshot()
+        self.flush(force=True)
+        return merge_snapshots(read_snapshot(path)
+                               for path in glob.glob(os.path.join(self.multiprocess_dir, "metrics-*.json")))
+
+    def render(self):
+        return render_snapshot(self.collect())
+
+
+def write_snapshot(path, snapshot):
+    # written to a temporary file then renamed over the old one - a scrape never reads half a file
+    directory = os.path.dirname(path)
+    file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix=".metrics-", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "w") as fp:
+            json.dump(snapshot, fp)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def read_snapshot(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        # the file belonged to a worker which has just been archived
+        return {"counters": [], "histograms": []}
+
+
+def merge_snapshots(snapshots):
+    """
+    :param snapshots: Iterable of Dicts returned by MetricsRegistry.snapshot
+    :return: Dict - a snapshot holding the sum of every counter and histogram
+    """
+    counters = defaultdict(float)
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            counters[(name, tuple(map(tuple, labels)))] += value
+        for name, labels, values in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            if key not in histograms:
+                histograms[key] = list(values)
+            else:
+                histograms[key] = [total + value for total, value in zip(histograms[key], values)]
+
+    return {
+        "counters": [[name, list(map(list, labels)), value] for (name, labels), value in counters.items()],
+        "histograms": [[name, list(map(list, labels)), values] for (name, labels), values in histograms.items()],
+    }
+
+
+def archive_worker_metrics(multiprocess_dir, pid):
+    """
+    Folds the file of a worker which has exited into the archive file. Called by the gunicorn master
+    :param multiprocess_dir: str - METRICS_MULTIPROCESS_DIR
+    :param pid: Integer - the worker's process id
+    """
+    worker_path = os.path.join(multiprocess_dir, f"metrics-{pid}.json")
+    if not os.path.exists(worker_path):
+        return
+    archive_path = os.path.join(multiprocess_dir, ARCHIVE_FILE)
+    write_snapshot(archive_path, merge_snapshots([read_snapshot(archive_path), read_snapshot(worker_path)]))
+    os.unlink(worker_path)
+
+
+def clear_multiprocess_dir(multiprocess_dir):
+    """
+    Removes the files left by a previous server. Called by the gunicorn master before it starts any workers
+    """
+    os.makedirs(multiprocess_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(multiprocess_dir, "metrics-*.json")):
+        os.unlink(path)
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def render_snapshot(snapshot):
+    """
+    :param snapshot: Dict returned by MetricsRegistry.snapshot or merge_snapshots
+    :return: str - the metrics in Prometheus' text exposition format
+    """
+    series = defaultdict(list)
+    for name, labels, value in snapshot["counters"]:
+        series[name].append((tuple(map(tuple, labels)), value))
+    for name, labels, values in snapshot["histograms"]:
+        series[name].append((tuple(map(tuple, labels)), values))
+
+    lines = []
+    for name, (metric_type, help_text, buckets) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for labels, value in sorted(series.get(name, ()), key=lambda item: item[0]):
+            if metric_type == "counter":
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+                continue
+            for bound, bucket_count in zip(buckets, value):
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', _format_value(bound)),))} "
+                             f"{_format_value(bucket_count)}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {_format_value(value[-1])}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(value[-2])}")
+            lines.append(f"{name}_count{_format_labels(labels)} {_format_value(value[-1])}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware(object):
+    """
+    Graphene execution middleware timing object and list field resolvers. Fields resolved by a DataLoader are timed
+    until the loader's batch resolves them
+    """
+
+    def resolve(self, next, root, info, **args):
+        metrics = current_request_metrics()
+        if metrics is None:
+            return next(root, info, **args)
+
+        if len(info.path) == 1:
+            operation = info.operation
+            metrics.operations.add((operation.operation, operation.name.value if operation.name else None))
+
+        if isinstance(get_named_type(info.return_type), (GraphQLScalarType, GraphQLEnumType)):
+            return next(root, info, **args)
+
+        field = f"{info.parent_type.name}.{info.field_name}"
+        started = time.perf_counter()
+        result = next(root, info, **args)
+        if hasattr(result, "then"):
+            def _observe(value):
+                metrics.resolver_seconds[field].append(time.perf_counter() - started)
+                return value
+            return result.then(_observe)
+
+        metrics.resolver_seconds[field].append(time.perf_counter() - started)
+        return result
+
+
+# graphql-core wraps every resolver of a plain middleware list in a Promise. Large pages resolve thousands of fields so
+# results are passed through as they are - MetricsMiddleware handles Promises itself
+metrics_middleware = MiddlewareManager(MetricsMiddleware(), wrap_in_promise=False)
+
+
+def listen_for_statements(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        if current_request_metrics() is not None:
+            conn.info.setdefault("metrics_statement_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _record_statement(conn, cursor, statement, parameters, context, executemany):
+        metrics = current_request_metrics()
+        started = conn.info.get("metrics_statement_started_at")
+        if metrics is None or not started:
+            return
+        metrics.sql_statements += 1
+        metrics.sql_seconds += time.perf_counter() - started.pop()
+        # -1 for SELECTs
+        if cursor.rowcount > 0:
+            metrics.sql_rows += cursor.rowcount
+
+
+_listening_for_loads = False
+
+
+def listen_for_loads(model):
+    # mapper events are global (not per engine or app) so the listener is only registered once per process
+    global _listening_for_loads
+    if _listening_for_loads:
+        return
+    _listening_for_loads = True
+
+    @event.listens_for(model, "load", propagate=True)
+    def _record_load(target, context):
+        metrics = current_request_metrics()
+        if metrics is not None:
+            metrics.sql_rows += 1
+
+
+def init_metrics(app):
+    """
+    Creates the app's MetricsRegistry (stored as app.extensions["metrics"]) and registers the SQL hooks on every
+    engine. Does nothing unless METRICS_ENABLED is set
+    """
+    from API.database import database_engines
+
+    if not app.config["METRICS_ENABLED"]:
+        return
+
+    multiprocess_dir = app.config["METRICS_MULTIPROCESS_DIR"]
+    if multiprocess_dir:
+        os.makedirs(multiprocess_dir, exist_ok=True)
+    app.extensions["metrics"] = MetricsRegistry(
+        max_operation_names=app.config["METRICS_MAX_OPERATION_NAMES"],
+        multiprocess_dir=multiprocess_dir,
+        flush_seconds=app.config["METRICS_FLUSH_SECONDS"],
+    )
+
+    for engine in database_engines(app).values():
+        listen_for_statements(engine)
+    listen_for_loads(app.extensions["sqlalchemy"].db.Model)
@@ -5,7 +5,11 @@ SpecialismsForTherapists = db.Table("TherapistSpecialisms",
                                     db.Column("therapist_id", db.Integer, db.ForeignKey('therapist.therapist_id'),
                                               primary_key=True),
                                     db.Column("specialism_id", db.Integer,
-                                              db.ForeignKey('specialism.specialism_id'), primary_key=True)
+                                              db.ForeignKey('specialism.specialism_id'), primary_key=True),
+                                    # The primary key only serves therapist -> specialism lookups. The reverse key
+                                    # serves the specialism -> therapist join used by the hasSpecialisms filter
+                                    db.Index("ix_therapist_specialisms_specialism_id_therapist_id", "specialism_id",
+                                             "therapist_id")
                                     )
 
 
@@ -14,6 +18,20 @@ SpecialismsForTherapists = db.Table("TherapistSpecialisms",
 
 class Appointment(db.Model):
     __tablename__ = "Appointments"
+    # Indexes match the query shapes exposed by our API
+    #   start time + type -> startTimeUnixSecondsRange filter (optionally combined with type/typeIn)
+    #   type + start time -> type/typeIn filters without a date range
+    #   therapist + duration -> each therapist's longest appointment, read by freeSlots with a single index seek
+    #   therapist + start time + duration + type -> hasSpecialisms join and AppointmentMutation idempotency. This one is
+    #   a unique constraint so the same appointment can't be inserted twice, even by concurrent requests
+    IDEMPOTENCY_KEY = ("therapist_id", "start_time_unix_seconds", "duration_seconds", "type")
+    __table_args__ = (
+        db.Index("ix_appointments_start_time_unix_seconds_type", "start_time_unix_seconds", "type"),
+        db.Index("ix_appointments_type_start_time_unix_seconds", "type", "start_time_unix_seconds"),
+        db.Index("ix_appointments_therapist_id_duration_seconds", "therapist_id", "duration_seconds"),
+        db.UniqueConstraint(*IDEMPOTENCY_KEY,
+                            name="uq_appointments_therapist_id_start_time_unix_seconds_duration_seconds_type"),
+    )
     appointment_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     start_time_unix_seconds = db.Column(db.Integer)
     duration_seconds = db.Column(db.Integer)
@@ -42,7 +60,7 @@ class Therapist(db.Model):
 class Specialism(db.Model):
     ___tablename__ = "Specialisms"
     specialism_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    specialism_name = db.Column(db.Text, nullable=False)
+    specialism_name = db.Column(db.Text, nullable=False, index=True)
 
     def __repr__(self):
         return f"<Specialism ID {self.specialism_id}>"
@@ -0,0 +1,260 @@
+import io
+import json
+import random
+import re
+import threading
+import time
+
+from flask import current_app, request
+from werkzeug.utils import import_string
+
+
+# Sentry captures exceptions and traces requests. sentry_sdk is only imported once Sentry is switched on (SENTRY_DSN
+# is set) - the SDK and its Flask integration add a noticeable chunk to the app's import time
+# https://docs.sentry.io/platforms/python/guides/flask/
+#
+# Tracing every request means every request pays for its spans and for sending them. TraceSampler decides in two
+# steps which transactions are sent
+#   1. When a request starts (traces_sampler) - only recorded requests pay for their spans. Mutations are always
+#      recorded and SENTRY_TRACES_HEAD_SAMPLE_RATE of other requests are. Requests to SENTRY_TRACES_IGNORED_PATHS
+#      aren't traced and nothing is traced while the spans per second budget is used up
+#   2. When the response is ready (after_request) - the operation is known by now. Requests that errored or took
+#      longer than SENTRY_SLOW_REQUEST_SECONDS are always kept - those which weren't recorded are sent without their
+#      spans. Other recorded requests are kept at the rate configured for their operation name or type (a share of
+#      every request - the head sample rate is taken into account). Kept transactions spend their spans from the
+#      SENTRY_MAX_SPANS_PER_SECOND budget and are dropped when it runs out
+# https://docs.sentry.io/platforms/python/configuration/sampling/#setting-a-sampling-function
+
+
+class SpanBudget(object):
+    """
+    A token bucket holding up to max_per_second spans, refilled continuously
+    """
+
+    def __init__(self, max_per_second):
+        self.max_per_second = max_per_second
+        self._tokens = float(max_per_second)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_per_second, self._tokens + (now - self._updated_at) * self.max_per_second)
+        self._updated_at = now
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self._tokens >= 1
+
+    def spend(self, spans):
+        """
+        :param spans: Integer - spans (including the transaction itself) about to be sent
+        :return: bool - False if the budget can't cover them. Nothing is spent in that case
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens < spans:
+                return False
+            self._tokens -= spans
+            return True
+
+
+# A mutation operation in a GraphQL document - matched in the request body before the app has parsed it
+MUTATION_OPERATION = re.compile(r"(?:^|[\s}])mutation\b")
+
+
+def request_has_mutation(environ, max_body_bytes):
+    """
+    Reads the request body (and puts it back for the app) to look for a mutation operation
+    :param environ: Dict - the request's WSGI environ
+    :param max_body_bytes: Integer - larger bodies aren't read and are treated as containing a mutation. So are bodies
+    without a Content-Length (e.g chunked) - reading one would consume the stream the app reads it from
+    :return: bool - True if the request may run a mutation
+    """
+    if environ.get("REQUEST_METHOD") != "POST":
+        # GraphQLView only runs mutations sent in a POST body
+        return False
+    try:
+        length = int(environ["CONTENT_LENGTH"])
+    except (KeyError, ValueError):
+        return True
+    if length > max_body_bytes:
+        return True
+    if length <= 0:
+        return False
+
+    body = environ["wsgi.input"].read(length)
+    environ["wsgi.input"] = io.BytesIO(body)
+    text = body.decode("utf-8", "replace")
+    try:
+        data = json.loads(text)
+        documents = [params.get("query") or "" for params in (data if isinstance(data, list) else [data])
+                     if isinstance(params, dict)]
+    except ValueError:
+        # an application/graphql body is the document itself
+        documents = [text]
+    return any(isinstance(document, str) and MUTATION_OPERATION.search(document) for document in documents)
+
+
+class TraceSampler(object):
+
+    def __init__(self, default_rate, operation_rates, slow_request_seconds, max_spans_per_second, ignored_paths,
+                 head_rate=1.0, max_body_bytes=65536):
+        """
+        :param default_rate: Number between 0 and 1 - rate for requests whose operation has no rate of its own
+        :param operation_rates: Dict mapping an operation name (e.g "AppointmentsForTherapist") or type ("query" or
+        "mutation") to a rate. Names take precedence over types
+        :param slow_request_seconds: Number - requests taking at least this long are always kept
+        :param max_spans_per_second: Integer - hard cap on the spans sent each second
+        :param ignored_paths: Iterable of request paths which are never traced e.g health checks
+        :param head_rate: Number between 0 and 1 - share of requests without a mutation recorded when they start
+        :param max_body_bytes: Integer - request bodies up to this size are read for mutations when a request starts
+        """
+        self.default_rate = default_rate
+        self.operation_rates = operation_rates
+        self.slow_request_seconds = slow_request_seconds
+        self.budget = SpanBudget(max_per_second=max_spans_per_second)
+        self.ignored_paths = frozenset(ignored_paths)
+        self.head_rate = head_rate
+        self.max_body_bytes = max_body_bytes
+
+    def __call__(self, sampling_context):
+        """
+        Sentry's traces_sampler. Called as each transaction starts
+        :return: 1.0 to record the transaction (the final decision is made by finish_transaction) or 0 to skip it
+        """
+        environ = sampling_context.get("wsgi_environ") or {}
+        if environ.get("PATH_INFO") in self.ignored_paths or not self.budget.available():
+            return 0
+        if random.random() < self.head_rate or request_has_mutation(environ, self.max_body_bytes):
+            return 1.0
+        return 0
+
+    def operation_rate(self, operations):
+        """
+        :param operations: List of (operation type, operation name) tuples - the operations in the request
+        :return: Number - the highest rate of any of the operations
+        """
+        if not operations:
+            return self.default_rate
+        return max(self.operation_rates.get(name, self.operation_rates.get(operation_type, self.default_rate))
+                   for operation_type, name in operations)
+
+    def recorded_rate(self, operations):
+        """
+        :return: Number - the share of recorded requests with these operations to keep. Requests without a mutation
+        were only recorded at head_rate so their operation rate is scaled up to keep it a share of every request
+        """
+        rate = self.operation_rate(operations)
+        if operations and any(operation_type == "mutation" for operation_type, _ in operations):
+            return rate
+        return min(1.0, rate / self.head_rate) if self.head_rate else 1.0
+
+    def sampling_reason(self, operations, failed, seconds):
+        """
+        :return: str - why the transaction is kept, or None if it should be dropped
+        """
+        if failed:
+            return "error"
+        if seconds >= self.slow_request_seconds:
+            return "slow"
+        if random.random() < self.recorded_rate(operations):
+            return "rate"
+        return None
+
+    def finish_unrecorded_transaction(self, transaction, path, failed, seconds):
+        """
+        Keeps a transaction which wasn't recorded when it started if it errored or was slow. It is sent with its name,
+        timing and tags but without spans - none were recorded
+        :return: str - why the transaction is kept, or None if it stays dropped
+        """
+        if path in self.ignored_paths:
+            return None
+        reason = "error" if failed else "slow" if seconds >= self.slow_request_seconds else None
+        if reason is None or not self.budget.spend(1):
+            return None
+
+        transaction.init_span_recorder(maxlen=0)
+        transaction.sampled = True
+        transaction.set_tag("sampling_reason", reason)
+        return reason
+
+    def finish_transaction(self, transaction, operations, failed, seconds):
+        """
+        Makes the final sampling decision for a recorded transaction. Dropped transactions are marked unsampled - Sentry
+        discards them when they finish
+        :return: str - why the transaction is kept, or None if it was dropped
+        """
+        reason = self.sampling_reason(operations, failed, seconds)
+        if reason is not None:
+            span_recorder = getattr(transaction, "_span_recorder", None)
+            spans = 1 + (len(span_recorder.spans) if span_recorder is not None else 0)
+            if not self.budget.spend(spans):
+                reason = None
+
+        if reason is None:
+            transaction.sampled = False
+        else:
+            transaction.set_tag("sampling_reason", reason)
+        return reason
+
+
+def _start_request_timer():
+    request.started_at = time.perf_counter()
+
+
+def _finish_transaction(response):
+    import sentry_sdk
+
+    transaction = sentry_sdk.Hub.current.scope.transaction
+    started_at = getattr(request, "started_at", None)
+    if transaction is None or started_at is None:
+        return response
+
+    sampler = current_app.extensions["trace_sampler"]
+    failed = response.status_code >= 500 or getattr(request, "graphql_errors", False)
+    seconds = time.perf_counter() - started_at
+    if transaction.sampled:
+        sampler.finish_transaction(transaction, getattr(request, "graphql_operations", None), failed, seconds)
+    else:
+        sampler.finish_unrecorded_transaction(transaction, request.path, failed, seconds)
+    return response
+
+
+def init_sentry(app):
+    """
+    :param app: Flask app - Sentry is configured from its config
+    :return: bool - True if Sentry was switched on
+    """
+    dsn = app.config["SENTRY_DSN"]
+    if not dsn:
+        return False
+
+    import sentry_sdk
+    from sentry_sdk.integrations.flask import FlaskIntegration
+
+    sampler = TraceSampler(
+        default_rate=app.config["SENTRY_TRACES_SAMPLE_RATE"],
+        operation_rates=app.config["SENTRY_TRACES_SAMPLE_RATES"],
+        slow_request_seconds=app.config["SENTRY_SLOW_REQUEST_SECONDS"],
+        max_spans_per_second=app.config["SENTRY_MAX_SPANS_PER_SECOND"],
+        ignored_paths=app.config["SENTRY_TRACES_IGNORED_PATHS"],
+        head_rate=app.config["SENTRY_TRACES_HEAD_SAMPLE_RATE"],
+    )
+    app.extensions["trace_sampler"] = sampler
+    app.before_request(_start_request_timer)
+    app.after_request(_finish_transaction)
+
+    options = {}
+    if app.config["SENTRY_TRANSPORT"]:
+        # e.g API.monitoring_transport.RecordingTransport - keeps events in memory rather than sending them
+        options["transport"] = import_string(app.config["SENTRY_TRANSPORT"])
+
+    sentry_sdk.init(
+        dsn=dsn,
+        integrations=[FlaskIntegration()],
+        traces_sampler=sampler,
+        **options
+    )
+    return True
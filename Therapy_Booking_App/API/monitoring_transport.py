@@ -0,0 +1,34 @@
+import logging
+from collections import deque
+
+from sentry_sdk.transport import Transport
+
+logger = logging.getLogger(__name__)
+
+
+class RecordingTransport(Transport):
+    """
+    A Sentry transport which keeps the last events and transactions in memory instead of sending them. Used by the
+    tests (and locally) to see what Sentry would have been sent. Enable with
+    SENTRY_TRANSPORT=API.monitoring_transport.RecordingTransport
+    """
+    max_size = 1000
+
+    def __init__(self, options=None):
+        super().__init__(options)
+        self.events = deque(maxlen=self.max_size)
+        self.transactions = deque(maxlen=self.max_size)
+
+    def capture_event(self, event):
+        self.events.append(event)
+        logger.debug({"message": "Sentry Event Recorded", "event_id": event.get("event_id")})
+
+    def capture_envelope(self, envelope):
+        transaction = envelope.get_transaction_event()
+        if transaction is not None:
+            self.transactions.append(transaction)
+            logger.debug({"message": "Sentry Transaction Recorded", "transaction": transaction.get("transaction"),
+                          "spans": len(transaction.get("spans", ()))})
+        event = envelope.get_event()
+        if event is not None:
+            self.events.append(event)
@@ -0,0 +1,214 @@
+import base64
+import binascii
+import json
+
+import graphene
+from flask import current_app
+from graphene.relay.connection import PageInfo
+from graphene_sqlalchemy_filter import FilterableConnectionField
+from graphql import GraphQLError
+from sqlalchemy import and_, or_, false, func, tuple_, inspect
+from sqlalchemy.sql import operators
+
+
+# graphene's relay connections paginate by offset. Every page reads and throws away all rows before it and a client that
+# omits "first" receives the entire table. KeysetConnectionField instead encodes the sort key of the last row returned
+# into the cursor and seeks past it i.e. WHERE (start_time, id) > (?, ?) ORDER BY start_time, id LIMIT n
+# https://use-the-index-luke.com/no-offset
+#
+# CountableConnection adds totalCount to a connection. It is only counted when selected - with a single
+# SELECT count(*) over the filtered query, without its ORDER BY, keyset predicate or LIMIT
+
+
+def encode_cursor(values):
+    """
+    :param values: List - the sort key values of a row. The primary key is always the final value
+    :return: str - an opaque cursor
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf8")).decode("utf8")
+
+
+def decode_cursor(cursor, number_of_keys):
+    """
+    :param cursor: str - a cursor previously returned by encode_cursor
+    :param number_of_keys: Integer - the number of sort keys the cursor must contain for the current sort order
+    :return: List - the sort key values encoded in the cursor
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("utf8")).decode("utf8"))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        values = None
+
+    if not isinstance(values, list) or len(values) != number_of_keys:
+        raise GraphQLError({"code": "invalid_cursor",
+                            "description": "Cursor is not valid for the requested sort order"}, 400)
+    return values
+
+
+def keyset_predicate(keys, values):
+    """
+    Builds a WHERE clause matching every row that sorts after the row the values were taken from
+    :param keys: List of (column, ascending) tuples - the sort keys in order of precedence
+    :param values: List - the cursor values for each key
+    :return: A SQLAlchemy boolean clause
+    """
+    ascending = {is_ascending for _, is_ascending in keys}
+    nullable = any(getattr(column, "nullable", True) for column, _ in keys)
+    if len(ascending) == 1 and None not in values and (ascending == {True} or not nullable):
+        # A row value comparison lets SQLite seek straight to the cursor using a matching index. SQLite sorts NULLs
+        # last when descending, yet a comparison with NULL is never true - so rows holding NULLs would be skipped
+        columns = tuple_(*(column for column, _ in keys))
+        return columns > tuple_(*values) if ascending.pop() else columns < tuple_(*values)
+
+    # Mixed directions, NULL cursor values or descending nullable keys (NULLs sort first ascending, last
+    # descending) need the expanded form
+    # a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+    clauses = []
+    equal_so_far = []
+    for (column, is_ascending), value in zip(keys, values):
+        if value is None:
+            after = column.isnot(None) if is_ascending else false()
+            equal = column.is_(None)
+        else:
+            after = column > value if is_ascending else or_(column < value, column.is_(None))
+            equal = column == value
+        clauses.append(and_(*equal_so_far, after))
+        equal_so_far.append(equal)
+
+    return or_(*clauses)
+
+
+class CountableConnection(graphene.relay.Connection):
+    """
+    A relay Connection with a totalCount field - the number of rows matching the filters across every page
+    """
+
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int()
+
+    @staticmethod
+    def resolve_total_count(parent, info):
+        """
+        :param parent: The connection being resolved
+        :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+        :return: Integer - the number of rows matching the filters
+        """
+        count_total = getattr(parent, "count_total", None)
+        if count_total is None:
+            # connections graphene-sqlalchemy builds from a list (e.g therapist { appointments }) hold every row
+            return parent.length
+        return count_total()
+
+
+class KeysetConnectionField(FilterableConnectionField):
+    """
+    A FilterableConnectionField which paginates with keyset (cursor) pagination rather than offsets
+
+    Page sizes default to Config.DEFAULT_PAGE_SIZE and requests for more than Config.MAX_PAGE_SIZE rows are rejected
+    """
+
+    @classmethod
+    def get_sort_keys(cls, model, sort):
+        """
+        :param model: The SQLAlchemy model being paginated
+        :param sort: List of sort enum values (or None) passed to the field
+        :return: List of (column, ascending) tuples. The primary key is appended as a tie breaker
+        """
+        if sort is None:
+            sort = []
+        elif not isinstance(sort, (list, tuple)):
+            sort = [sort]
+
+        keys = []
+        for sort_value in sort:
+            expression = sort_value.value
+            keys.append((expression.element, expression.modifier is not operators.desc_op))
+
+        primary_key = inspect(model).primary_key[0]
+        if not any(column is primary_key for column, _ in keys):
+            keys.append((primary_key, True))
+
+        return keys
+
+    @classmethod
+    def get_page_size(cls, first, last):
+        default_page_size = current_app.config["DEFAULT_PAGE_SIZE"]
+        max_page_size = current_app.config["MAX_PAGE_SIZE"]
+
+        for argument, value in (("first", first), ("last", last)):
+            if value is not None and not 0 <= value <= max_page_size:
+                raise GraphQLError({"code": "invalid_page_size",
+                                    "description": f"'{argument}' must be between 0 and {max_page_size}"}, 400)
+
+        if first is None and last is None:
+            return default_page_size
+        return first if first is not None else last
+
+    @classmethod
+    def total_count(cls, info, args, resolved):
+        """
+        :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+        :param args: The arguments passed to the field (filters, sort, first, last, after, before)
+        :param resolved: The filtered query returned by the field's resolver
+        :return: Integer - the number of rows the query matches, ignoring sorting and pagination
+        """
+        return resolved.order_by(None).with_entities(func.count()).scalar()
+
+    @classmethod
+    def resolve_connection(cls, connection_type, model, info, args, resolved):
+        if resolved is None:
+            resolved = cls.get_query(model, info, **dict(args, sort=None))
+
+        first, last = args.get("first"), args.get("last")
+        after, before = args.get("after"), args.get("before")
+        page_size = cls.get_page_size(first, last)
+
+        keys = cls.get_sort_keys(model, args.get("sort"))
+        # When paginating backwards we walk the sort order in reverse and flip the rows back afterwards
+        backwards = last is not None and first is None
+        if backwards:
+            keys = [(column, not is_ascending) for column, is_ascending in keys]
+
+        query = resolved.order_by(None).order_by(
+            *(column.asc() if is_ascending else column.desc() for column, is_ascending in keys))
+
+        reverse_keys = [(column, not is_ascending) for column, is_ascending in keys]
+        if after is not None:
+            query = query.filter(keyset_predicate(reverse_keys if backwards else keys,
+                                                  decode_cursor(after, len(keys))))
+        if before is not None:
+            query = query.filter(keyset_predicate(keys if backwards else reverse_keys,
+                                                  decode_cursor(before, len(keys))))
+
+        # Fetching one extra row tells us whether another page exists without a separate count query
+        rows = query.limit(page_size + 1).all()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+
+        if first is not None and last is not None:
+            rows = rows[-last:] if last else []
+        if backwards:
+            rows.reverse()
+
+        mapper = inspect(model)
+        attribute_names = [mapper.get_property_by_column(column).key for column, _ in keys]
+
+        edges = [connection_type.Edge(node=row,
+                                      cursor=encode_cursor([getattr(row, name) for name in attribute_names]))
+                 for row in rows]
+
+        page_info = PageInfo(
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+            has_previous_page=has_more if backwards else after is not None,
+            has_next_page=before is not None if backwards else has_more,
+        )
+
+        connection = connection_type(edges=edges, page_info=page_info)
+        connection.iterable = rows
+        connection.length = len(rows)
+        # only called if totalCount is selected
+        connection.count_total = lambda: cls.total_count(info, args, resolved)
+        return connection
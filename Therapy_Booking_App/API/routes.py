@@ -1,18 +1,273 @@
-from flask import Blueprint
+import hmac
+import logging
+import time
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context
 from flask_graphql import GraphQLView
+from graphql import GraphQLError
+from graphql.utils.get_operation_ast import get_operation_ast
+from graphql_server import HttpQueryError, default_format_error, json_encode
 
 from API.schema import schema
+from API.backend import RequestDocumentBackend, document_backend
+from API.appointments.export import EXPORT_FORMATS, export_chunks, export_query, parse_filters
+from API.appointments.feed import get_change_feed, stream_events
+from API.authentication.decorators import header_must_have_jwt
+from API.database import (configured_max_overflow, database_engines, database_route, probe_engine, read_engine_enabled,
+                          READ, WRITE)
+from API.metrics import RequestMetrics, metrics_middleware, record_phase
+
+logger = logging.getLogger(__name__)
 
 bp = Blueprint('main', __name__)
 
 # flask_graphql is a helper library using GraphQL-Server which itself uses GraphQL-core the python implementation of GraphQL
 # It handles the parsing of SDL sent to our API passes it to our graphene schema object for querying and returns the results
 
+
+
+class RoutedGraphQLView(GraphQLView):
+    """
+    Runs requests made up of query operations against the read engine and everything else against the writer engine
+    (see API/database.py). The request's operations and whether it returned errors are recorded on the request for
+    the trace sampler (see API/monitoring.py). Requests are measured for /metrics (see API/metrics.py)
+
+    A request body may be a JSON array of operations (batch=True). They are executed in order with the request as
+    their context, so they share the database session, the verified access token and the DataLoaders, and the
+    response is an array of results in the same order. Batches over MAX_BATCH_OPERATIONS are rejected
+    """
+
+    def dispatch_request(self):
+        registry = current_app.extensions.get("metrics")
+        if registry is None:
+            return self.dispatch_routed_request()
+
+        request.metrics = RequestMetrics()
+        response = None
+        try:
+            response = self.dispatch_routed_request()
+            return response
+        finally:
+            failed = response is None or response.status_code >= 400 or getattr(request, "graphql_errors", False)
+            registry.record_request(request.metrics, failed)
+
+    def dispatch_routed_request(self):
+        routed = read_engine_enabled()
+        if routed or "trace_sampler" in current_app.extensions:
+            request.graphql_operations = self.operations()
+        if not routed:
+            return super().dispatch_request()
+        with database_route(self.database_route(request.graphql_operations)):
+            return super().dispatch_request()
+
+    def parse_body(self):
+        # parsed once per request - operations() reads the body before GraphQLView executes it
+        body = getattr(request, "graphql_body", None)
+        if body is None:
+            body = request.graphql_body = super().parse_body()
+
+        max_operations = current_app.config["MAX_BATCH_OPERATIONS"]
+        if isinstance(body, list) and len(body) > max_operations:
+            raise HttpQueryError(400, str({"code": "batch_too_large", "description":
+                                           f"A batch can contain at most {max_operations} operations"}))
+        return body
+
+    def operations(self):
+        """
+        :return: List of (operation type, operation name) tuples - one per operation the request runs. None if the
+        request can't be parsed or doesn't say which of its operations to run
+        """
+        try:
+            data = self.parse_body()
+            operations = []
+            for params in (data if isinstance(data, list) else [data]):
+                query = params.get("query") or request.args.get("query")
+                operation_name = params.get("operationName") or request.args.get("operationName")
+                document = self.get_backend().document_from_string(self.schema, query)
+                operation = get_operation_ast(document.document_ast, operation_name)
+                operations.append((operation.operation, operation.name.value if operation.name else None))
+            return operations
+        except Exception:
+            return None
+
+    @staticmethod
+    def database_route(operations):
+        """
+        :return: READ if every operation in the request is a query. Requests which can't be parsed go to WRITE - they
+        fail before touching the database
+        """
+        if operations and all(operation_type == "query" for operation_type, _ in operations):
+            return READ
+        return WRITE
+
+    def format_error(self, error):
+        request.graphql_errors = True
+        return default_format_error(error)
+
+    def encode(self, data, pretty=False):
+        started = time.perf_counter()
+        try:
+            return json_encode(data, pretty=pretty)
+        finally:
+            record_phase("encode", time.perf_counter() - started)
+
+    def get_backend(self):
+        # one per request so operations() and the execution share the documents parsed for it
+        backend = getattr(request, "graphql_backend", None)
+        if backend is None:
+            backend = request.graphql_backend = RequestDocumentBackend(super().get_backend())
+        return backend
+
+    def get_middleware(self):
+        if "metrics" in current_app.extensions:
+            return metrics_middleware
+        return self.middleware
+
+
 bp.add_url_rule(
     '/graphql',
-    view_func=GraphQLView.as_view(
+    view_func=RoutedGraphQLView.as_view(
         'graphql',
         schema=schema,
         graphiql=True,
+        # caches parsed + validated documents so repeat queries skip straight to execution
+        backend=document_backend,
+        batch=True,
     )
 )
+
+
+@bp.route('/graphql/document-cache')
+def document_cache_stats():
+    """
+    Hit/miss counters for this worker's parsed + validated document cache
+    Requires the same Authorization header as /graphql
+    """
+    try:
+        header_must_have_jwt(lambda: None)()
+    except GraphQLError as e:
+        return jsonify(e.message), 401
+    return jsonify(document_backend.stats())
+
+
+@bp.route('/metrics')
+def metrics():
+    """
+    Resolver, SQL and per operation metrics in Prometheus' text format. Includes every worker's metrics when
+    METRICS_MULTIPROCESS_DIR is set
+    Requires the same Authorization header as /graphql, or METRICS_TOKEN as a bearer token - JWTs expire so scrapers
+    are given a static credential
+    """
+    registry = current_app.extensions.get("metrics")
+    if registry is None:
+        abort(404)
+
+    token = current_app.config["METRICS_TOKEN"]
+    if not (token and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}")):
+        try:
+            header_must_have_jwt(lambda: None)()
+        except GraphQLError as e:
+            return jsonify(e.message), 401
+    return Response(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@bp.route('/export/appointments')
+def export_appointments():
+    """
+    Streams every appointment matching the filters as NDJSON (the default) or CSV (see API/appointments/export.py)
+    Query string - filters: JSON in the shape of the appointments filters argument. format: ndjson or csv
+    Requires the same Authorization header as /graphql
+    """
+    try:
+        header_must_have_jwt(lambda: None)()
+    except GraphQLError as e:
+        return jsonify(e.message), 401
+
+    export_format = request.args.get("format") or "ndjson"
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"code": "invalid_format",
+                        "description": f"format must be one of {', '.join(sorted(EXPORT_FORMATS))}"}), 400
+    try:
+        filters = parse_filters(schema.get_type("AppointmentsFilter"), request.args.get("filters"))
+    except ValueError as e:
+        return jsonify({"code": "invalid_filters", "description": str(e)}), 400
+
+    def generate():
+        # an export only reads so it runs on the read engine when there is one
+        with database_route(READ):
+            yield from export_chunks(export_format, export_query(request, filters),
+                                     current_app.config["EXPORT_BATCH_SIZE"])
+
+    return Response(stream_with_context(generate()), content_type=EXPORT_FORMATS[export_format],
+                    headers={"Content-Disposition": f"attachment; filename=appointments.{export_format}"})
+
+
+@bp.route('/events/appointments')
+def appointment_events():
+    """
+    A Server-Sent Events stream of the appointments created from now on (see API/appointments/feed.py)
+    Query string - therapist_id, type and specialism, each may be repeated. An event is sent if it matches every one
+    of the filters given (and any of the values given for it)
+    Last-Event-ID header - the events since this id are sent first (only with CHANGE_FEED_BUS_PATH set)
+    Requires the same Authorization header as /graphql
+    """
+    try:
+        header_must_have_jwt(lambda: None)()
+    except GraphQLError as e:
+        return jsonify(e.message), 401
+
+    try:
+        therapist_ids = {int(therapist_id) for therapist_id in request.args.getlist("therapist_id")}
+    except ValueError:
+        return jsonify({"code": "invalid_filters", "description": "therapist_id must be an integer"}), 400
+    types = set(request.args.getlist("type"))
+    specialisms = set(request.args.getlist("specialism"))
+
+    try:
+        last_event_id = int(request.headers["Last-Event-ID"]) if request.headers.get("Last-Event-ID") else None
+    except ValueError:
+        return jsonify({"code": "invalid_last_event_id", "description": "Last-Event-ID must be an integer"}), 400
+
+    hub = get_change_feed()
+    subscription = hub.subscribe(therapist_ids or None, types or None, specialisms or None)
+    if subscription is None:
+        return jsonify({"code": "too_many_subscribers",
+                        "description": "This worker can't take another stream - retry shortly"}), 503
+    # read after subscribing so nothing published in between is missed
+    replay = hub.replay(subscription, last_event_id) if last_event_id is not None else []
+
+    # the stream doesn't touch the database so it isn't run within the request's context
+    response = Response(stream_events(subscription, current_app.config["CHANGE_FEED_KEEPALIVE_SECONDS"], replay),
+                        content_type="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    # also called when the client disconnects
+    response.call_on_close(lambda: hub.unsubscribe(subscription))
+    return response
+
+
+@bp.route('/healthz')
+def healthz():
+    """
+    Liveness - the worker is up and serving requests. Doesn't touch the database
+    """
+    return jsonify({"status": "ok"})
+
+
+@bp.route('/readyz')
+def readyz():
+    """
+    Readiness - every database can run a query. Responds 503 otherwise so a load balancer stops sending traffic to this
+    worker. A pool whose connections are all serving requests is busy, not broken - it is reported as "busy" and the
+    worker stays ready
+    """
+    ready, databases = True, {}
+    for route, engine in database_engines(current_app).items():
+        try:
+            status = probe_engine(engine, configured_max_overflow(current_app, route))
+            databases[route] = {"status": status, "pool": engine.pool.status()}
+        except Exception as e:
+            logger.exception({"message": "Readiness Check Failed", "database": route})
+            ready = False
+            databases[route] = {"status": "unavailable", "error": type(e).__name__}
+
+    return jsonify({"status": "ok" if ready else "unavailable", "databases": databases}), 200 if ready else 503
@@ -2,14 +2,17 @@ import logging
 
 import graphene
 
-from graphene_sqlalchemy_filter import FilterableConnectionField
-
 from API.models import Appointment as AppointmentModel
+from API.selection import selected_paths, submitted_document
+from API.structured_logging import LazyPayload
 
 from API.authentication import AuthMutation, RefreshMutation, header_must_have_jwt
-from API.appointments.schema import AppointmentsSchema
+from API.appointments.schema import AppointmentsSchema, FreeSlotSchema
+from API.appointments.availability import free_slots
+from API.appointments.cache import CachedAppointmentsConnectionField
 from API.appointments.filters import AppointmentsFilter
-from API.appointments.mutations import AppointmentMutation
+from API.appointments.mutations import AppointmentMutation, CreateAppointmentsMutation
+from API.appointments.projection import appointment_load_options
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +27,7 @@ class Mutation(graphene.ObjectType):
     auth = AuthMutation.Field()
     refresh = RefreshMutation.Field()
     appointment = AppointmentMutation.Field()
+    create_appointments = CreateAppointmentsMutation.Field()
 
 
 class Query(graphene.ObjectType):
@@ -35,8 +39,10 @@ class Query(graphene.ObjectType):
         The resolver method name should match the field name
     '''
     node = graphene.relay.Node.Field()
-    appointments = FilterableConnectionField(connection=AppointmentsSchema, filters=AppointmentsFilter(),
-                                             sort=AppointmentsSchema.sort_argument())
+    # sorting and pagination (first/last/after/before) are applied to the query we return by KeysetConnectionField
+    # repeat requests are then served from AppointmentsCache
+    appointments = CachedAppointmentsConnectionField(connection=AppointmentsSchema, filters=AppointmentsFilter(),
+                                                     sort=AppointmentsSchema.sort_argument())
 
     @staticmethod
     @header_must_have_jwt
@@ -49,13 +55,42 @@ class Query(graphene.ObjectType):
         :return: An object representing one or more appointments
         """
 
-        query = AppointmentModel.query
-        logger.debug({"message": "Resolving Appointment Query", "query_submitted": info.context.json["query"]})
+        # only the columns (and relationships) the client selected are loaded
+        query = AppointmentModel.query.options(*appointment_load_options(selected_paths(info), sort))
+        logger.debug(LazyPayload(lambda: {"message": "Resolving Appointment Query",
+                                          "query_submitted": submitted_document(info)}))
         if filters is not None:
             query = AppointmentsFilter.filter(info, query, filters)
 
         return query
 
+    free_slots = graphene.List(FreeSlotSchema, therapist_ids=graphene.List(graphene.NonNull(graphene.Int)),
+                               specialisms=graphene.List(graphene.NonNull(graphene.String)),
+                               range_start=graphene.Int(required=True), range_end=graphene.Int(required=True),
+                               min_duration_seconds=graphene.Int(default_value=0))
+
+    @staticmethod
+    @header_must_have_jwt
+    def resolve_free_slots(parent, info, range_start, range_end, min_duration_seconds=0, therapist_ids=None,
+                           specialisms=None):
+        """
+        Finds the gaps between appointments for every therapist matching the filters
+        :param parent: The value object returned from the resolver of the parent field
+        :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+        :param range_start: Integer - unix seconds. Start of the window to search
+        :param range_end: Integer - unix seconds. End of the window to search
+        :param min_duration_seconds: Integer - shorter gaps are not returned
+        :param therapist_ids: List of Integers - only search these therapists
+        :param specialisms: List of Str - only search therapists holding any of these specialisms
+        :return: List of FreeSlotSchema ordered by therapist then start time
+        """
+        logger.debug(LazyPayload(lambda: {"message": "Resolving Free Slots Query",
+                                          "query_submitted": submitted_document(info)}))
+        return [FreeSlotSchema(therapist_id=therapist_id, start_time_unix_seconds=start, end_time_unix_seconds=end,
+                               duration_seconds=end - start)
+                for therapist_id, start, end in free_slots(therapist_ids, specialisms, range_start, range_end,
+                                                           min_duration_seconds)]
+
 
 # constructs the complete Graphql Schema
 schema = graphene.Schema(query=Query, types=[AppointmentsSchema], mutation=Mutation)
@@ -0,0 +1,58 @@
+from graphql.language.ast import Field, FragmentSpread, InlineFragment
+from graphql.language.printer import print_ast
+
+
+# Helpers for inspecting what a client has asked for. info.field_asts holds the parsed selection set of the field
+# currently being resolved
+
+
+def selected_paths(info):
+    """
+    Returns every field selected beneath the field currently being resolved e.g for
+    appointments { edges { node { therapists { firstName } } } } -> {"edges", "edges.node", "edges.node.therapists",
+    "edges.node.therapists.firstName"}
+    :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+    :return: Set of dotted field names (as written in the query i.e camelCase)
+    """
+    paths = set()
+    for field_ast in info.field_asts:
+        _collect_paths(field_ast.selection_set, info.fragments, "", paths)
+    return paths
+
+
+def _collect_paths(selection_set, fragments, prefix, paths):
+    if selection_set is None:
+        return
+
+    for selection in selection_set.selections:
+        if isinstance(selection, Field):
+            path = prefix + selection.name.value
+            paths.add(path)
+            _collect_paths(selection.selection_set, fragments, path + ".", paths)
+        elif isinstance(selection, FragmentSpread):
+            fragment = fragments.get(selection.name.value)
+            if fragment is not None:
+                _collect_paths(fragment.selection_set, fragments, prefix, paths)
+        elif isinstance(selection, InlineFragment):
+            _collect_paths(selection.selection_set, fragments, prefix, paths)
+
+
+def selection_signature(info):
+    """
+    :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+    :return: str - the printed selection set of the current field along with any fragments it may reference
+    """
+    printed = [print_ast(field_ast.selection_set) for field_ast in info.field_asts if field_ast.selection_set]
+    printed.extend(print_ast(info.fragments[name]) for name in sorted(info.fragments))
+    return "\n".join(printed)
+
+
+def submitted_document(info):
+    """
+    :param info: The GraphQL execution info. Meta info about the current GraphQL Query. Per Request Context Variable
+    :return: str - the document the operation being executed was sent in. A batched request sends one per operation
+    """
+    location = info.operation.loc
+    if location is not None and location.source is not None:
+        return location.source.body
+    return print_ast(info.operation)
@@ -0,0 +1,246 @@
+import atexit
+import copy
+import datetime
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+
+# logging.basicConfig gives the root logger a StreamHandler - the request thread formats every record and writes it to
+# the console itself, waiting on the write. LogPipeline instead puts records on a bounded queue and a QueueListener
+# thread formats them as JSON (one object per line) and does the writing. A full queue drops records (they are
+# counted) rather than block the request.
+#   * Request threads only do what has to happen on them - building payloads and str() of ORM objects, which may need
+#     the request's session
+#   * logger.debug(LazyPayload(lambda: {...})) defers building the payload until a handler accepts the record - it
+#     never runs when the logger's level is disabled or the record isn't sampled
+#   * DEBUG records are sampled at LOG_DEBUG_SAMPLE_RATE (or the rate for their logger in LOG_DEBUG_SAMPLE_RATES).
+#     Kept records carry their sample_rate
+#   * LOG_LEVEL sets the root logger's level and LOG_LEVELS the level of individual loggers
+# https://docs.python.org/3/howto/logging-cookbook.html#dealing-with-handlers-that-block
+
+PRIMITIVE_TYPES = (str, int, float, bool, type(None))
+
+
+class LazyPayload(object):
+    """
+    A log message built on demand e.g logger.debug(LazyPayload(lambda: {"message": "...", "query": query}))
+    """
+
+    __slots__ = ("builder", "_payload")
+
+    def __init__(self, builder):
+        """
+        :param builder: Callable returning the payload - a Dict (or str)
+        """
+        self.builder = builder
+        self._payload = None
+
+    def resolve(self):
+        if self._payload is None:
+            self._payload = self.builder()
+        return self._payload
+
+    def __str__(self):
+        return str(self.resolve())
+
+
+def json_safe(value):
+    """
+    :return: value with anything JSON can't hold (e.g ORM objects) replaced by its str()
+    """
+    if isinstance(value, PRIMITIVE_TYPES):
+        return value
+    if isinstance(value, dict):
+        return {str(key): json_safe(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [json_safe(item) for item in value]
+    return str(value)
+
+
+class DebugSampler(logging.Filter):
+    """
+    Keeps a random sample of DEBUG records. Records at INFO and above are always kept
+    """
+
+    def __init__(self, default_rate=1.0, logger_rates=None):
+        """
+        :param default_rate: Number between 0 and 1 - rate for loggers with no rate of their own
+        :param logger_rates: Dict mapping a logger name (e.g "API.schema") to a rate. Applies to its child loggers too
+        """
+        super().__init__()
+        self.default_rate = default_rate
+        self.logger_rates = logger_rates or {}
+
+    def rate(self, logger_name):
+        name = logger_name
+        while name:
+            if name in self.logger_rates:
+                return self.logger_rates[name]
+            name = name.rpartition(".")[0]
+        return self.default_rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1:
+            return True
+        if random.random() < rate:
+            record.sample_rate = rate
+            return True
+        return False
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records prepared by NonBlockingQueueHandler as a single line of JSON
+    """
+
+    def format(self, record):
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry["message"] = record.getMessage()
+        if getattr(record, "sample_rate", None) is not None:
+            entry["sample_rate"] = record.sample_rate
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue without waiting. Records which don't fit are dropped and counted
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exception_formatter = logging.Formatter()
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        """
+        Runs on the request thread. Builds the payload - lazy payloads and str() of ORM objects must be resolved while
+        the request (and its session) is still around - and leaves the JSON encoding to the listener thread
+        """
+        message = record.msg
+        if isinstance(message, LazyPayload):
+            message = message.resolve()
+        if isinstance(message, dict) and not record.args:
+            payload = json_safe(message)
+        else:
+            payload = {"message": record.getMessage() if not isinstance(message, dict) else str(message)}
+
+        record = copy.copy(record)
+        record.msg = payload
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+
+class LogPipeline(object):
+
+    def __init__(self, level="INFO", levels=None, debug_sample_rate=1.0, debug_sample_rates=None, queue_size=10000,
+                 stream=None):
+        """
+        :param level: str - level of the root logger e.g "INFO"
+        :param levels: Dict mapping logger names to levels e.g {"API.schema": "DEBUG", "sqlalchemy.engine": "WARNING"}
+        :param debug_sample_rate: Number between 0 and 1 - share of DEBUG records kept
+        :param debug_sample_rates: Dict mapping logger names to the share of their DEBUG records kept
+        :param queue_size: Integer - records waiting to be written. More are dropped
+        :param stream: File like object records are written to. Defaults to stderr
+        """
+        self.level = level
+        self.levels = levels or {}
+        self.queue_size = queue_size
+        self.stream = stream
+        self.sampler = DebugSampler(debug_sample_rate, debug_sample_rates)
+        self.handler = None
+        self.listener = None
+
+    def start(self):
+        """
+        Sets the configured levels and sends every record logged from now on through the queue
+        """
+        root = logging.getLogger()
+        root.setLevel(self.level)
+        for name, level in self.levels.items():
+            logging.getLogger(name).setLevel(level)
+
+        self.handler = NonBlockingQueueHandler(queue.Queue(self.queue_size))
+        self.handler.addFilter(self.sampler)
+        root.addHandler(self.handler)
+        self._start_listener()
+        return self
+
+    def _start_listener(self):
+        output = logging.StreamHandler(self.stream or sys.stderr)
+        output.setFormatter(JsonFormatter())
+        self.listener = QueueListener(self.handler.queue, output, respect_handler_level=False)
+        self.listener.start()
+
+    def restart(self):
+        """
+        Starts a new listener thread. Called in each worker after a fork - threads aren't copied into the child, so the
+        listener started by the master isn't running there
+        """
+        if self.handler is None:
+            return
+        self.handler.queue = queue.Queue(self.queue_size)
+        self._start_listener()
+
+    def stop(self):
+        """
+        Writes every queued record then removes the handler from the root logger
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        if self.handler is not None:
+            logging.getLogger().removeHandler(self.handler)
+
+
+def init_logging(app, stream=None):
+    """
+    Replaces console logging with a LogPipeline configured from the app's config. It is stored as
+    app.extensions["log_pipeline"]
+    :param app: Flask app
+    :param stream: File like object records are written to. Defaults to stderr
+    :return: LogPipeline
+    """
+    pipeline = LogPipeline(
+        level=app.config["LOG_LEVEL"],
+        levels=app.config["LOG_LEVELS"],
+        debug_sample_rate=app.config["LOG_DEBUG_SAMPLE_RATE"],
+        debug_sample_rates=app.config["LOG_DEBUG_SAMPLE_RATES"],
+        queue_size=app.config["LOG_QUEUE_SIZE"],
+        stream=stream,
+    ).start()
+    app.extensions["log_pipeline"] = pipeline
+    # records still queued when the process exits are written out first
+    atexit.register(pipeline.stop)
+    return pipeline
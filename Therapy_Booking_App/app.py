@@ -1,25 +1,16 @@
-import sentry_sdk
-
-from sentry_sdk.integrations.flask import FlaskIntegration
+import os
 
 import API
-import logging
-
-import mock_data_generation
 
-sentry_sdk.init(
-    dsn="https://14705234ea144f8ca9c07f5b60e96d4b@o1144439.ingest.sentry.io/6208485",
-    integrations=[FlaskIntegration()],
+from API.monitoring import init_sentry
+from API.structured_logging import init_logging
 
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    # We recommend adjusting this value in production.
-    traces_sample_rate=1.0
-)
 
-
-app = API.create_app(config_class=API.Config)
-logging.basicConfig(level=logging.DEBUG)
+# API_CONFIG=production switches on the WAL + connection pool database profile
+config_class = API.ProductionConfig if os.environ.get('API_CONFIG') == 'production' else API.Config
+app = API.create_app(config_class=config_class)
+init_logging(app)
+init_sentry(app)
 
 
 
@@ -27,6 +18,9 @@ logging.basicConfig(level=logging.DEBUG)
 if __name__ == "__main__":
 
     if app.config["GENERATE_MOCK_DATA"] is True:
-        mock_data_generation.generate_fake_data_for_development_db(API.db)
+        # only needed by the development server
+        import mock_data_generation
+
+        mock_data_generation.generate_fake_data_for_development_db()
 
     app.run(host='0.0.0.0',port=80)
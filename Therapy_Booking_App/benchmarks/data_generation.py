@@ -0,0 +1,178 @@
+import random
+
+
+# mock_data_generation creates a dozen rows one ORM object at a time - enough for the tests but far too few to say
+# anything about performance. generate_benchmark_data bulk loads a deterministic data set of any size (10^4 to 10^7
+# appointments) with a realistic shape: a handful of popular specialisms, a long tail of busy and quiet therapists and
+# appointments spread over a year. The same seed + scale always produces exactly the same rows so runs can be compared
+
+# 1640995200 = Sat Jan 1st 2022 - 00:00:00
+START_TIME_UNIX_SECONDS = 1640995200
+SLOT_SECONDS = 1800
+SLOTS_PER_YEAR = 365 * 24 * 3600 // SLOT_SECONDS
+
+# Ordered by popularity. Weights follow Zipf's law i.e the second specialism is held by half as many therapists as
+# the first
+SPECIALISM_NAMES = ("CBT", "Anxiety", "Depression", "ADHD", "Addiction", "Relationships", "Trauma", "Divorce",
+                    "Grief", "Sexuality", "OCD", "Eating Disorders")
+APPOINTMENT_TYPES = (("one-off", 0.7), ("consultation", 0.3))
+DURATIONS_SECONDS = ((3600, 0.7), (1800, 0.2), (5400, 0.1))
+FIRST_NAMES = ("jeff", "jane", "charlie", "dennis", "mac", "dee", "frank", "bill", "doyle", "luther", "rickety",
+               "artemis")
+LAST_NAMES = ("smith", "kelly", "reynolds", "mcdonald", "ponderosa", "mcpoyle", "vandross", "cricket")
+
+# Mean number of appointments per therapist. A scale of 10^6 appointments has 5000 therapists
+APPOINTMENTS_PER_THERAPIST = 200
+
+
+def number_of_therapists(appointments):
+    return max(10, appointments // APPOINTMENTS_PER_THERAPIST)
+
+
+def generate_specialism_rows():
+    return [{"specialism_id": specialism_id, "specialism_name": name}
+            for specialism_id, name in enumerate(SPECIALISM_NAMES, start=1)]
+
+
+def generate_therapist_rows(rng, therapists):
+    """
+    :param rng: random.Random
+    :param therapists: Integer - number of therapists to generate
+    :return: Tuple of (therapist rows, therapist specialism rows)
+    """
+    specialism_weights = [1 / rank for rank in range(1, len(SPECIALISM_NAMES) + 1)]
+
+    therapist_rows, therapist_specialism_rows = [], []
+    for therapist_id in range(1, therapists + 1):
+        therapist_rows.append({"therapist_id": therapist_id, "first_name": rng.choice(FIRST_NAMES),
+                               "last_name": rng.choice(LAST_NAMES)})
+        # Most therapists hold 1-3 specialisms
+        specialism_ids = set()
+        for _ in range(rng.choice((1, 1, 2, 2, 2, 3, 3, 4))):
+            specialism_ids.add(rng.choices(range(1, len(SPECIALISM_NAMES) + 1), weights=specialism_weights)[0])
+        therapist_specialism_rows.extend({"therapist_id": therapist_id, "specialism_id": specialism_id}
+                                         for specialism_id in sorted(specialism_ids))
+    return therapist_rows, therapist_specialism_rows
+
+
+def generate_appointment_rows(rng, appointments, therapists, chunk_size):
+    """
+    Yields appointment rows in chunks. Rows are unique on Appointment.IDEMPOTENCY_KEY - each therapist's appointments
+    are placed in increasing half hour slots
+    :param rng: random.Random
+    :param appointments: Integer - total number of appointments to generate
+    :param therapists: Integer - number of therapists (ids 1..therapists) appointments are shared between
+    :param chunk_size: Integer - rows per chunk
+    :return: Generator of lists of appointment rows
+    """
+    # Pareto distributed workloads - a few therapists are much busier than the rest
+    workloads = [rng.paretovariate(2.0) for _ in range(therapists)]
+    total_workload = sum(workloads)
+    cumulative_weights, running_total = [], 0.0
+    for workload in workloads:
+        running_total += workload
+        cumulative_weights.append(running_total)
+
+    # Spread each therapist's expected number of appointments over roughly a year
+    max_gap_slots = [max(1, int(2 * SLOTS_PER_YEAR * total_workload / (workload * appointments)))
+                     for workload in workloads]
+    next_slot = [rng.randrange(max_gap) for max_gap in max_gap_slots]
+
+    type_names, type_weights = zip(*APPOINTMENT_TYPES)
+    durations, duration_weights = zip(*DURATIONS_SECONDS)
+    therapist_ids = range(1, therapists + 1)
+
+    generated = 0
+    while generated < appointments:
+        size = min(chunk_size, appointments - generated)
+        chunk_therapist_ids = rng.choices(therapist_ids, cum_weights=cumulative_weights, k=size)
+        chunk_types = rng.choices(type_names, weights=type_weights, k=size)
+        chunk_durations = rng.choices(durations, weights=duration_weights, k=size)
+
+        rows = []
+        for therapist_id, appointment_type, duration_seconds in zip(chunk_therapist_ids, chunk_types,
+                                                                    chunk_durations):
+            index = therapist_id - 1
+            rows.append({"appointment_id": generated + len(rows) + 1, "therapist_id": therapist_id,
+                         "start_time_unix_seconds": START_TIME_UNIX_SECONDS + next_slot[index] * SLOT_SECONDS,
+                         "duration_seconds": duration_seconds, "type": appointment_type})
+            next_slot[index] += rng.randint(1, max_gap_slots[index])
+
+        generated += size
+        yield rows
+
+
+def generate_benchmark_data(db, appointments, seed=0, chunk_size=10000):
+    """
+    Wipes the database and bulk loads a deterministic benchmark data set with executemany inserts. Secondary indexes
+    are dropped while the appointments are loaded and rebuilt afterwards - building an index once is far cheaper than
+    maintaining it row by row
+    :param db: flask_sqlalchemy.SQLAlchemy - must be used within an app context
+    :param appointments: Integer - number of appointments to generate e.g 10**4 to 10**7
+    :param seed: Integer - seed for the random number generator
+    :param chunk_size: Integer - rows per insert
+    :return: Dict - number of rows generated per table
+    """
+    from API.models import Appointment, Therapist, Specialism, SpecialismsForTherapists
+
+    rng = random.Random(seed)
+    therapists = number_of_therapists(appointments)
+    therapist_rows, therapist_specialism_rows = generate_therapist_rows(rng, therapists)
+    appointment_indexes = list(Appointment.__table__.indexes)
+
+    db.drop_all()
+    db.create_all()
+
+    with db.engine.connect() as connection:
+        # Durability doesn't matter for a data set we can regenerate. A WAL database (see ProductionConfig) is left in
+        # WAL - leaving it needs every other pooled connection closed
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        synchronous = connection.exec_driver_sql("PRAGMA synchronous").scalar()
+        connection.exec_driver_sql("PRAGMA synchronous = OFF")
+        if journal_mode != "wal":
+            connection.exec_driver_sql("PRAGMA journal_mode = MEMORY")
+
+        with connection.begin():
+            for index in appointment_indexes:
+                index.drop(connection)
+            connection.execute(Specialism.__table__.insert(), generate_specialism_rows())
+            connection.execute(Therapist.__table__.insert(), therapist_rows)
+            connection.execute(SpecialismsForTherapists.insert(), therapist_specialism_rows)
+
+        for rows in generate_appointment_rows(rng, appointments, therapists, chunk_size):
+            with connection.begin():
+                connection.execute(Appointment.__table__.insert(), rows)
+
+        with connection.begin():
+            for index in appointment_indexes:
+                index.create(connection)
+            connection.exec_driver_sql("ANALYZE")
+
+        # a pooled connection goes back to serving requests
+        connection.exec_driver_sql(f"PRAGMA journal_mode = {journal_mode}")
+        connection.exec_driver_sql(f"PRAGMA synchronous = {synchronous}")
+
+    return {"appointments": appointments, "therapists": therapists, "specialisms": len(SPECIALISM_NAMES),
+            "therapist_specialisms": len(therapist_specialism_rows)}
+
+
+def generate_dense_therapist(db, appointments, spacing_seconds=7200, duration_seconds=3600, chunk_size=10000):
+    """
+    Adds one very busy therapist - an appointment every spacing_seconds - for benchmarking per therapist lookups such
+    as the overlap check
+    :param db: flask_sqlalchemy.SQLAlchemy - must be used within an app context
+    :param appointments: Integer - number of appointments to give the therapist e.g 10**5
+    :return: Tuple of (therapist_id, start time of the first appointment)
+    """
+    from API.models import Appointment, Therapist
+
+    with db.engine.connect() as connection:
+        with connection.begin():
+            therapist_id = connection.execute(Therapist.__table__.insert(),
+                                              {"first_name": "dense", "last_name": "therapist"}).inserted_primary_key[0]
+            for start in range(0, appointments, chunk_size):
+                connection.execute(Appointment.__table__.insert(), [
+                    {"therapist_id": therapist_id, "duration_seconds": duration_seconds, "type": "one-off",
+                     "start_time_unix_seconds": START_TIME_UNIX_SECONDS + index * spacing_seconds}
+                    for index in range(start, min(start + chunk_size, appointments))])
+    return therapist_id, START_TIME_UNIX_SECONDS
@@ -0,0 +1,480 @@
+"""
+Runs timed GraphQL scenarios against a generated data set and reports latency, SQL statement counts and peak memory
+as JSON. Run from the Therapy_Booking_App directory e.g
+
+    python -m benchmarks.run_benchmarks --appointments 100000 --output results.json
+    python -m benchmarks.run_benchmarks --appointments 100000 --compare results.json
+    python -m benchmarks.run_benchmarks --appointments 100000 --sqlite-profile production --compare results.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from itertools import combinations
+
+from sqlalchemy import event, func
+
+from API import create_app, db, Config, ProductionConfig
+from API.database import database_engines
+from benchmarks.data_generation import generate_benchmark_data, generate_dense_therapist, START_TIME_UNIX_SECONDS
+
+
+# Requests go through the Flask test client so every layer we own is measured - routing, authentication, GraphQL
+# parsing + execution, the ORM and SQLite - without the noise of a network stack
+
+BENCHMARK_USERNAME = "benchmark_user"
+BENCHMARK_PASSWORD = "password"
+
+# Filters exposed by AppointmentsFilter. Every combination of these is benchmarked
+APPOINTMENT_FILTERS = {
+    "startTimeUnixSecondsRange": 'startTimeUnixSecondsRange: {begin: %d, end: %d}' % (
+        START_TIME_UNIX_SECONDS + 90 * 24 * 3600, START_TIME_UNIX_SECONDS + 120 * 24 * 3600),
+    "type": 'type: "one-off"',
+    "typeIn": 'typeIn: ["one-off", "consultation"]',
+    "hasSpecialisms": 'hasSpecialisms: ["ADHD", "Grief"]',
+    "hasAllSpecialisms": 'hasAllSpecialisms: ["CBT", "Anxiety"]',
+}
+
+NESTED_SELECTIONS = {
+    "flat": "appointmentId startTimeUnixSeconds durationSeconds type",
+    "therapist": "appointmentId startTimeUnixSeconds therapists { firstName lastName }",
+    "therapist_specialisms": "appointmentId startTimeUnixSeconds therapists { firstName lastName "
+                             "specialisms { edges { node { specialismName } } } }",
+}
+
+PAGE_SIZE = 50
+PAGE_DEPTHS = (1, 10, 100)
+BULK_MUTATION_SIZE = 100
+# Threads sending reads and writes at the same time in the mixed workload
+MIXED_READERS = 4
+MIXED_WRITERS = 2
+
+# scenario.variables is called with the iteration number so mutations can create a new appointment each time
+# scenario.config is applied to the app while the scenario runs. Scenarios with expect_errors are meant to be rejected
+Scenario = namedtuple("Scenario", "name category query variables config expect_errors", defaults=(None, False))
+
+
+def appointments_query(arguments, selection):
+    return "{ appointments(%s) { edges { cursor node { %s } } pageInfo { hasNextPage endCursor } } }" % (
+        arguments, selection)
+
+
+def filter_scenarios():
+    scenarios = [Scenario("filters/none", "filters",
+                          appointments_query(f"first: {PAGE_SIZE}", NESTED_SELECTIONS["flat"]), None)]
+    for combination_size in range(1, len(APPOINTMENT_FILTERS) + 1):
+        for filter_names in combinations(APPOINTMENT_FILTERS, combination_size):
+            filters = ", ".join(APPOINTMENT_FILTERS[name] for name in filter_names)
+            scenarios.append(Scenario("filters/" + "+".join(filter_names), "filters",
+                                      appointments_query(f"first: {PAGE_SIZE}, filters: {{{filters}}}",
+                                                         NESTED_SELECTIONS["flat"]), None))
+    return scenarios
+
+
+def nested_selection_scenarios():
+    return [Scenario(f"nested/{name}", "nested", appointments_query(f"first: {PAGE_SIZE}", selection), None)
+            for name, selection in NESTED_SELECTIONS.items()]
+
+
+def page_depth_scenarios(client, headers):
+    """
+    Walks the appointments connection once (untimed) to find the cursor of each page depth we benchmark
+    """
+    scenarios = []
+    cursor, depth = None, 1
+    while depth <= max(PAGE_DEPTHS):
+        if depth in PAGE_DEPTHS:
+            after = f', after: "{cursor}"' if cursor is not None else ""
+            scenarios.append(Scenario(f"pagination/page_{depth}", "pagination",
+                                      appointments_query(f"first: {PAGE_SIZE}{after}", NESTED_SELECTIONS["flat"]),
+                                      None))
+
+        response = client.post("/graphql", headers=headers, json={"query": appointments_query(
+            f"first: {PAGE_SIZE}" + (f', after: "{cursor}"' if cursor is not None else ""), "appointmentId")})
+        page_info = response.json["data"]["appointments"]["pageInfo"]
+        if not page_info["hasNextPage"]:
+            break
+        cursor, depth = page_info["endCursor"], depth + 1
+    return scenarios
+
+
+def availability_scenarios():
+    query = """
+        {
+          freeSlots(%s rangeStart: %d, rangeEnd: %d, minDurationSeconds: 3600) {
+            therapistId startTimeUnixSeconds endTimeUnixSeconds
+          }
+        }
+    """
+    window_start = START_TIME_UNIX_SECONDS + 90 * 24 * 3600
+    return [Scenario(f"availability/{name}_{days}_days", "availability",
+                     query % (filters, window_start, window_start + days * 24 * 3600), None)
+            for name, filters in (("all_therapists", ""), ("specialism", 'specialisms: ["ADHD"],'),
+                                  ("one_therapist", "therapistIds: [1],"))
+            for days in (1, 7)]
+
+
+def overlap_scenarios(dense_therapist_id, first_start_time):
+    """
+    Creates appointments for the therapist added by generate_dense_therapist (an hour long appointment every two hours)
+    with and without Config.REJECT_OVERLAPPING_APPOINTMENTS
+    """
+    query = """
+        mutation CreateAppointment($startTimeUnixSeconds: Int!) {
+          appointment(therapistId: %d, startTimeUnixSeconds: $startTimeUnixSeconds, durationSeconds: 1800,
+                      type: "one-off") {
+            appointment { appointmentId }
+          }
+        }
+    """ % dense_therapist_id
+    gaps = itertools.count(first_start_time + 3600, 7200)
+    check_overlaps = {"REJECT_OVERLAPPING_APPOINTMENTS": True}
+    return [
+        Scenario("overlaps/create_in_gap_unchecked", "overlaps", query,
+                 lambda _: {"startTimeUnixSeconds": next(gaps)}),
+        Scenario("overlaps/create_in_gap", "overlaps", query, lambda _: {"startTimeUnixSeconds": next(gaps)},
+                 config=check_overlaps),
+        Scenario("overlaps/create_overlapping", "overlaps", query,
+                 lambda iteration: {"startTimeUnixSeconds": first_start_time + iteration * 7200 + 1200},
+                 config=check_overlaps, expect_errors=True),
+    ]
+
+
+def mutation_scenarios(first_free_start_time):
+    start_times = itertools.count(first_free_start_time, 3600)
+
+    def new_appointment(_):
+        return {"startTimeUnixSeconds": next(start_times)}
+
+    def new_appointments(_):
+        return {"input": [{"therapistId": 1, "startTimeUnixSeconds": next(start_times), "durationSeconds": 3600,
+                           "type": "one-off"} for _ in range(BULK_MUTATION_SIZE)]}
+
+    single_mutation = """
+        mutation CreateAppointment($startTimeUnixSeconds: Int!) {
+          appointment(therapistId: 1, startTimeUnixSeconds: $startTimeUnixSeconds, durationSeconds: 3600,
+                      type: "one-off") {
+            appointment { appointmentId }
+          }
+        }
+    """
+    bulk_mutation = """
+        mutation CreateAppointments($input: [AppointmentInput!]!) {
+          createAppointments(input: $input) { appointments { appointmentId } }
+        }
+    """
+    existing_start_time = next(start_times)
+    return [
+        Scenario("mutations/create_appointment", "mutations", single_mutation, new_appointment),
+        Scenario("mutations/create_existing_appointment", "mutations", single_mutation,
+                 lambda _: {"startTimeUnixSeconds": existing_start_time}),
+        Scenario(f"mutations/create_appointments_{BULK_MUTATION_SIZE}", "mutations", bulk_mutation, new_appointments),
+    ]
+
+
+def percentile(sorted_values, percent):
+    """
+    Nearest rank percentile
+    :param sorted_values: List of numbers in ascending order
+    :param percent: Number between 0 and 100
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * percent // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def peak_rss_kilobytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes on Linux
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_scenario(client, headers, scenario, repetitions, warmup):
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    config = scenario.config or {}
+    original_config = {key: client.application.config[key] for key in config}
+    client.application.config.update(config)
+
+    latencies, errors = [], 0
+    for iteration in range(warmup + repetitions):
+        payload = {"query": scenario.query}
+        if scenario.variables is not None:
+            payload["variables"] = scenario.variables(iteration)
+
+        timed = iteration >= warmup
+        if timed:
+            for engine in database_engines(client.application).values():
+                event.listen(engine, "before_cursor_execute", record_statement)
+        try:
+            started = time.perf_counter()
+            response = client.post("/graphql", headers=headers, json=payload)
+            elapsed = time.perf_counter() - started
+        finally:
+            if timed:
+                for engine in database_engines(client.application).values():
+                    event.remove(engine, "before_cursor_execute", record_statement)
+
+        if timed:
+            latencies.append(elapsed * 1000)
+            if response.status_code != 200 or ("errors" in response.json) != scenario.expect_errors:
+                errors += 1
+
+    client.application.config.update(original_config)
+    latencies.sort()
+    return {
+        "name": scenario.name,
+        "category": scenario.category,
+        "requests": repetitions,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+        "sql_statements_per_request": len(statements) / repetitions if repetitions else None,
+        "peak_rss_kb": peak_rss_kilobytes(),
+    }
+
+
+def run_mixed_workload(app, headers, first_free_start_time, readers, writers, repetitions, warmup):
+    """
+    Reader threads each send repetitions date range queries while writer threads keep creating appointments until the
+    readers finish. Only the reads are timed - run with each --sqlite-profile to see how writers affect readers
+    :return: Dict - shaped like run_scenario's results plus the number of writes made and failed
+    """
+    statements = []
+    latencies, errors = [], []
+    writes, write_errors = [], []
+    start_times = itertools.count(first_free_start_time, 3600)
+    start_times_lock = threading.Lock()
+    readers_finished = threading.Event()
+    read_query = appointments_query(
+        f"first: {PAGE_SIZE}, filters: {{{APPOINTMENT_FILTERS['startTimeUnixSecondsRange']}}}",
+        NESTED_SELECTIONS["flat"])
+    write_query = """
+        mutation CreateAppointment($startTimeUnixSeconds: Int!) {
+          appointment(therapistId: 2, startTimeUnixSeconds: $startTimeUnixSeconds, durationSeconds: 3600,
+                      type: "one-off") {
+            appointment { appointmentId }
+          }
+        }
+    """
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    def read():
+        client = app.test_client()
+        for iteration in range(warmup + repetitions):
+            started = time.perf_counter()
+            response = client.post("/graphql", headers=headers, json={"query": read_query})
+            elapsed = time.perf_counter() - started
+            if iteration >= warmup:
+                latencies.append(elapsed * 1000)
+                if response.status_code != 200 or "errors" in response.json:
+                    errors.append(response.json)
+
+    def write():
+        client = app.test_client()
+        while not readers_finished.is_set():
+            with start_times_lock:
+                start_time = next(start_times)
+            response = client.post("/graphql", headers=headers, json={
+                "query": write_query, "variables": {"startTimeUnixSeconds": start_time}})
+            writes.append(start_time)
+            if response.status_code != 200 or "errors" in response.json:
+                write_errors.append(response.json)
+
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    writer_threads = [threading.Thread(target=write) for _ in range(writers)]
+    for engine in database_engines(app).values():
+        event.listen(engine, "before_cursor_execute", record_statement)
+    try:
+        for thread in writer_threads + reader_threads:
+            thread.start()
+        for thread in reader_threads:
+            thread.join()
+        readers_finished.set()
+        for thread in writer_threads:
+            thread.join()
+    finally:
+        for engine in database_engines(app).values():
+            event.remove(engine, "before_cursor_execute", record_statement)
+
+    latencies.sort()
+    requests = len(latencies) + len(writes)
+    return {
+        "name": f"mixed/{readers}_readers_{writers}_writers",
+        "category": "mixed",
+        "requests": len(latencies),
+        "errors": len(errors),
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": sum(latencies) / len(latencies) if latencies else None,
+        "sql_statements_per_request": len(statements) / requests if requests else None,
+        "peak_rss_kb": peak_rss_kilobytes(),
+        "writes": len(writes),
+        "write_errors": len(write_errors),
+    }
+
+
+def benchmark_config(database_uri, use_caches, sqlite_profile="default"):
+    settings = {
+        "SQLALCHEMY_DATABASE_URI": database_uri,
+        # tokens must outlive the run
+        "JWT_ACCESS_TOKEN_EXPIRES": 24 * 3600,
+    }
+    if not use_caches:
+        # repeat requests would otherwise be served from memory and never reach the database
+        settings["APPOINTMENTS_CACHE_MAX_ENTRIES"] = 0
+    base_config = ProductionConfig if sqlite_profile == "production" else Config
+    return type("BenchmarkConfig", (base_config,), settings)
+
+
+def run(appointments, seed=0, repetitions=50, warmup=3, database_uri=None, use_caches=False, categories=None,
+        dense_therapist_appointments=10 ** 5, sqlite_profile="default"):
+    """
+    Generates the data set then runs every scenario
+    :param appointments: Integer - scale factor. Number of appointments to generate
+    :param seed: Integer - seed for the data generator
+    :param repetitions: Integer - timed requests per scenario
+    :param warmup: Integer - untimed requests sent before each scenario
+    :param database_uri: str - SQLAlchemy URI of the database to (re)generate. Defaults to a file in the temp directory
+    :param use_caches: bool - leave the appointments cache enabled
+    :param categories: Iterable of str - only run scenarios in these categories. Defaults to every category
+    :param dense_therapist_appointments: Integer - appointments given to the therapist used by the overlap scenarios
+    :param sqlite_profile: str - "production" runs against ProductionConfig's WAL + connection pool profile
+    :return: Dict - the results, ready to be dumped as JSON
+    """
+    from API.models import User, Appointment
+
+    if database_uri is None:
+        database_uri = "sqlite:///" + os.path.join(tempfile.gettempdir(),
+                                                   f"therapy_booking_benchmark_{appointments}.db")
+
+    app = create_app(benchmark_config(database_uri, use_caches, sqlite_profile))
+    with app.app_context():
+        started = time.perf_counter()
+        rows = generate_benchmark_data(db, appointments, seed=seed)
+        dense_therapist_id, dense_first_start_time = None, None
+        if not categories or "overlaps" in categories:
+            dense_therapist_id, dense_first_start_time = generate_dense_therapist(db, dense_therapist_appointments)
+            rows["dense_therapist_appointments"] = dense_therapist_appointments
+        user = User(username=BENCHMARK_USERNAME, email="benchmark@test.com")
+        user.set_password(BENCHMARK_PASSWORD)
+        db.session.add(user)
+        db.session.commit()
+        load_seconds = time.perf_counter() - started
+
+        client = app.test_client()
+        auth_mutation = 'mutation { auth(username: "%s", password: "%s") { accessToken } }' % (BENCHMARK_USERNAME,
+                                                                                                BENCHMARK_PASSWORD)
+        response = client.post("/graphql", json={"query": auth_mutation})
+        headers = {"Authorization": f"Bearer {response.json['data']['auth']['accessToken']}"}
+
+        first_free_start_time = db.session.query(func.max(Appointment.start_time_unix_seconds)).scalar() + 3600
+        db.session.remove()
+
+        scenarios = filter_scenarios() + page_depth_scenarios(client, headers) + nested_selection_scenarios() + \
+            availability_scenarios() + mutation_scenarios(first_free_start_time)
+        if dense_therapist_id is not None:
+            scenarios += overlap_scenarios(dense_therapist_id, dense_first_start_time)
+        if categories:
+            scenarios = [scenario for scenario in scenarios if scenario.category in categories]
+
+        results = [run_scenario(client, headers, scenario, repetitions, warmup) for scenario in scenarios]
+        if not categories or "mixed" in categories:
+            mixed_start_time = db.session.query(func.max(Appointment.start_time_unix_seconds)).scalar() + 3600
+            db.session.remove()
+            for writers in (0, MIXED_WRITERS):
+                results.append(run_mixed_workload(app, headers, mixed_start_time, MIXED_READERS, writers,
+                                                  repetitions, warmup))
+        db.session.remove()
+
+    return {
+        "metadata": {
+            "appointments": appointments,
+            "seed": seed,
+            "repetitions": repetitions,
+            "warmup": warmup,
+            "use_caches": use_caches,
+            "sqlite_profile": sqlite_profile,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "started_at": int(time.time()),
+        },
+        "load": dict(rows, seconds=load_seconds),
+        "scenarios": results,
+    }
+
+
+def compare(baseline, results):
+    """
+    :param baseline: Dict - results of an earlier run
+    :param results: Dict - results of this run
+    :return: List of Dicts - the change in p50/p99 latency and statement count for every scenario in both runs
+    """
+    baseline_scenarios = {scenario["name"]: scenario for scenario in baseline["scenarios"]}
+    changes = []
+    for scenario in results["scenarios"]:
+        before = baseline_scenarios.get(scenario["name"])
+        if before is None:
+            continue
+        changes.append({
+            "name": scenario["name"],
+            "p50_ratio": scenario["p50_ms"] / before["p50_ms"] if before["p50_ms"] else None,
+            "p99_ratio": scenario["p99_ms"] / before["p99_ms"] if before["p99_ms"] else None,
+            "sql_statements_change": scenario["sql_statements_per_request"] - before["sql_statements_per_request"],
+        })
+    return changes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--appointments", type=int, default=10 ** 4, help="scale factor e.g 10000 to 10000000")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repetitions", type=int, default=50, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed requests sent before each scenario")
+    parser.add_argument("--database-uri", default=None, help="database to generate. Its contents are wiped")
+    parser.add_argument("--use-caches", action="store_true", help="leave the appointments cache enabled")
+    parser.add_argument("--category", action="append", dest="categories",
+                        choices=("filters", "pagination", "nested", "availability", "mutations", "overlaps",
+                                 "mixed"))
+    parser.add_argument("--dense-therapist-appointments", type=int, default=10 ** 5,
+                        help="appointments given to the therapist used by the overlap scenarios")
+    parser.add_argument("--sqlite-profile", choices=("default", "production"), default="default",
+                        help="production applies ProductionConfig's WAL pragmas and connection pool")
+    parser.add_argument("--output", default=None, help="write the JSON results here rather than to stdout")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare against")
+    args = parser.parse_args(argv)
+
+    results = run(args.appointments, seed=args.seed, repetitions=args.repetitions, warmup=args.warmup,
+                  database_uri=args.database_uri, use_caches=args.use_caches, categories=args.categories,
+                  dense_therapist_appointments=args.dense_therapist_appointments,
+                  sqlite_profile=args.sqlite_profile)
+    if args.compare:
+        with open(args.compare) as fp:
+            results["comparison"] = compare(json.load(fp), results)
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
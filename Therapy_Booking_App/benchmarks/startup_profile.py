@@ -0,0 +1,91 @@
+"""
+Measures how long a fresh interpreter takes to import app.py (i.e. to be ready to serve) and breaks the import time
+down per module using python -X importtime. Run from the Therapy_Booking_App directory e.g
+
+    python -m benchmarks.startup_profile
+    SENTRY_DSN=https://public@sentry.example.com/1 python -m benchmarks.startup_profile --top 40
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+# Each import is timed in a new interpreter - modules imported by an earlier run would otherwise already be loaded
+
+APP_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+# Modules the API only needs outside of serving requests. None of them should be imported by app.py
+NON_SERVING_MODULES = ("flask_migrate", "alembic", "mock_data_generation")
+
+
+def import_app(python_args=()):
+    """
+    Imports app.py in a new interpreter
+    :return: Tuple of (wall clock seconds, stderr, Set of module names that were loaded)
+    """
+    script = "import sys, app; print(','.join(sys.modules))"
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, *python_args, "-c", script], cwd=APP_DIRECTORY,
+                               capture_output=True, text=True, check=True)
+    return time.perf_counter() - started, completed.stderr, set(completed.stdout.strip().split(","))
+
+
+def parse_import_times(stderr):
+    """
+    :param stderr: str - output of python -X importtime
+    :return: List of Dicts - the self + cumulative milliseconds spent importing each module and its nesting depth
+    """
+    modules = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules.append({"module": name, "self_ms": int(self_us) / 1000,
+                            "cumulative_ms": int(cumulative_us) / 1000, "depth": len(indent) // 2})
+    return modules
+
+
+def interpreter_start_seconds():
+    # the time an empty interpreter takes to start - the floor for import_app_seconds
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - started
+
+
+def profile(repetitions=5, top=25):
+    """
+    :param repetitions: Integer - number of fresh interpreters app.py is imported in. The median is reported
+    :param top: Integer - number of modules with the highest cumulative import time to report
+    :return: Dict - the results, ready to be dumped as JSON
+    """
+    timings = sorted(import_app()[0] for _ in range(repetitions))
+    baseline = sorted(interpreter_start_seconds() for _ in range(repetitions))
+
+    _, stderr, loaded_modules = import_app(("-X", "importtime"))
+    modules = parse_import_times(stderr)
+    return {
+        "import_app_seconds": timings[len(timings) // 2],
+        "interpreter_seconds": baseline[len(baseline) // 2],
+        "sentry_enabled": "sentry_sdk" in loaded_modules,
+        "non_serving_modules_loaded": sorted(name for name in NON_SERVING_MODULES if name in loaded_modules),
+        "modules": sorted(modules, key=lambda module: module["cumulative_ms"], reverse=True)[:top],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repetitions", type=int, default=5, help="fresh interpreters to time")
+    parser.add_argument("--top", type=int, default=25, help="modules to report, slowest first")
+    args = parser.parse_args(argv)
+
+    json.dump(profile(repetitions=args.repetitions, top=args.top), sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,56 @@
 #generates a schema file from the schema we have setup
 #Could be used as part of a CI/CD pipeline to auto update documentation with latest changes
+#
+#Run from the Therapy_Booking_App directory
+#   python generate_schema.py            rewrites current_api_schema.graphql (in the repository root)
+#   python generate_schema.py --check    builds + validates the schema and exits with an error if the snapshot is out
+#                                        of date. The Docker image runs this at build time so a broken schema (or
+#                                        FilterSet) fails the build rather than the first worker to start
+import argparse
+import os
+import sys
 
-from Therapy_Booking_App.API.schema import schema
+SNAPSHOT_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "current_api_schema.graphql"))
 
-from graphql.utils import schema_printer
 
-my_schema_str = schema_printer.print_schema(schema)
-fp = open("current_api_schema.graphql", "w")
-fp.write(my_schema_str)
-fp.close()
\ No newline at end of file
+def build_schema_snapshot():
+    """
+    Builds the graphene schema, the SQLAlchemy mappers and every FilterSet, then checks the schema answers an
+    introspection query
+    :return: str - the schema in SDL
+    """
+    from graphql.utils import schema_printer
+    from graphql.utils.introspection_query import introspection_query
+    from sqlalchemy.orm import configure_mappers
+
+    from API.schema import schema
+
+    configure_mappers()
+    result = schema.execute(introspection_query)
+    if result.errors:
+        raise ValueError(f"Schema Failed Validation: {result.errors}")
+    return schema_printer.print_schema(schema) + "\n"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Writes (or checks) the GraphQL schema snapshot")
+    parser.add_argument("--check", action="store_true", help="fail if the snapshot is out of date")
+    parser.add_argument("--output", default=SNAPSHOT_PATH)
+    args = parser.parse_args(argv)
+
+    schema_string = build_schema_snapshot()
+    if args.check:
+        with open(args.output) as fp:
+            if fp.read() != schema_string:
+                print(f"'{args.output}' Is Out Of Date - Run generate_schema.py To Update It")
+                return 1
+        print(f"'{args.output}' Is Up To Date")
+        return 0
+
+    with open(args.output, "w") as fp:
+        fp.write(schema_string)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
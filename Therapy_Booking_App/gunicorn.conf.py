@@ -0,0 +1,81 @@
+# Production server settings. Run from the Therapy_Booking_App directory with
+#
+#     API_CONFIG=production gunicorn --config gunicorn.conf.py app:app
+#
+# Flask's development server (python app.py) runs every request in one interpreter. Gunicorn's master process imports
+# app.py once - creating the app, its schema and models - and forks worker processes from it, so workers start with
+# everything already imported and throughput scales with cores rather than being capped by one interpreter's GIL.
+# https://docs.gunicorn.org/en/stable/settings.html
+#
+# Reloading
+#   kill -HUP <master pid>    re-reads this file and replaces the workers gracefully - in flight requests finish
+#                             first. As the app is preloaded HUP doesn't pick up new code
+#   kill -USR2 <master pid>   starts a new master running the new code alongside the old one. Once it is serving
+#                             send the old master TERM
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND') or '0.0.0.0:80'
+
+# Import the app in the master so workers share its memory (copy on write) and start instantly
+preload_app = True
+
+# The usual (2 x cores) + 1 - a worker waiting on SQLite I/O leaves its core to another worker
+workers = int(os.environ.get('GUNICORN_WORKERS') or multiprocessing.cpu_count() * 2 + 1)
+# Threads per worker. Keep at or below ProductionConfig's read pool size so queries never wait for a connection.
+# The app reads the same variable - change feed streams hold a thread each and are kept to fewer than this
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS') or 4)
+
+# Seconds a silent worker is given before it is killed and restarted, and seconds workers get to finish their
+# requests when shutting down or reloading
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 30)
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT') or 30)
+keepalive = 5
+
+# Replace each worker after this many requests (staggered by the jitter) to bound memory growth
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 10000)
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+
+# Workers write their /metrics numbers to this directory so a scrape answered by any worker covers all of them
+# (see API/metrics.py). The app reads the same variable into Config.METRICS_MULTIPROCESS_DIR
+metrics_dir = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+
+def on_starting(server):
+    # numbers left by a previous server would otherwise be added to this one's
+    if metrics_dir:
+        from API.metrics import clear_multiprocess_dir
+
+        clear_multiprocess_dir(metrics_dir)
+
+
+def post_fork(server, worker):
+    # Connections the master opened while preloading must not be used by more than one process
+    from API.database import dispose_engines
+    from app import app
+
+    dispose_engines(app)
+    # the log writing thread doesn't survive the fork
+    app.extensions["log_pipeline"].restart()
+
+
+def worker_exit(server, worker):
+    # write the numbers recorded since the worker's last flush
+    from app import app
+
+    if "metrics" in app.extensions:
+        app.extensions["metrics"].flush(force=True)
+    # write out the records still queued
+    app.extensions["log_pipeline"].stop()
+
+
+def child_exit(server, worker):
+    # runs in the master once a worker has exited - its numbers are kept in the archive file
+    if metrics_dir:
+        from API.metrics import archive_worker_metrics
+
+        archive_worker_metrics(metrics_dir, worker.pid)
@@ -0,0 +1,39 @@
+"""appointment idempotency constraint
+
+Revision ID: 1201fae719e6
+Revises: de5d9989457c
+Create Date: 2026-10-18 06:39:01.999532
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1201fae719e6'
+down_revision = 'de5d9989457c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Duplicates could only have been created by concurrent retries. Keep the first copy of each appointment
+    op.execute('''
+        DELETE FROM "Appointments" WHERE appointment_id NOT IN (
+            SELECT MIN(appointment_id) FROM "Appointments"
+            GROUP BY therapist_id, start_time_unix_seconds, duration_seconds, type
+        )
+    ''')
+    # SQLite can't add a constraint to an existing table so batch mode recreates the table with it
+    with op.batch_alter_table('Appointments') as batch_op:
+        batch_op.drop_index('ix_appointments_therapist_id_start_time_unix_seconds_duration_seconds_type')
+        batch_op.create_unique_constraint('uq_appointments_therapist_id_start_time_unix_seconds_duration_seconds_type',
+                                          ['therapist_id', 'start_time_unix_seconds', 'duration_seconds', 'type'])
+
+
+def downgrade():
+    with op.batch_alter_table('Appointments') as batch_op:
+        batch_op.drop_constraint('uq_appointments_therapist_id_start_time_unix_seconds_duration_seconds_type',
+                                 type_='unique')
+        batch_op.create_index('ix_appointments_therapist_id_start_time_unix_seconds_duration_seconds_type',
+                              ['therapist_id', 'start_time_unix_seconds', 'duration_seconds', 'type'], unique=False)
@@ -1,3 +1,6 @@
+import os
+
+
 def insert_api_users(db):
     from API.models import User
 
@@ -120,6 +123,10 @@ def generate_fake_data_for_development_db():
         app_context.push()
         db.drop_all()
         db.create_all()
+        # create_all builds the latest schema - record that so `flask db upgrade` doesn't try to create it again
+        from flask_migrate import Migrate, stamp
+        Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations"))
+        stamp()
         insert_appointments_and_therapists(db)
         insert_api_users(db)
         generate_nine_unique_appointments_for_testing_filter_combinations(db)
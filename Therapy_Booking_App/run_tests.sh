@@ -1,6 +1,5 @@
 if
-python3.9 -m unittest tests/route_integration_tests.py&&\
-python3.9 -m unittest tests/model_tests.py
+python3.9 -m unittest tests/*_tests.py
 
 then
   echo "API Integration Tests Ran Without Errors"
@@ -0,0 +1,84 @@
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.appointments.loaders import RequestLoaders
+from API.models import Appointment
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+
+class TestBatchConfig(TestConfig):
+    MAX_BATCH_OPERATIONS = 3
+
+
+class API_Batch_Tests(unittest.TestCase):
+    COUNT_QUERY = "query Count { appointments { edges { node { appointmentId therapists { firstName } } } } }"
+    MUTATION = """
+        mutation Create {
+          appointment(therapistId: 2, startTimeUnixSeconds: 1644874120, durationSeconds: 3600, type: "one-off") {
+            appointment { appointmentId }
+          }
+        }
+    """
+
+    def setUp(self):
+        self.flask_app = create_app(TestBatchConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header', return_value="token")
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    @mock.patch('API.appointments.loaders.RequestLoaders', wraps=RequestLoaders)
+    def test_operations_run_in_order_and_share_the_request(self, request_loaders, verify_jwt, *args):
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json=[
+            {"query": self.COUNT_QUERY},
+            {"query": self.MUTATION},
+            {"query": self.COUNT_QUERY, "operationName": "Count"},
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        first, created, second = response.json
+        self.assertEqual([edge["node"]["appointmentId"] for edge in first["data"]["appointments"]["edges"]],
+                         ["1", "2"])
+        self.assertEqual(created, {"data": {"appointment": {"appointment": {"appointmentId": "3"}}}})
+        # the query after the mutation sees the new appointment
+        self.assertEqual([edge["node"]["appointmentId"] for edge in second["data"]["appointments"]["edges"]],
+                         ["1", "2", "3"])
+        # one token verification and one set of DataLoaders for the whole batch
+        self.assertEqual(verify_jwt.call_count, 1)
+        self.assertEqual(request_loaders.call_count, 1)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_errors_are_returned_in_place(self, *args):
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json=[
+            {"query": "{ appointments { edges { node { not_a_field } } } }"},
+            {"query": self.COUNT_QUERY},
+        ])
+        self.assertEqual(response.status_code, 400)
+        invalid, valid = response.json
+        self.assertIn("errors", invalid)
+        self.assertEqual(len(valid["data"]["appointments"]["edges"]), 2)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_batches_over_the_configured_limit_are_rejected(self, *args):
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json=[{"query": self.MUTATION}] * 4)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"errors": [{"message": str({
+            "code": "batch_too_large", "description": "A batch can contain at most 3 operations"})}]})
+        # nothing was executed
+        self.assertEqual(Appointment.query.count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
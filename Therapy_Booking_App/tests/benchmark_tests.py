@@ -0,0 +1,95 @@
+import json
+import random
+import unittest
+from unittest import mock
+
+from sqlalchemy import func
+
+from API import create_app, db, Config
+from API.models import Appointment
+from benchmarks import run_benchmarks, startup_profile
+from benchmarks.data_generation import generate_appointment_rows, generate_benchmark_data
+
+import os
+
+
+class TestConfig(Config):
+    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    SQLALCHEMY_DATABASE_URI = f'sqlite:///{basedir}/tests/test_app.db'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    API_DOMAIN = 'http://127.0.0.1:5000'
+
+
+class Benchmark_Tests(unittest.TestCase):
+
+    def tearDown(self):
+        app = create_app(TestConfig)
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_data_generator_is_deterministic_and_respects_idempotency_key(self):
+        first_run = [row for rows in generate_appointment_rows(random.Random(7), 5000, 25, 1000) for row in rows]
+        second_run = [row for rows in generate_appointment_rows(random.Random(7), 5000, 25, 1000) for row in rows]
+        self.assertEqual(first_run, second_run)
+        self.assertEqual(len(first_run), 5000)
+
+        keys = {tuple(row[name] for name in Appointment.IDEMPOTENCY_KEY) for row in first_run}
+        self.assertEqual(len(keys), len(first_run))
+
+    def test_generated_data_is_loaded_with_indexes(self):
+        app = create_app(TestConfig)
+        with app.app_context():
+            rows = generate_benchmark_data(db, 2000, seed=1, chunk_size=300)
+
+            self.assertEqual(rows["therapists"], 10)
+            self.assertEqual(db.session.query(func.count(Appointment.appointment_id)).scalar(), 2000)
+            index_names = {row[1] for row in db.session.connection().exec_driver_sql(
+                "PRAGMA index_list('Appointments')")}
+            self.assertTrue({index.name for index in Appointment.__table__.indexes} <= index_names)
+
+    def test_benchmark_reports_every_scenario_as_json(self):
+        results = run_benchmarks.run(500, repetitions=2, warmup=0, database_uri=TestConfig.SQLALCHEMY_DATABASE_URI,
+                                     dense_therapist_appointments=1000)
+        json.dumps(results)
+
+        self.assertEqual(results["load"]["appointments"], 500)
+        self.assertEqual(results["load"]["dense_therapist_appointments"], 1000)
+        categories = {scenario["category"] for scenario in results["scenarios"]}
+        self.assertEqual(categories, {"filters", "pagination", "nested", "availability", "mutations",
+                                          "overlaps", "mixed"})
+        for scenario in results["scenarios"]:
+            with self.subTest(scenario=scenario["name"]):
+                self.assertEqual(scenario["errors"], 0)
+                self.assertLessEqual(scenario["p50_ms"], scenario["p99_ms"])
+                self.assertGreater(scenario["sql_statements_per_request"], 0)
+                self.assertGreater(scenario["peak_rss_kb"], 0)
+
+        comparison = run_benchmarks.compare(results, results)
+        self.assertEqual({change["p50_ratio"] for change in comparison}, {1.0})
+
+
+class Startup_Profile_Tests(unittest.TestCase):
+
+    def test_import_times_are_parsed_per_module(self):
+        modules = startup_profile.parse_import_times(
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       120 |        120 |     API.config\n"
+            "import time:      1500 |       9000 |   API\n")
+        self.assertEqual(modules, [
+            {"module": "API.config", "self_ms": 0.12, "cumulative_ms": 0.12, "depth": 2},
+            {"module": "API", "self_ms": 1.5, "cumulative_ms": 9.0, "depth": 1},
+        ])
+
+    def test_app_does_not_import_non_serving_modules(self):
+        with mock.patch.dict(os.environ, {"SENTRY_DSN": ""}):
+            results = startup_profile.profile(repetitions=1, top=5)
+
+        self.assertEqual(results["non_serving_modules_loaded"], [])
+        self.assertFalse(results["sentry_enabled"])
+        self.assertEqual(results["modules"][0]["module"], "app")
+        self.assertGreater(results["import_app_seconds"], results["interpreter_seconds"])
+
+
+if __name__ == '__main__':
+    unittest.main()
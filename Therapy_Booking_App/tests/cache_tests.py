@@ -0,0 +1,231 @@
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.appointments.cache import AppointmentsSummary, FilterFootprint, get_appointments_cache
+from API.appointments.feed import ChangeFeedHub, SQLiteEventBus
+from API.models import Appointment
+import mock_data_generation as mock_data_generation
+from tests.helpers import appointments_query, StatementRecordingMixin, TestConfig
+
+import os
+
+
+class API_Cache_Tests(StatementRecordingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app = self.app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @staticmethod
+    def create_appointment_mutation(start_time_unix_seconds, type):
+        return """
+            mutation {
+              appointment(therapistId: 1, startTimeUnixSeconds: %s, durationSeconds: 3600, type: "%s") {
+                appointment {
+                  appointmentId
+                }
+              }
+            }
+        """ % (start_time_unix_seconds, type)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_repeated_query_is_served_from_cache_without_sql(self, *args):
+        response, statements = self.post_counting_statements(
+            appointments_query('typeIn: ["one-off", "consultation"]'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(statements, 0)
+
+        # equivalent filters share a cache entry
+        cached_response, cached_statements = self.post_counting_statements(
+            appointments_query('typeIn: ["consultation", "one-off"]'))
+        self.assertEqual(cached_response.json, response.json)
+        self.assertEqual(cached_statements, 0)
+        self.assertEqual(get_appointments_cache().hits, 1)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_cached_query_still_requires_authentication(self, *args):
+        query = appointments_query('type: "one-off"')
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+
+        with mock.patch('API.authentication.decorators.get_token_auth_header', side_effect=Exception("No Token")):
+            response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+        self.assertEqual(response.json["data"]["appointments"], None)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_new_appointment_only_invalidates_matching_entries(self, *args):
+        one_off_query = appointments_query('type: "one-off"')
+        consultation_query = appointments_query('type: "consultation"')
+        later_range_query = appointments_query('startTimeUnixSecondsRange: {begin: 1700000000, end: 1800000000}')
+        cbt_query = appointments_query('hasSpecialisms: ["CBT"]')
+        adhd_query = appointments_query('hasSpecialisms: ["ADHD"]')
+        for query in (one_off_query, consultation_query, later_range_query, cbt_query, adhd_query):
+            self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+
+        # therapist 1 (jeff) specialises in Addiction + ADHD
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql',
+                      json={"query": self.create_appointment_mutation(1644874120, "one-off")})
+
+        _, consultation_statements = self.post_counting_statements(consultation_query)
+        _, later_range_statements = self.post_counting_statements(later_range_query)
+        _, cbt_statements = self.post_counting_statements(cbt_query)
+        self.assertEqual([consultation_statements, later_range_statements, cbt_statements], [0, 0, 0])
+
+        response, one_off_statements = self.post_counting_statements(one_off_query)
+        self.assertGreater(one_off_statements, 0)
+        start_times = [edge["node"]["startTimeUnixSeconds"] for edge in response.json["data"]["appointments"]["edges"]]
+        self.assertEqual(start_times, [1644747572, 1644874120])
+
+        response, adhd_statements = self.post_counting_statements(adhd_query)
+        self.assertGreater(adhd_statements, 0)
+        self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 2)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_appointments_created_by_other_workers_invalidate_matching_entries(self, *args):
+        bus_dir = tempfile.mkdtemp()
+
+        class TestRelayConfig(TestConfig):
+            CHANGE_FEED_BUS_PATH = os.path.join(bus_dir, "change-feed.db")
+            CHANGE_FEED_POLL_SECONDS = 0.01
+
+        worker = create_app(TestRelayConfig)
+        other_worker = ChangeFeedHub(bus=SQLiteEventBus(TestRelayConfig.CHANGE_FEED_BUS_PATH))
+        cache = worker.extensions["appointments_cache"]
+        try:
+            client = worker.test_client()
+            for query in (appointments_query('type: "one-off"'), appointments_query('type: "consultation"')):
+                client.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+            self.assertEqual(len(cache), 2)
+            # the first request started the relay - it only reads events published after it starts
+            time.sleep(0.05)
+
+            other_worker.publish({"appointment_id": 3, "start_time_unix_seconds": 1644874120, "duration_seconds": 3600,
+                                  "type": "one-off", "therapist_id": 1, "therapist_specialisms": ["ADHD"]})
+            deadline = time.monotonic() + 2
+            while cache.invalidations == 0 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # only the one-off entry is dropped
+            self.assertEqual((cache.invalidations, len(cache)), (1, 1))
+        finally:
+            worker.extensions["change_feed"].stop()
+            shutil.rmtree(bus_dir)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_appointments_without_a_start_time_invalidate_every_range(self, *args):
+        footprint = FilterFootprint.from_filters({"start_time_unix_seconds_range": {"begin": 1, "end": 2}})
+        dated = Appointment(start_time_unix_seconds=5, type="one-off", therapist_id=1)
+        undated = Appointment(type="one-off", therapist_id=1)
+        self.assertFalse(footprint.matches(dated, set))
+        self.assertTrue(footprint.matches(undated, set))
+        self.assertFalse(footprint.overlaps(AppointmentsSummary([dated])))
+        self.assertTrue(footprint.overlaps(AppointmentsSummary([dated, undated])))
+
+        range_query = appointments_query('startTimeUnixSecondsRange: {begin: 1700000000, end: 1800000000}')
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": range_query})
+        get_appointments_cache().invalidate(undated)
+        _, statements = self.post_counting_statements(range_query)
+        self.assertGreater(statements, 0)
+
+    def post_recording_count_queries(self, query):
+        response, statements = self.post_recording_statements(query)
+        # the reference catalog checks its tables with count(*) subqueries - only the totalCount query starts with one
+        return response, [statement for statement in statements if statement.startswith("SELECT count(*)")]
+
+    @staticmethod
+    def total_count_query(arguments, total_count=True):
+        return """
+            {
+              appointments(%s) {
+                %s
+                pageInfo {
+                  endCursor
+                }
+                edges {
+                  node {
+                    type
+                  }
+                }
+              }
+            }
+        """ % (arguments, "totalCount" if total_count else "")
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_total_count_is_one_count_over_the_filtered_query(self, *args):
+        response, count_statements = self.post_recording_count_queries(
+            self.total_count_query('filters: {hasSpecialisms: ["CBT", "ADHD"]}, sort: [START_TIME_UNIX_SECONDS_DESC], '
+                                   'first: 1'))
+        appointments = response.json["data"]["appointments"]
+        self.assertEqual(appointments["totalCount"], 2)
+        self.assertEqual(len(appointments["edges"]), 1)
+        self.assertEqual(len(count_statements), 1)
+        self.assertNotIn("ORDER BY", count_statements[0])
+        self.assertNotIn("LIMIT", count_statements[0])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_total_count_is_only_counted_when_selected(self, *args):
+        response, count_statements = self.post_recording_count_queries(self.total_count_query("first: 1", False))
+        self.assertNotIn("totalCount", response.json["data"]["appointments"])
+        self.assertEqual(count_statements, [])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_total_count_is_cached_across_pages(self, *args):
+        first_page, count_statements = self.post_recording_count_queries(
+            self.total_count_query('filters: {typeIn: ["one-off", "consultation"]}, first: 1'))
+        self.assertEqual(len(count_statements), 1)
+
+        end_cursor = first_page.json["data"]["appointments"]["pageInfo"]["endCursor"]
+        second_page, count_statements = self.post_recording_count_queries(
+            self.total_count_query('filters: {typeIn: ["consultation", "one-off"]}, first: 1, after: "%s"'
+                                   % end_cursor))
+        self.assertEqual(count_statements, [])
+        self.assertEqual(second_page.json["data"]["appointments"]["totalCount"], 2)
+        self.assertEqual(second_page.json["data"]["appointments"]["edges"], [{"node": {"type": "consultation"}}])
+
+        # the first page itself is now served from the page cache
+        cached_first_page, statements = self.post_counting_statements(
+            self.total_count_query('filters: {typeIn: ["one-off", "consultation"]}, first: 1'))
+        self.assertEqual(cached_first_page.json, first_page.json)
+        self.assertEqual(statements, 0)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_new_appointment_invalidates_matching_counts(self, *args):
+        one_off_query = self.total_count_query('filters: {type: "one-off"}')
+        consultation_query = self.total_count_query('filters: {type: "consultation"}, first: 1')
+        response, _ = self.post_recording_count_queries(one_off_query)
+        self.assertEqual(response.json["data"]["appointments"]["totalCount"], 1)
+        self.post_recording_count_queries(consultation_query)
+
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql',
+                      json={"query": self.create_appointment_mutation(1644874120, "one-off")})
+
+        response, count_statements = self.post_recording_count_queries(one_off_query)
+        self.assertEqual(response.json["data"]["appointments"]["totalCount"], 2)
+        self.assertEqual(len(count_statements), 1)
+        _, count_statements = self.post_recording_count_queries(
+            self.total_count_query('filters: {type: "consultation"}, first: 2'))
+        self.assertEqual(count_statements, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+import json
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from sqlalchemy import event
+
+from API import create_app, db, Config
+from API.appointments.feed import ChangeFeedHub, SQLiteEventBus, get_change_feed
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+import os
+
+
+class TestChangeFeedConfig(TestConfig):
+    CHANGE_FEED_QUEUE_SIZE = 1
+    CHANGE_FEED_MAX_SUBSCRIBERS = 2
+    CHANGE_FEED_KEEPALIVE_SECONDS = 0.01
+
+
+class API_Change_Feed_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestChangeFeedConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def open_stream(self, **query_string):
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/events/appointments', query_string=query_string,
+                                headers={"Authorization": "Bearer token"}, buffered=False)
+        return response, iter(response.response)
+
+    def create_appointment(self):
+        mutation = """
+            mutation {
+              appointment(therapistId: 2, startTimeUnixSeconds: 1644874120, durationSeconds: 3600,
+                          type: "consultation") {
+                appointment {
+                  appointmentId
+                }
+              }
+            }
+        """
+        return self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": mutation})
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_new_appointment_is_streamed_to_matching_subscribers(self, *args):
+        cbt_response, cbt_stream = self.open_stream(specialism="CBT", type=["consultation", "one-off"])
+        jeff_response, jeff_stream = self.open_stream(therapist_id=1)
+        self.assertEqual(cbt_response.content_type, "text/event-stream")
+        self.assertEqual(next(cbt_stream), b": connected\n\n")
+        self.assertEqual(next(jeff_stream), b": connected\n\n")
+
+        self.assertEqual(self.create_appointment().json["data"]["appointment"]["appointment"]["appointmentId"], "3")
+        # repeating the mutation returns the existing appointment - nothing new is published
+        self.create_appointment()
+
+        self.assertEqual(next(cbt_stream).decode("utf8"), "event: appointment.created\ndata: %s\n\n" % json.dumps({
+            "appointment_id": 3, "start_time_unix_seconds": 1644874120, "duration_seconds": 3600,
+            "type": "consultation", "therapist_id": 2, "therapist_specialisms": ["CBT", "Divorce", "Sexuality"]}))
+        self.assertEqual(next(cbt_stream), b": keep-alive\n\n")
+        self.assertEqual(next(jeff_stream), b": keep-alive\n\n")
+
+        cbt_response.close()
+        jeff_response.close()
+        self.assertEqual(len(get_change_feed()), 0)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_slow_subscribers_are_dropped(self, *args):
+        response, stream = self.open_stream()
+        next(stream)
+        hub = get_change_feed()
+        # CHANGE_FEED_QUEUE_SIZE = 1 - the second event doesn't fit
+        event = {"appointment_id": 3, "therapist_id": 2, "type": "consultation", "therapist_specialisms": []}
+        hub.publish(event)
+        hub.publish(event)
+
+        self.assertEqual(next(stream), b'event: dropped\ndata: {"reason": "slow_consumer"}\n\n')
+        self.assertEqual(list(stream), [])
+        self.assertEqual(hub.dropped_subscribers, 1)
+        self.assertEqual(len(hub), 0)
+        response.close()
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_streams_per_worker_are_limited(self, *args):
+        responses = [self.open_stream()[0] for _ in range(2)]
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/events/appointments',
+                                headers={"Authorization": "Bearer token"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json["code"], "too_many_subscribers")
+
+        for stream_response in responses:
+            stream_response.close()
+        self.assertEqual(len(get_change_feed()), 0)
+
+    def test_streams_per_worker_leave_threads_for_other_requests(self):
+        class TestFewThreadsConfig(TestChangeFeedConfig):
+            WORKER_THREADS = 2
+            CHANGE_FEED_MAX_SUBSCRIBERS = 100
+
+        with self.assertLogs("API.appointments.feed", level="WARNING"):
+            app = create_app(TestFewThreadsConfig)
+        self.assertEqual(app.extensions["change_feed"].max_subscribers, 1)
+
+        TestFewThreadsConfig.WORKER_THREADS = 1
+        self.assertEqual(create_app(TestFewThreadsConfig).extensions["change_feed"].max_subscribers, 0)
+        # by default half of the threads
+        self.assertEqual(Config.CHANGE_FEED_MAX_SUBSCRIBERS, Config.WORKER_THREADS // 2)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_invalid_stream_requests_are_rejected(self, *args):
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/events/appointments?therapist_id=jeff',
+                                headers={"Authorization": "Bearer token"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["code"], "invalid_filters")
+
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/events/appointments',
+                                headers={"Authorization": "Bearer token", "Last-Event-ID": "jeff"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["code"], "invalid_last_event_id")
+        self.assertEqual(len(get_change_feed()), 0)
+
+    def test_stream_requires_authentication(self):
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/events/appointments')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(len(get_change_feed()), 0)
+
+    def test_events_are_relayed_between_workers(self):
+        bus_dir = tempfile.mkdtemp()
+        path = os.path.join(bus_dir, "change-feed.db")
+        # one hub per "worker" - each with its own connection to the bus
+        publishing_hub = ChangeFeedHub(bus=SQLiteEventBus(path, poll_seconds=0.01))
+        relaying_hub = ChangeFeedHub(bus=SQLiteEventBus(path, poll_seconds=0.01))
+        try:
+            publishing_subscription = publishing_hub.subscribe()
+            relayed_subscription = relaying_hub.subscribe(types={"consultation"})
+            # the relay threads only read events published after they start
+            time.sleep(0.05)
+
+            event = {"appointment_id": 3, "therapist_id": 2, "type": "consultation", "therapist_specialisms": []}
+            publishing_hub.publish(event)
+            publishing_hub.publish(dict(event, appointment_id=4, type="one-off"))
+
+            # delivered with the event's id on the bus
+            self.assertEqual(relayed_subscription.get(timeout=2), (1, event))
+            self.assertEqual(relayed_subscription.get(timeout=0.1), None)
+            # the publishing worker delivers its own events directly and skips them on the bus
+            self.assertEqual([publishing_subscription.get(timeout=0.1) for _ in range(3)],
+                             [(1, event), (2, dict(event, appointment_id=4, type="one-off")), None])
+        finally:
+            publishing_hub.stop()
+            relaying_hub.stop()
+            shutil.rmtree(bus_dir)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_reconnecting_subscribers_are_sent_the_events_they_missed(self, *args):
+        bus_dir = tempfile.mkdtemp()
+
+        class TestBusConfig(TestChangeFeedConfig):
+            CHANGE_FEED_BUS_PATH = os.path.join(bus_dir, "change-feed.db")
+            CHANGE_FEED_POLL_SECONDS = 0.01
+            CHANGE_FEED_QUEUE_SIZE = 10
+
+        worker = create_app(TestBusConfig)
+        hub = worker.extensions["change_feed"]
+        other_worker = ChangeFeedHub(bus=SQLiteEventBus(TestBusConfig.CHANGE_FEED_BUS_PATH))
+        client = worker.test_client()
+
+        def open_stream(headers=None):
+            response = client.get(f'{TestConfig.API_DOMAIN}/events/appointments', query_string={"type": "consultation"},
+                                  headers=dict(headers or {}, Authorization="Bearer token"), buffered=False)
+            return response, iter(response.response)
+
+        try:
+            response, stream = open_stream()
+            self.assertEqual(next(stream), b": connected\n\n")
+            event = {"appointment_id": 3, "therapist_id": 2, "type": "consultation", "therapist_specialisms": []}
+            hub.publish(event)
+            self.assertEqual(next(stream).decode("utf8"),
+                             "id: 1\nevent: appointment.created\ndata: %s\n\n" % json.dumps(event))
+            response.close()
+
+            # published while the client was disconnected - by this worker and another one
+            hub.publish(dict(event, appointment_id=4), dict(event, appointment_id=5, type="one-off"))
+            other_worker.publish(dict(event, appointment_id=6))
+
+            response, stream = open_stream({"Last-Event-ID": "1"})
+            self.assertEqual(next(stream), b": connected\n\n")
+            # only the matching events, each sent once even if the relay also delivers it
+            self.assertEqual([next(stream).decode("utf8").split("\n")[0] for _ in range(2)], ["id: 2", "id: 4"])
+            time.sleep(0.05)
+            self.assertEqual(next(stream), b": keep-alive\n\n")
+            response.close()
+            self.assertEqual(len(hub), 0)
+        finally:
+            hub.stop()
+            other_worker.stop()
+            shutil.rmtree(bus_dir)
+
+    def test_events_published_together_are_relayed_in_one_transaction(self):
+        bus_dir = tempfile.mkdtemp()
+        path = os.path.join(bus_dir, "change-feed.db")
+        bus = SQLiteEventBus(path)
+        try:
+            statements = []
+            bus._connection().set_trace_callback(statements.append)
+            events = [{"appointment_id": appointment_id, "therapist_id": 2, "type": "consultation",
+                       "therapist_specialisms": []} for appointment_id in (3, 4, 5)]
+            ChangeFeedHub(bus=bus).publish(*events)
+
+            self.assertEqual([statement for statement in statements if statement in ("BEGIN IMMEDIATE", "COMMIT")],
+                             ["BEGIN IMMEDIATE", "COMMIT"])
+            # another worker reads all of them
+            relayed, last_id = SQLiteEventBus(path).read_after(0)
+            self.assertEqual([event for _, event in relayed], events)
+        finally:
+            shutil.rmtree(bus_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
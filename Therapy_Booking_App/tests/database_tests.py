@@ -0,0 +1,298 @@
+import runpy
+import sqlite3
+import time
+import unittest
+from functools import partial
+from unittest import mock
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from API import create_app, db
+from API.backend import document_backend
+from API.database import dispose_engines
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig, TestProductionConfig
+
+import os
+
+
+class API_SQLite_Profile_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestProductionConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        db.get_engine(self.flask_app).dispose()
+        database_path = TestProductionConfig.SQLALCHEMY_DATABASE_URI[len('sqlite:///'):]
+        for path in (database_path, database_path + '-wal', database_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    query = """
+        {
+          appointments { edges { node { appointmentId } } }
+        }
+    """
+
+    def test_pragmas_are_applied_to_every_pooled_connection(self):
+        expected = {"journal_mode": "wal", "synchronous": 1, "busy_timeout": 5000, "temp_store": 2,
+                    "cache_size": -65536, "mmap_size": 268435456}
+        read_engine = self.flask_app.extensions["read_engine"]
+        writer, first_reader, second_reader = db.engine.connect(), read_engine.connect(), read_engine.connect()
+        try:
+            self.assertIsNot(first_reader.connection.dbapi_connection, second_reader.connection.dbapi_connection)
+            for connection, query_only in ((writer, 0), (first_reader, 1), (second_reader, 1)):
+                for name, value in dict(expected, query_only=query_only).items():
+                    with self.subTest(pragma=name):
+                        self.assertEqual(connection.exec_driver_sql(f"PRAGMA {name}").scalar(), value)
+        finally:
+            writer.close()
+            first_reader.close()
+            second_reader.close()
+
+        # writes are serialised on one connection per worker
+        self.assertEqual(db.engine.pool.size(), 1)
+        self.assertEqual(read_engine.pool.size(), 8)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_connections_are_reused_between_requests(self, *args):
+        opened = []
+        event.listen(self.flask_app.extensions["read_engine"], "connect",
+                     lambda dbapi_connection, connection_record: opened.append(dbapi_connection))
+        db.session.remove()
+        for _ in range(5):
+            response = self.app.post(f'{TestProductionConfig.API_DOMAIN}/graphql', json={"query": self.query})
+            self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 2)
+        self.assertLessEqual(len(opened), 1)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_readers_are_not_blocked_by_a_writer(self, *args):
+        db.session.remove()
+        writer = db.engine.raw_connection()
+        try:
+            # an exclusive lock shuts readers out of a rollback journal database until the writer finishes
+            cursor = writer.cursor()
+            cursor.execute("BEGIN EXCLUSIVE")
+            cursor.execute("DELETE FROM Appointments")
+
+            started = time.monotonic()
+            response = self.app.post(f'{TestProductionConfig.API_DOMAIN}/graphql', json={"query": self.query})
+            self.assertLess(time.monotonic() - started, 1)
+            # the reader sees the last committed snapshot
+            self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 2)
+        finally:
+            writer.rollback()
+            writer.close()
+
+
+class API_Database_Routing_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestProductionConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+        db.session.remove()
+
+        self.statements = {"read": [], "write": []}
+        self.read_engine = self.flask_app.extensions["read_engine"]
+        for route, engine in (("read", self.read_engine), ("write", db.engine)):
+            event.listen(engine, "before_cursor_execute", partial(self.record_statement, route))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        db.get_engine(self.flask_app).dispose()
+        self.read_engine.dispose()
+        database_path = TestProductionConfig.SQLALCHEMY_DATABASE_URI[len('sqlite:///'):]
+        for path in (database_path, database_path + '-wal', database_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def record_statement(self, route, conn, cursor, statement, parameters, context, executemany):
+        self.statements[route].append(statement)
+
+    document = """
+        query Appointments {
+          appointments { edges { node { appointmentId } } }
+        }
+        mutation CreateAppointment {
+          appointment(therapistId: 2, startTimeUnixSeconds: 1644874120, durationSeconds: 3600, type: "one-off") {
+            appointment { appointmentId }
+          }
+        }
+    """
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_query_operations_run_on_the_read_engine(self, *args):
+        response = self.app.post(f'{TestProductionConfig.API_DOMAIN}/graphql',
+                                 json={"query": self.document, "operationName": "Appointments"})
+
+        self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 2)
+        self.assertGreater(len(self.statements["read"]), 0)
+        self.assertEqual(self.statements["write"], [])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_mutations_run_on_the_writer_engine(self, *args):
+        response = self.app.post(f'{TestProductionConfig.API_DOMAIN}/graphql',
+                                 json={"query": self.document, "operationName": "CreateAppointment"})
+        self.assertEqual(response.json["data"]["appointment"]["appointment"]["appointmentId"], "3")
+        self.assertEqual(self.statements["read"], [])
+        self.assertGreater(len(self.statements["write"]), 0)
+
+        # the next query starts a new read transaction and sees the appointment
+        response = self.app.post(f'{TestProductionConfig.API_DOMAIN}/graphql',
+                                 json={"query": self.document, "operationName": "Appointments"})
+        self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 3)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_graphql_documents_are_parsed_and_validated_once(self, *args):
+        # routing reads each request's operations before it is executed - the document is still only parsed once
+        endpoint = f'{TestProductionConfig.API_DOMAIN}/graphql'
+        stats_before = self.app.get(f'{TestProductionConfig.API_DOMAIN}/graphql/document-cache').json
+
+        valid_query = "query RoutedDocumentCacheTest{appointments{edges{node{durationSeconds}}}}"
+        invalid_query = "query RoutedDocumentCacheTest{appointments{edges{node{not_a_field}}}}"
+        with mock.patch.object(document_backend, "document_from_string",
+                               wraps=document_backend.document_from_string) as document_from_string:
+            for _ in range(3):
+                response = self.app.post(endpoint, json={"query": valid_query})
+                self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 2)
+                response = self.app.post(endpoint, json={"query": invalid_query})
+                self.assertEqual(response.status_code, 400)
+            response = self.app.post(endpoint, json={"query": "{ appointments {"})
+            self.assertIn("Syntax Error", response.json["errors"][0]["message"])
+        self.assertEqual(document_from_string.call_count, 7)
+
+        stats_after = self.app.get(f'{TestProductionConfig.API_DOMAIN}/graphql/document-cache').json
+        self.assertEqual(stats_after["misses"] - stats_before["misses"], 2)
+        self.assertEqual(stats_after["hits"] - stats_before["hits"], 4)
+
+    def test_document_cache_stats_require_authentication(self):
+        response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/graphql/document-cache')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json["code"], "authorization_header_missing")
+
+    def test_read_connections_can_not_write(self):
+        with self.read_engine.connect() as connection:
+            with self.assertRaises(OperationalError):
+                connection.exec_driver_sql("DELETE FROM Appointments")
+
+
+class TestHealthCheckConfig(TestProductionConfig):
+    # fail fast when the pool is exhausted
+    SQLALCHEMY_ENGINE_OPTIONS = dict(TestProductionConfig.SQLALCHEMY_ENGINE_OPTIONS, pool_timeout=0.1)
+
+
+class API_Health_Check_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestHealthCheckConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        dispose_engines(self.flask_app)
+        database_path = TestProductionConfig.SQLALCHEMY_DATABASE_URI[len('sqlite:///'):]
+        for path in (database_path, database_path + '-wal', database_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_healthz(self):
+        response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/healthz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"status": "ok"})
+
+    def test_readyz_checks_every_database_pool(self):
+        response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/readyz')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["status"], "ok")
+        self.assertEqual(set(response.json["databases"]), {"read", "write"})
+        for database in response.json["databases"].values():
+            self.assertEqual(database["status"], "ok")
+
+    def test_readyz_stays_ready_while_a_pool_is_busy(self):
+        # the writer pool holds one connection - held here as a mutation would hold it
+        writer = db.engine.connect()
+        try:
+            started = time.perf_counter()
+            response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/readyz')
+            elapsed = time.perf_counter() - started
+        finally:
+            writer.close()
+
+        # answered without waiting pool_timeout for the writer connection
+        self.assertLess(elapsed, TestProductionConfig.SQLALCHEMY_ENGINE_OPTIONS["pool_timeout"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["status"], "ok")
+        self.assertEqual(response.json["databases"]["write"]["status"], "busy")
+        self.assertEqual(response.json["databases"]["read"]["status"], "ok")
+
+    def test_readyz_counts_a_pools_overflow_connections(self):
+        options = TestProductionConfig.SQLALCHEMY_READ_ENGINE_OPTIONS
+        read_engine = self.flask_app.extensions["read_engine"]
+        # the pool can still open overflow connections
+        readers = [read_engine.connect() for _ in range(options["pool_size"])]
+        try:
+            response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/readyz')
+            self.assertEqual(response.json["databases"]["read"]["status"], "ok")
+            readers.extend(read_engine.connect() for _ in range(options["max_overflow"] - 1))
+            # the readiness check opens the last one itself
+            response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/readyz')
+            self.assertEqual(response.json["databases"]["read"]["status"], "ok")
+            readers.append(read_engine.connect())
+            response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/readyz')
+            self.assertEqual(response.json["databases"]["read"]["status"], "busy")
+        finally:
+            for reader in readers:
+                reader.close()
+
+    def test_readyz_is_unavailable_when_a_busy_pool_cant_reach_its_database(self):
+        writer = db.engine.connect()
+        try:
+            with mock.patch.object(db.engine.dialect, "connect", side_effect=sqlite3.OperationalError("unable to open")):
+                response = self.app.get(f'{TestProductionConfig.API_DOMAIN}/readyz')
+        finally:
+            writer.close()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json["status"], "unavailable")
+        self.assertEqual(response.json["databases"]["write"], {"status": "unavailable", "error": "OperationalError"})
+
+    def test_server_config_sizes_workers_by_core_count(self):
+        server_config_path = os.path.join(TestConfig.basedir, 'gunicorn.conf.py')
+        with mock.patch.dict(os.environ, {"GUNICORN_WORKERS": "", "GUNICORN_THREADS": "2"}):
+            with mock.patch('multiprocessing.cpu_count', return_value=4):
+                server_config = runpy.run_path(server_config_path)
+
+        self.assertTrue(server_config["preload_app"])
+        self.assertEqual(server_config["workers"], 9)
+        self.assertEqual(server_config["threads"], 2)
+        self.assertLessEqual(server_config["threads"],
+                             TestProductionConfig.SQLALCHEMY_READ_ENGINE_OPTIONS["pool_size"])
+
+
+if __name__ == '__main__':
+    unittest.main()
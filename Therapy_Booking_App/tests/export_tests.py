@@ -0,0 +1,95 @@
+import json
+import unittest
+from unittest import mock
+
+from API import create_app, db
+import mock_data_generation as mock_data_generation
+from tests.helpers import recording_statements, TestConfig
+
+
+class TestExportConfig(TestConfig):
+    EXPORT_BATCH_SIZE = 1
+
+
+class API_Export_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestExportConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def export(self, **query_string):
+        return self.app.get(f'{TestConfig.API_DOMAIN}/export/appointments', query_string=query_string,
+                            headers={"Authorization": "Bearer token"})
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_export_streams_filtered_rows_as_ndjson(self, *args):
+        response = self.export(filters=json.dumps({"hasSpecialisms": ["CBT"], "typeIn": ["consultation", "one-off"]}))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.content_type, "application/x-ndjson")
+        self.assertEqual([json.loads(line) for line in response.get_data(as_text=True).splitlines()], [{
+            "appointment_id": 2, "start_time_unix_seconds": 1644780000, "duration_seconds": 3600,
+            "type": "consultation", "therapist_id": 2, "therapist_first_name": "jane", "therapist_last_name": "smith",
+            "therapist_specialisms": ["CBT", "Divorce", "Sexuality"]}])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_export_streams_csv_one_batch_per_chunk(self, *args):
+        response = self.export(format="csv")
+        self.assertEqual(response.content_type, "text/csv; charset=utf-8")
+        # EXPORT_BATCH_SIZE = 1 - the header then one chunk per row
+        chunks = [chunk.decode("utf8") for chunk in response.response]
+        self.assertEqual(chunks, [
+            "appointment_id,start_time_unix_seconds,duration_seconds,type,therapist_id,therapist_first_name,"
+            "therapist_last_name,therapist_specialisms\r\n",
+            "1,1644747572,3600,one-off,1,jeff,smith,Addiction;ADHD\r\n",
+            "2,1644780000,3600,consultation,2,jane,smith,CBT;Divorce;Sexuality\r\n",
+        ])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_export_reads_flat_rows_in_one_query(self, *args):
+        with recording_statements(db.engine) as statements:
+            response = self.export(filters=json.dumps({"startTimeUnixSecondsRange": {"begin": 0,
+                                                                                     "end": 1700000000}}))
+            rows = response.get_data(as_text=True).splitlines()
+
+        self.assertEqual(len(rows), 2)
+        appointment_statements = [statement for statement in statements if '"Appointments"' in statement]
+        self.assertEqual(len(appointment_statements), 1)
+        self.assertIn("LEFT OUTER JOIN therapist", appointment_statements[0])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_invalid_export_requests_are_rejected(self, *args):
+        response = self.export(filters=json.dumps({"bogus": 1}))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"code": "invalid_filters", "description": 'In field "bogus": Unknown field.'})
+
+        response = self.export(filters="{not json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["code"], "invalid_filters")
+
+        response = self.export(format="xml")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json, {"code": "invalid_format", "description": "format must be one of csv, ndjson"})
+
+    def test_export_requires_authentication(self):
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/export/appointments')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json, {"code": "authorization_header_missing",
+                                         "description": "Authorization header is expected"})
+
+
+if __name__ == '__main__':
+    unittest.main()
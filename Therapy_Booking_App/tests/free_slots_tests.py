@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.appointments.availability import find_gaps
+from API.models import Appointment
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+
+class API_Free_Slots_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app = self.app.test_client()
+        db.create_all()
+        # jeff (therapist 1) is booked 1644747572 -> 1644751172, jane (therapist 2) 1644780000 -> 1644783600
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def free_slots(self, arguments):
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": """
+            {
+              freeSlots(%s) {
+                therapistId
+                startTimeUnixSeconds
+                endTimeUnixSeconds
+                therapist {
+                  firstName
+                }
+              }
+            }
+        """ % arguments})
+        return response.json
+
+    @staticmethod
+    def slots(response):
+        return [(slot["therapistId"], slot["startTimeUnixSeconds"], slot["endTimeUnixSeconds"])
+                for slot in response["data"]["freeSlots"]]
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_free_slots_are_the_gaps_between_appointments(self, *args):
+        response = self.free_slots("rangeStart: 1644740000, rangeEnd: 1644790000")
+        self.assertEqual(self.slots(response), [(1, 1644740000, 1644747572), (1, 1644751172, 1644790000),
+                                                (2, 1644740000, 1644780000), (2, 1644783600, 1644790000)])
+        self.assertEqual(response["data"]["freeSlots"][0]["therapist"], {"firstName": "jeff"})
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_free_slots_can_be_filtered(self, *args):
+        # jeff's appointment starts before the window but runs into it
+        self.assertEqual(self.slots(self.free_slots("therapistIds: [1], rangeStart: 1644749000, rangeEnd: 1644790000")),
+                         [(1, 1644751172, 1644790000)])
+        self.assertEqual(self.slots(self.free_slots(
+            'specialisms: ["CBT"], rangeStart: 1644740000, rangeEnd: 1644790000, minDurationSeconds: 7200')),
+            [(2, 1644740000, 1644780000)])
+        self.assertEqual(self.slots(self.free_slots(
+            'therapistIds: [1], specialisms: ["CBT"], rangeStart: 1644740000, rangeEnd: 1644790000')), [])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_earlier_longer_appointments_running_into_the_window_are_busy(self, *args):
+        # overlapping appointments are accepted unless REJECT_OVERLAPPING_APPOINTMENTS is set. The latest appointment
+        # before the window (500 -> 600) ends before it but the earlier one (0 -> 5000) books the whole window
+        db.session.add_all([
+            Appointment(therapist_id=2, start_time_unix_seconds=0, duration_seconds=5000, type="one-off"),
+            Appointment(therapist_id=2, start_time_unix_seconds=500, duration_seconds=100, type="one-off")])
+        db.session.commit()
+
+        self.assertEqual(self.slots(self.free_slots("therapistIds: [2], rangeStart: 1000, rangeEnd: 3000")), [])
+        self.assertEqual(self.slots(self.free_slots("therapistIds: [2], rangeStart: 1000, rangeEnd: 6000")),
+                         [(2, 5000, 6000)])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_invalid_range_is_rejected(self, *args):
+        response = self.free_slots("rangeStart: 1644790000, rangeEnd: 1644740000")
+        self.assertEqual(response["errors"][0]["message"],
+                         str({"code": "invalid_range", "description": "'rangeEnd' must be after 'rangeStart'"}))
+
+    def test_overlapping_appointments_are_swept_into_one_busy_period(self):
+        self.assertEqual(find_gaps([(0, 10), (5, 20), (8, 12), (25, 30)], 0, 40, 0), [(20, 25), (30, 40)])
+        self.assertEqual(find_gaps([(0, 10), (5, 20), (8, 12), (25, 30)], 0, 40, 6), [(30, 40)])
+        self.assertEqual(find_gaps([], 0, 40, 0), [(0, 40)])
+        self.assertEqual(find_gaps([(-10, 50)], 0, 40, 0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
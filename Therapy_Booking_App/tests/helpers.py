@@ -0,0 +1,98 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from API import db, Config, ProductionConfig
+
+import os
+
+
+class TestConfig(Config):
+    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    SQLALCHEMY_DATABASE_URI = f'sqlite:///{basedir}/tests/test_app.db'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    API_DOMAIN = 'http://127.0.0.1:5000'
+
+
+class TestProductionConfig(ProductionConfig):
+    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+    # WAL is a persistent property of the database file so the production profile gets a file of its own
+    SQLALCHEMY_DATABASE_URI = f'sqlite:///{basedir}/tests/test_app_production.db'
+    API_DOMAIN = 'http://127.0.0.1:5000'
+
+
+@contextmanager
+def recording_statements(engine, parameters=False):
+    """
+    Records every SQL statement run on the engine within the block
+    :param parameters: bool - record (statement, parameters) tuples rather than the statements alone
+    :return: List - filled in as the statements run
+    """
+    statements = []
+
+    def record_statement(conn, cursor, statement, statement_parameters, context, executemany):
+        statements.append((statement, statement_parameters) if parameters else statement)
+
+    event.listen(engine, "before_cursor_execute", record_statement)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record_statement)
+
+
+class StatementRecordingMixin(object):
+    """
+    For test cases whose test client is self.app
+    """
+
+    def post_recording_statements(self, query, variables=None):
+        """
+        Posts a query to our endpoint and records every SQL statement it triggers
+        :param query: str - the GraphQL query to send
+        :param variables: Dict - the query's variables
+        :return: the response and a list of the statements
+        """
+        payload = {"query": query}
+        if variables is not None:
+            payload["variables"] = variables
+        with recording_statements(db.engine) as statements:
+            response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json=payload)
+        return response, statements
+
+    def post_counting_statements(self, query):
+        """
+        :return: the response and the number of SQL statements the query triggered
+        """
+        response, statements = self.post_recording_statements(query)
+        return response, len(statements)
+
+
+def appointments_query(filters):
+    """
+    :param filters: str - the fields of the appointments filters argument e.g 'type: "one-off"'
+    :return: str - a query for the matching appointments with their therapist and the therapist's specialisms
+    """
+    return """
+        {
+          appointments(filters: {%s}) {
+            edges {
+              node {
+                appointmentId
+                startTimeUnixSeconds
+                type
+                therapists {
+                  firstName
+                  lastName
+                  specialisms {
+                    edges {
+                      node {
+                        specialismName
+                      }
+                    }
+                  }
+                }
+              }
+            }
+          }
+        }
+    """ % filters
@@ -0,0 +1,97 @@
+import io
+import json
+import logging
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.structured_logging import init_logging, LazyPayload, LogPipeline
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+
+class TestLoggingConfig(TestConfig):
+    LOG_LEVEL = 'INFO'
+    LOG_LEVELS = {"API.schema": "DEBUG"}
+
+
+class API_Logging_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestLoggingConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+        self.root_level = logging.getLogger().level
+        self.stream = io.StringIO()
+        self.pipeline = init_logging(self.flask_app, stream=self.stream)
+
+    def tearDown(self):
+        self.pipeline.stop()
+        logging.getLogger().setLevel(self.root_level)
+        logging.getLogger("API.schema").setLevel(logging.NOTSET)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def written_records(self):
+        # stopping the listener writes out every queued record
+        self.pipeline.stop()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_records_are_written_as_json_with_per_logger_levels(self, *args):
+        query = "{ appointments { edges { node { appointmentId } } } }"
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": """
+            mutation {
+              appointment(therapistId: 2, startTimeUnixSeconds: 1644874120, durationSeconds: 3600, type: "one-off") {
+                appointment { appointmentId }
+              }
+            }
+        """})
+
+        records = self.written_records()
+        # API.schema logs at DEBUG, everything else at INFO
+        resolving = [record for record in records if record["message"] == "Resolving Appointment Query"]
+        self.assertEqual(len(resolving), 1)
+        self.assertEqual(resolving[0]["query_submitted"], query)
+        self.assertEqual((resolving[0]["level"], resolving[0]["logger"]), ("DEBUG", "API.schema"))
+        self.assertIn("Created New Appointment <Appointment ID 3>", [record["message"] for record in records])
+        self.assertNotIn("Returning Mutation", [record["message"] for record in records])
+
+    def test_lazy_payloads_are_only_built_for_records_which_are_written(self):
+        builder = mock.Mock(return_value={"message": "Built"})
+        logging.getLogger("API.appointments.mutations").debug(LazyPayload(builder))
+        builder.assert_not_called()
+
+        self.pipeline.sampler.logger_rates = {"API.schema": 0}
+        logging.getLogger("API.schema").debug(LazyPayload(builder))
+        builder.assert_not_called()
+
+        self.pipeline.sampler.logger_rates = {"API.schema": 0.5}
+        with mock.patch('API.structured_logging.random.random', return_value=0.25):
+            logging.getLogger("API.schema").debug(LazyPayload(builder))
+        builder.assert_called_once()
+
+        records = self.written_records()
+        self.assertEqual([(record["message"], record.get("sample_rate")) for record in records], [("Built", 0.5)])
+
+    def test_request_threads_do_not_wait_for_a_full_queue(self):
+        pipeline = LogPipeline(queue_size=1, stream=io.StringIO())
+        pipeline.start()
+        # nothing takes records off the queue while the listener is stopped
+        pipeline.listener.stop()
+        logger = logging.getLogger("API.logging_test")
+        for number in range(3):
+            logger.warning({"message": "Queued", "number": number})
+        self.assertEqual(pipeline.handler.dropped, 2)
+        pipeline.listener = None
+        pipeline.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
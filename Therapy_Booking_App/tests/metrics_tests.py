@@ -0,0 +1,161 @@
+import re
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.metrics import archive_worker_metrics, read_snapshot, write_snapshot
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+import os
+
+
+class TestMetricsConfig(TestConfig):
+    METRICS_TOKEN = "metrics-token"
+
+
+class TestMetricsDisabledConfig(TestConfig):
+    METRICS_ENABLED = False
+
+
+class API_Metrics_Tests(unittest.TestCase):
+    # a line of Prometheus' text format which isn't a comment
+    SAMPLE_LINE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*(\{([a-zA-Z_]+="[^"]*",?)*\})? -?[0-9.e+-]+$')
+    QUERY = """
+        query MetricsTest {
+          appointments { edges { node { appointmentId therapists { firstName } } } }
+        }
+    """
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp()
+        self.flask_app = create_app(TestMetricsConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.metrics_dir)
+
+    def scrape(self, app=None):
+        response = (app or self.app).get(f'{TestConfig.API_DOMAIN}/metrics',
+                                         headers={"Authorization": f"Bearer {TestMetricsConfig.METRICS_TOKEN}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain; version=0.0.4"))
+        lines = response.data.decode("utf8").splitlines()
+        for line in lines:
+            if not line.startswith("#"):
+                self.assertRegex(line, self.SAMPLE_LINE)
+        return lines
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_resolver_sql_and_operation_metrics_are_reported(self, *args):
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": self.QUERY})
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": self.QUERY})
+        lines = self.scrape()
+
+        self.assertIn('graphql_requests_total{operation="MetricsTest",status="ok",type="query"} 2', lines)
+        self.assertIn('graphql_resolver_seconds_count{field="Query.appointments"} 2', lines)
+        # once per appointment per request
+        self.assertIn('graphql_resolver_seconds_count{field="AppointmentsSchema.therapists"} 4', lines)
+        # scalar fields aren't timed
+        self.assertFalse([line for line in lines if 'field="AppointmentsSchema.appointmentId"' in line])
+        for phase in ("parse", "execute", "encode"):
+            self.assertIn(f'graphql_phase_seconds_count{{phase="{phase}"}} 2', lines)
+
+        statements = [line for line in lines if line.startswith('graphql_request_sql_statements_sum{operation="Metric')]
+        self.assertEqual(len(statements), 1)
+        self.assertGreater(float(statements[0].split()[-1]), 0)
+        # two appointments with a therapist each, twice
+        rows = [line for line in lines if line.startswith('graphql_request_sql_rows_sum{operation="MetricsTest"}')]
+        self.assertGreaterEqual(float(rows[0].split()[-1]), 8)
+
+    def test_failed_requests_are_counted_as_errors(self):
+        # no Authorization header
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": self.QUERY})
+        self.assertIn('graphql_requests_total{operation="MetricsTest",status="error",type="query"} 1', self.scrape())
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_metrics_from_every_worker_are_added_together(self, *args):
+        worker_config = type("TestMultiprocessMetricsConfig", (TestMetricsConfig,),
+                             {"METRICS_MULTIPROCESS_DIR": self.metrics_dir})
+        worker_app = create_app(worker_config)
+        worker_client = worker_app.test_client()
+        labels = [["operation", "MetricsTest"], ["status", "ok"], ["type", "query"]]
+        # another worker has served the query twice
+        write_snapshot(os.path.join(self.metrics_dir, "metrics-1.json"),
+                       {"counters": [["graphql_requests_total", labels, 2]], "histograms": []})
+
+        with worker_app.app_context():
+            worker_client.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": self.QUERY})
+            self.assertIn('graphql_requests_total{operation="MetricsTest",status="ok",type="query"} 3',
+                          self.scrape(worker_client))
+
+            # the other worker exits. Its numbers are kept
+            archive_worker_metrics(self.metrics_dir, 1)
+            self.assertFalse(os.path.exists(os.path.join(self.metrics_dir, "metrics-1.json")))
+            self.assertIn('graphql_requests_total{operation="MetricsTest",status="ok",type="query"} 3',
+                          self.scrape(worker_client))
+        worker_app.extensions["metrics"].stop()
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_idle_workers_metrics_reach_their_file(self, *args):
+        worker_config = type("TestMultiprocessMetricsConfig", (TestMetricsConfig,),
+                             {"METRICS_MULTIPROCESS_DIR": self.metrics_dir, "METRICS_FLUSH_SECONDS": 0.05})
+        worker_app = create_app(worker_config)
+        registry = worker_app.extensions["metrics"]
+        worker_client = worker_app.test_client()
+        try:
+            with worker_app.app_context():
+                # the second request comes too soon after the first was written
+                for _ in range(2):
+                    worker_client.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": self.QUERY})
+                self.assertEqual(read_snapshot(registry.process_file())["counters"][0][-1], 1)
+
+                # the worker goes idle - its second request is still written for other workers' scrapes
+                deadline = time.monotonic() + 2
+                while read_snapshot(registry.process_file())["counters"][0][-1] < 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(read_snapshot(registry.process_file())["counters"][0][-1], 2)
+        finally:
+            registry.stop()
+
+    def test_metrics_require_a_jwt_or_the_metrics_token(self):
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/metrics')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json["code"], "authorization_header_missing")
+        response = self.app.get(f'{TestConfig.API_DOMAIN}/metrics', headers={"Authorization": "Bearer wrong-token"})
+        self.assertEqual(response.status_code, 401)
+
+        self.scrape()
+        with mock.patch('API.authentication.decorators.get_token_auth_header'), \
+                mock.patch('API.authentication.decorators.verify_jwt_in_argument'):
+            response = self.app.get(f'{TestConfig.API_DOMAIN}/metrics', headers={"Authorization": "Bearer token"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_operation_names_are_capped(self):
+        registry = self.flask_app.extensions["metrics"]
+        registry.max_operation_names = 1
+        self.assertEqual(registry.operation_label({("query", "First")}), ("First", "query"))
+        self.assertEqual(registry.operation_label({("query", "Second")}), ("other", "query"))
+        self.assertEqual(registry.operation_label({("query", "First")}), ("First", "query"))
+
+    def test_metrics_can_be_switched_off(self):
+        app = create_app(TestMetricsDisabledConfig)
+        self.assertNotIn("metrics", app.extensions)
+        self.assertEqual(app.test_client().get(f'{TestConfig.API_DOMAIN}/metrics').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
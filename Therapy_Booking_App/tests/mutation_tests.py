@@ -0,0 +1,265 @@
+import threading
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.models import Appointment
+import mock_data_generation as mock_data_generation
+from tests.helpers import StatementRecordingMixin, TestConfig
+
+
+class API_Concurrency_Tests(StatementRecordingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    mutation = """
+        mutation {
+          appointment(therapistId: 2, startTimeUnixSeconds: 1644874120, durationSeconds: 3600, type: "one-off") {
+            appointment {
+              appointmentId
+            }
+          }
+        }
+    """
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_concurrent_identical_mutations_create_exactly_one_appointment(self, *args):
+        number_of_threads, requests_per_thread = 8, 5
+        barrier = threading.Barrier(number_of_threads)
+        responses, errors = [], []
+
+        def send_mutations():
+            client = self.flask_app.test_client()
+            try:
+                barrier.wait()
+                for _ in range(requests_per_thread):
+                    response = client.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": self.mutation})
+                    responses.append(response.json)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=send_mutations) for _ in range(number_of_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(responses), number_of_threads * requests_per_thread)
+        self.assertEqual({response["data"]["appointment"]["appointment"]["appointmentId"] for response in responses},
+                         {"3"})
+
+        db.session.remove()
+        self.assertEqual(Appointment.query.filter_by(therapist_id=2, start_time_unix_seconds=1644874120,
+                                                     duration_seconds=3600, type="one-off").count(), 1)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_creating_a_new_appointment_does_not_select(self, *args):
+        response, statements = self.post_recording_statements(self.mutation)
+
+        self.assertEqual(response.json, {"data": {"appointment": {"appointment": {"appointmentId": "3"}}}})
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith("INSERT"))
+        self.assertIn("ON CONFLICT", statements[0])
+
+
+class API_Overlap_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestConfig)
+        self.flask_app.config["REJECT_OVERLAPPING_APPOINTMENTS"] = True
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        # jeff (therapist 1) is booked 1644747572 -> 1644751172
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def create_appointment(self, start_time_unix_seconds, duration_seconds=3600, therapist_id=1, client=None):
+        client = client or self.app
+        response = client.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": """
+            mutation {
+              appointment(therapistId: %d, startTimeUnixSeconds: %d, durationSeconds: %d, type: "one-off") {
+                appointment {
+                  appointmentId
+                }
+              }
+            }
+        """ % (therapist_id, start_time_unix_seconds, duration_seconds)})
+        return response.json
+
+    overlap_error = str({"code": "appointment_overlaps",
+                         "description": "The therapist already has an appointment overlapping the appointment "
+                                        "starting at 1644749000"})
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_overlapping_appointments_are_rejected(self, *args):
+        response = self.create_appointment(1644749000)
+        self.assertEqual(response["errors"][0]["message"], self.overlap_error)
+        # starts before and ends after the existing appointment
+        self.assertIn("errors", self.create_appointment(1644740000, duration_seconds=20000))
+        self.assertEqual(Appointment.query.count(), 2)
+
+        # back to back appointments and other therapists are fine
+        self.assertNotIn("errors", self.create_appointment(1644751172))
+        self.assertNotIn("errors", self.create_appointment(1644743972))
+        self.assertNotIn("errors", self.create_appointment(1644749000, therapist_id=2))
+        # re-sending an existing appointment is still idempotent
+        self.assertEqual(self.create_appointment(1644747572),
+                         {"data": {"appointment": {"appointment": {"appointmentId": "1"}}}})
+        self.assertEqual(Appointment.query.count(), 5)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_bulk_creation_rejects_batches_which_overlap_each_other(self, *args):
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": """
+            mutation {
+              createAppointments(input: [
+                {therapistId: 2, startTimeUnixSeconds: 1700000000, durationSeconds: 3600, type: "one-off"},
+                {therapistId: 2, startTimeUnixSeconds: 1700003000, durationSeconds: 3600, type: "one-off"}
+              ]) {
+                appointments {
+                  appointmentId
+                }
+              }
+            }
+        """})
+
+        self.assertEqual(response.json["errors"][0]["message"],
+                         str({"code": "appointment_overlaps",
+                              "description": "The therapist already has an appointment overlapping the appointment "
+                                             "starting at 1700000000, 1700003000"}))
+        self.assertEqual(Appointment.query.count(), 2)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_concurrent_overlapping_creates_book_the_therapist_once(self, *args):
+        number_of_threads = 8
+        barrier = threading.Barrier(number_of_threads)
+        responses, errors = [], []
+
+        def create_overlapping_appointment(offset):
+            try:
+                client = self.flask_app.test_client()
+                barrier.wait()
+                # every appointment overlaps every other one
+                responses.append(self.create_appointment(1700000000 + offset * 400, therapist_id=2, client=client))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=create_overlapping_appointment, args=(offset,))
+                   for offset in range(number_of_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len([response for response in responses if "errors" not in response]), 1)
+        db.session.remove()
+        self.assertEqual(Appointment.query.filter(Appointment.start_time_unix_seconds >= 1700000000).count(), 1)
+
+
+class API_Bulk_Mutation_Tests(StatementRecordingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    mutation = """
+        mutation CreateAppointments($input: [AppointmentInput!]!) {
+          createAppointments(input: $input) {
+            appointments {
+              appointmentId
+              startTimeUnixSeconds
+            }
+          }
+        }
+    """
+
+    def create_appointments(self, appointments):
+        return self.post_recording_statements(self.mutation, {"input": appointments})
+
+    @staticmethod
+    def appointment_input(start_time_unix_seconds, therapist_id=2):
+        return {"therapistId": therapist_id, "startTimeUnixSeconds": start_time_unix_seconds,
+                "durationSeconds": 3600, "type": "one-off"}
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_appointments_are_returned_in_input_order_with_duplicates_and_existing_rows(self, *args):
+        response, statements = self.create_appointments([
+            self.appointment_input(1700000200),
+            # already exists - created by mock_data_generation
+            self.appointment_input(1644747572, therapist_id=1),
+            self.appointment_input(1700000100),
+            self.appointment_input(1700000200),
+        ])
+
+        appointments = response.json["data"]["createAppointments"]["appointments"]
+        self.assertEqual([appointment["startTimeUnixSeconds"] for appointment in appointments],
+                         [1700000200, 1644747572, 1700000100, 1700000200])
+        self.assertEqual(appointments[1]["appointmentId"], "1")
+        self.assertEqual(appointments[0]["appointmentId"], appointments[3]["appointmentId"])
+        self.assertEqual(Appointment.query.count(), 4)
+
+        # one lookup of existing appointments, one executemany insert and one read back of every row
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(statements[1].startswith("INSERT"))
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_number_of_statements_does_not_grow_with_batch_size(self, *args):
+        _, statements = self.create_appointments([self.appointment_input(1700000000 + i) for i in range(200)])
+
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(Appointment.query.count(), 202)
+
+        # resending the batch creates nothing and needs no insert
+        response, statements = self.create_appointments([self.appointment_input(1700000000 + i) for i in range(200)])
+        self.assertEqual(len(response.json["data"]["createAppointments"]["appointments"]), 200)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(Appointment.query.count(), 202)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_batches_over_the_configured_limit_are_rejected(self, *args):
+        self.flask_app.config["MAX_BULK_APPOINTMENTS"] = 2
+        response, _ = self.create_appointments([self.appointment_input(1700000000 + i) for i in range(3)])
+
+        self.assertEqual(response.json["errors"][0]["message"],
+                         str({"code": "batch_too_large",
+                              "description": "At most 2 appointments can be created at once"}))
+        self.assertEqual(Appointment.query.count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
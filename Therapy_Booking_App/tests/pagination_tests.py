@@ -0,0 +1,122 @@
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.appointments.schema import AppointmentsSchema
+from API.models import Appointment
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+
+class API_Pagination_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app = self.app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+        mock_data_generation.generate_nine_unique_appointments_for_testing_filter_combinations(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def query_page(self, arguments):
+        endpoint = f'{TestConfig.API_DOMAIN}/graphql'
+        return self.app.post(endpoint, json={"query": """
+            {
+              appointments(%s) {
+                pageInfo {
+                  hasNextPage
+                  hasPreviousPage
+                  startCursor
+                  endCursor
+                }
+                edges {
+                  node {
+                    appointmentId
+                  }
+                }
+              }
+            }
+        """ % arguments})
+
+    @staticmethod
+    def expected_appointment_ids(sort_name):
+        """
+        :param sort_name: str - an AppointmentsSchemaSortEnum value e.g START_TIME_UNIX_SECONDS_DESC
+        :return: every appointment id in the order the API should return them - ties are broken by appointment id
+        """
+        column_name, direction = sort_name.lower().rsplit("_", 1)
+        appointments = sorted(Appointment.query.all(), key=lambda appointment: appointment.appointment_id)
+        # SQLite sorts NULLs before every other value - first when ascending and last when descending
+        appointments = sorted(appointments, key=lambda appointment: (getattr(appointment, column_name) is not None,
+                                                                     getattr(appointment, column_name)),
+                              reverse=direction == "desc")
+        return [str(appointment.appointment_id) for appointment in appointments]
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_can_page_forwards_and_backwards_for_every_sort_order(self, *args):
+        # appointments with NULLs in their sort columns must be paged through too
+        db.session.add_all([Appointment(start_time_unix_seconds=5, duration_seconds=60, type="one-off"),
+                            Appointment(start_time_unix_seconds=None, duration_seconds=None, type=None)])
+        db.session.commit()
+        for sort_enum_value in AppointmentsSchema.sort_enum()._meta.enum:
+            with self.subTest(sort=sort_enum_value.name):
+                expected_ids = self.expected_appointment_ids(sort_enum_value.name)
+
+                forward_ids, cursor, has_next_page = [], None, True
+                while has_next_page:
+                    after = f', after: "{cursor}"' if cursor else ""
+                    response = self.query_page(f"sort: {sort_enum_value.name}, first: 3{after}")
+                    connection = response.json["data"]["appointments"]
+                    self.assertLessEqual(len(connection["edges"]), 3)
+                    forward_ids.extend(edge["node"]["appointmentId"] for edge in connection["edges"])
+                    cursor = connection["pageInfo"]["endCursor"]
+                    has_next_page = connection["pageInfo"]["hasNextPage"]
+
+                self.assertEqual(forward_ids, expected_ids)
+
+                backward_ids, cursor, has_previous_page = [], None, True
+                while has_previous_page:
+                    before = f', before: "{cursor}"' if cursor else ""
+                    response = self.query_page(f"sort: {sort_enum_value.name}, last: 4{before}")
+                    connection = response.json["data"]["appointments"]
+                    backward_ids = [edge["node"]["appointmentId"] for edge in connection["edges"]] + backward_ids
+                    cursor = connection["pageInfo"]["startCursor"]
+                    has_previous_page = connection["pageInfo"]["hasPreviousPage"]
+
+                self.assertEqual(backward_ids, expected_ids)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_page_size_defaults_to_config_and_is_capped(self, *args):
+        with mock.patch.dict(self.app.application.config, {"DEFAULT_PAGE_SIZE": 5, "MAX_PAGE_SIZE": 8}):
+            response = self.query_page("sort: APPOINTMENT_ID_ASC")
+            self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 5)
+            self.assertTrue(response.json["data"]["appointments"]["pageInfo"]["hasNextPage"])
+
+            response = self.query_page("first: 8")
+            self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 8)
+
+            response = self.query_page("first: 9")
+            self.assertEqual(response.json["data"]["appointments"], None)
+            self.assertEqual(response.json["errors"][0]["message"],
+                             str({"code": "invalid_page_size", "description": "'first' must be between 0 and 8"}))
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_invalid_cursor_is_rejected(self, *args):
+        response = self.query_page('first: 2, after: "not-a-cursor"')
+        self.assertEqual(response.json["data"]["appointments"], None)
+        self.assertEqual(response.json["errors"][0]["message"],
+                         str({"code": "invalid_cursor",
+                              "description": "Cursor is not valid for the requested sort order"}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import re
+import unittest
+from unittest import mock
+
+from API import create_app, db
+import mock_data_generation as mock_data_generation
+from tests.helpers import StatementRecordingMixin, TestConfig
+
+
+class API_Projection_Tests(StatementRecordingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @staticmethod
+    def selected_columns(statement):
+        return re.split(r"\sFROM\s", statement, maxsplit=1)[0]
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_only_selected_columns_are_read(self, *args):
+        response, statements = self.post_recording_statements(
+            "{ appointments(sort: [TYPE_ASC]) { edges { cursor node { startTimeUnixSeconds } } } }")
+
+        edges = response.json["data"]["appointments"]["edges"]
+        self.assertEqual([edge["node"]["startTimeUnixSeconds"] for edge in edges], [1644780000, 1644747572])
+        # the primary key and the sort key (encoded into the cursor) are read too - and nothing else
+        self.assertEqual(len(statements), 1)
+        columns = self.selected_columns(statements[0])
+        for column in ("appointment_id", "start_time_unix_seconds", "type"):
+            self.assertIn(f'"Appointments".{column}', columns)
+        for column in ("duration_seconds", "therapist_id"):
+            self.assertNotIn(f'"Appointments".{column}', columns)
+
+        # a page cached from a projected query is served without loading the missing columns
+        cached_response, cached_statements = self.post_recording_statements(
+            "{ appointments(sort: [TYPE_ASC]) { edges { cursor node { startTimeUnixSeconds } } } }")
+        self.assertEqual(cached_response.json, response.json)
+        self.assertEqual(cached_statements, [])
+
+        # a different selection is a different cache entry and loads the columns it needs
+        response, statements = self.post_recording_statements(
+            "{ appointments(sort: [TYPE_ASC]) { edges { node { durationSeconds therapistId } } } }")
+        self.assertEqual(response.json["data"]["appointments"]["edges"][0]["node"],
+                         {"durationSeconds": 3600, "therapistId": 2})
+        self.assertEqual(len(statements), 1)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_therapist_appointments_are_selectin_loaded(self, *args):
+        # loads the reference catalog
+        self.post_recording_statements("{ appointments { edges { node { therapists { firstName } } } } }")
+
+        response, statements = self.post_recording_statements("""
+            {
+              appointments {
+                edges { node { appointmentId therapists { firstName appointments { edges { node { type } } } } } }
+              }
+            }
+        """)
+
+        nodes = [edge["node"] for edge in response.json["data"]["appointments"]["edges"]]
+        self.assertEqual([node["therapists"]["appointments"]["edges"][0]["node"]["type"] for node in nodes],
+                         ["one-off", "consultation"])
+        # the page, its therapists and every therapist's appointments - not one lazy load per therapist
+        self.assertEqual(len(statements), 3)
+        self.assertIn('WHERE "Appointments".therapist_id IN', statements[2])
+        self.assertNotIn("duration_seconds", self.selected_columns(statements[2]))
+        self.assertFalse([statement for statement in statements if "TherapistSpecialisms" in statement])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+import unittest
+from itertools import combinations
+from unittest import mock
+
+from API import create_app, db
+from API.appointments.catalog import get_reference_catalog
+import mock_data_generation as mock_data_generation
+from tests.helpers import recording_statements, TestConfig
+
+
+class TestQueryPlanConfig(TestConfig):
+    # The reference catalog deliberately reads the (small) therapist + specialism tables in full. It is loaded in setUp
+    # and not re-checked during a test so only the statements our queries issue are inspected
+    REFERENCE_CATALOG_CHECK_SECONDS = 3600
+
+
+# Every filter exposed by AppointmentsFilter. Each combination of these is sent to the API and the SQL it generates
+# is checked with EXPLAIN QUERY PLAN
+APPOINTMENT_FILTERS = {
+    "startTimeUnixSecondsRange": 'startTimeUnixSecondsRange: {begin: 0, end: 1644790000}',
+    "type": 'type: "one-off"',
+    "typeIn": 'typeIn: ["one-off", "consultation"]',
+    "hasSpecialisms": 'hasSpecialisms: ["ADHD", "CBT"]',
+    "hasAllSpecialisms": 'hasAllSpecialisms: ["Addiction", "ADHD"]',
+}
+
+
+class Query_Plan_Tests(unittest.TestCase):
+    """
+    Confirms that every query shape exposed by our API is served by an index. SQLite reports a full table scan as
+    "SCAN <table>" in the output of EXPLAIN QUERY PLAN whereas index lookups are reported as "SEARCH <table>"
+    """
+
+    def setUp(self):
+        self.flask_app = create_app(TestQueryPlanConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+        mock_data_generation.generate_nine_unique_appointments_for_testing_filter_combinations(db)
+        get_reference_catalog()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def capture_statements(self, query):
+        """
+        Posts a query to our endpoint and records every SQL statement it triggers
+        :param query: str - the GraphQL query to send
+        :return: the response and a list of (statement, parameters) tuples
+        """
+        with recording_statements(db.engine, parameters=True) as statements:
+            response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+        return response, statements
+
+    def assert_no_table_scans(self, statements):
+        for statement, parameters in statements:
+            if not statement.lstrip().upper().startswith("SELECT"):
+                continue
+            query_plan = db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}",
+                                                                 parameters).fetchall()
+            details = [row[3] for row in query_plan]
+            # Subqueries (e.g the relay connection's count(*) over our filtered query) are reported as CO-ROUTINE or
+            # MATERIALIZE steps and then scanned by name. Those are scans of an intermediate result not of a table
+            subqueries = {detail.split(" ")[1] for detail in details
+                          if detail.startswith(("CO-ROUTINE", "MATERIALIZE"))}
+            scans = [detail for detail in details if detail.startswith("SCAN") and
+                     detail.split(" ")[1] not in subqueries and detail != "SCAN CONSTANT ROW"]
+            self.assertEqual(scans, [], f"Table scan found in query plan {details} for statement {statement}")
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_every_filter_combination_is_served_by_an_index(self, *args):
+        for combination_size in range(1, len(APPOINTMENT_FILTERS) + 1):
+            for filter_names in combinations(APPOINTMENT_FILTERS, combination_size):
+                with self.subTest(filters=filter_names):
+                    filters = ", ".join(APPOINTMENT_FILTERS[name] for name in filter_names)
+                    response, statements = self.capture_statements("""
+                        {
+                          appointments(filters: {%s}) {
+                            edges {
+                              node {
+                                startTimeUnixSeconds
+                                therapists {
+                                  firstName
+                                  specialisms {
+                                    edges {
+                                      node {
+                                        specialismName
+                                      }
+                                    }
+                                  }
+                                }
+                              }
+                            }
+                          }
+                        }
+                    """ % filters)
+
+                    self.assertEqual(response.status_code, 200)
+                    self.assertNotEqual(statements, [])
+                    self.assert_no_table_scans(statements)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_free_slots_are_served_by_an_index(self, *args):
+        response, statements = self.capture_statements("""
+            {
+              freeSlots(specialisms: ["ADHD"], rangeStart: 1644740000, rangeEnd: 1644790000) {
+                therapistId
+                startTimeUnixSeconds
+              }
+            }
+        """)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("errors", response.json)
+        self.assertEqual(len(statements), 2)
+        self.assert_no_table_scans(statements)
+
+        # the lookback before the window is bounded by each therapist's own longest appointment - one seek per therapist
+        carried_in, parameters = statements[0]
+        details = [row[3] for row in db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {carried_in}",
+                                                                              parameters)]
+        self.assertTrue(any("ix_appointments_therapist_id_duration_seconds (therapist_id=?)" in detail
+                            for detail in details), details)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_appointment_mutation_idempotency_lookup_is_served_by_an_index(self, *args):
+        response, statements = self.capture_statements("""
+            mutation {
+              appointment(therapistId: 1, startTimeUnixSeconds: 1644747572, durationSeconds: 3600, type: "one-off") {
+                appointment {
+                  appointmentId
+                }
+              }
+            }
+        """)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"data": {"appointment": {"appointment": {"appointmentId": "1"}}}})
+        self.assert_no_table_scans(statements)
+
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_overlap_check_is_served_by_an_index(self, *args):
+        self.flask_app.config["REJECT_OVERLAPPING_APPOINTMENTS"] = True
+        response, statements = self.capture_statements("""
+            mutation {
+              appointment(therapistId: 1, startTimeUnixSeconds: 1644874120, durationSeconds: 3600, type: "one-off") {
+                appointment {
+                  appointmentId
+                }
+              }
+            }
+        """)
+
+        self.assertNotIn("errors", response.json)
+        self.assertEqual(len(statements), 2)
+        self.assert_no_table_scans(statements)
+
+
+if __name__ == '__main__':
+    unittest.main()
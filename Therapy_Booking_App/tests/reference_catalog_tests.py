@@ -0,0 +1,116 @@
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.appointments.cache import get_appointments_cache
+from API.models import Appointment, Therapist, Specialism, SpecialismsForTherapists
+import mock_data_generation as mock_data_generation
+from tests.helpers import appointments_query, StatementRecordingMixin, TestConfig
+
+
+class API_Reference_Catalog_Tests(StatementRecordingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def appointment_ids(self, response):
+        return [edge["node"]["appointmentId"] for edge in response.json["data"]["appointments"]["edges"]]
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_specialism_filter_and_nested_fields_need_only_the_appointments_query(self, *args):
+        self.post_recording_statements(appointments_query('type: "one-off"'))
+
+        response, statements = self.post_recording_statements(appointments_query('hasSpecialisms: ["CBT"]'))
+        self.assertEqual(self.appointment_ids(response), ["2"])
+        self.assertEqual(response.json["data"]["appointments"]["edges"][0]["node"]["therapists"]["specialisms"],
+                         {"edges": [{"node": {"specialismName": "CBT"}}, {"node": {"specialismName": "Divorce"}},
+                                    {"node": {"specialismName": "Sexuality"}}]})
+        self.assertEqual(len(statements), 1)
+        self.assertNotIn("TherapistSpecialisms", statements[0])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_catalog_refreshes_when_reference_tables_change(self, *args):
+        response, _ = self.post_recording_statements(appointments_query('hasSpecialisms: ["ADHD"]'))
+        self.assertEqual(self.appointment_ids(response), ["1"])
+
+        # changes committed through the ORM mark the catalog stale straight away
+        jane = Therapist.query.filter_by(first_name="jane").one()
+        jane.specialisms.append(Specialism.query.filter_by(specialism_name="ADHD").one())
+        db.session.commit()
+        get_appointments_cache().clear()
+
+        response, _ = self.post_recording_statements(appointments_query('hasSpecialisms: ["ADHD"]'))
+        self.assertEqual(self.appointment_ids(response), ["1", "2"])
+
+        # rows written without the ORM are noticed by the table signature check
+        self.flask_app.extensions["reference_catalog"].check_seconds = 0
+        db.session.execute(SpecialismsForTherapists.delete().where(
+            SpecialismsForTherapists.c.therapist_id == jane.therapist_id))
+        db.session.commit()
+        get_appointments_cache().clear()
+
+        response, _ = self.post_recording_statements(appointments_query('hasSpecialisms: ["ADHD"]'))
+        self.assertEqual(self.appointment_ids(response), ["1"])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_therapists_missing_from_the_catalog_are_read_from_the_database(self, *args):
+        self.post_recording_statements(appointments_query('type: "one-off"'))
+        catalog = self.flask_app.extensions["reference_catalog"]
+        refreshes = catalog.refreshes
+
+        # written by another connection - the catalog doesn't know about the therapist until its next signature check
+        with db.engine.begin() as connection:
+            therapist_id = connection.execute(Therapist.__table__.insert().values(
+                first_name="dee", last_name="reynolds")).inserted_primary_key[0]
+            connection.execute(Appointment.__table__.insert().values(
+                therapist_id=therapist_id, start_time_unix_seconds=1644900000, duration_seconds=3600,
+                type="consultation"))
+        get_appointments_cache().clear()
+
+        response, _ = self.post_recording_statements(appointments_query('startTimeUnixSecondsRange: '
+                                                                              '{begin: 1644900000, end: 1644900000}'))
+        self.assertEqual(response.json["data"]["appointments"]["edges"][0]["node"]["therapists"],
+                         {"firstName": "dee", "lastName": "reynolds", "specialisms": {"edges": []}})
+        self.assertEqual(catalog.refreshes, refreshes + 1)
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_catalog_therapists_can_still_load_their_appointments(self, *args):
+        response, _ = self.post_recording_statements("""
+            {
+              appointments(filters: {type: "one-off"}) {
+                edges {
+                  node {
+                    therapists {
+                      appointments {
+                        edges {
+                          node {
+                            startTimeUnixSeconds
+                          }
+                        }
+                      }
+                    }
+                  }
+                }
+              }
+            }
+        """)
+        self.assertEqual(response.json["data"]["appointments"]["edges"][0]["node"]["therapists"]["appointments"],
+                         {"edges": [{"node": {"startTimeUnixSeconds": 1644747572}}]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,11 @@
 import unittest
 from unittest import mock
 
-from API import create_app, db, Config
+from API import create_app, db
+from API.appointments.cache import get_appointments_cache
+from API.models import Appointment
 import mock_data_generation as mock_data_generation
-
-import os
-
-
-class TestConfig(Config):
-    basedir = os.path.abspath(os.path.dirname(__file__))
-    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
-    SQLALCHEMY_DATABASE_URI = f'sqlite:///{basedir}/tests/test_app.db'
-    SQLALCHEMY_TRACK_MODIFICATIONS = False
-    API_DOMAIN = 'http://127.0.0.1:5000'
+from tests.helpers import recording_statements, TestConfig
 
 
 class API_Integration_Tests(unittest.TestCase):
@@ -78,6 +71,30 @@ class API_Integration_Tests(unittest.TestCase):
             {'message': 'Cannot query field "non_existent_field" on type "AppointmentsSchema".',
              'locations': [{'line': 1, 'column': 31}]}]})
 
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_graphql_documents_are_parsed_and_validated_once(self, *args):
+        """
+        Checks that repeat documents are served from the document cache and that cached validation errors are still
+        returned to the user
+        """
+        endpoint = f'{TestConfig.API_DOMAIN}/graphql'
+        stats_before = self.app.get(f'{TestConfig.API_DOMAIN}/graphql/document-cache').json
+
+        valid_query = "query DocumentCacheTest{appointments{edges{node{durationSeconds}}}}"
+        invalid_query = "query DocumentCacheTest{appointments{edges{node{not_a_field}}}}"
+        for _ in range(3):
+            response = self.app.post(endpoint, json={"query": valid_query})
+            self.assertEqual(response.json, {"data": {"appointments": {'edges': []}}})
+            response = self.app.post(endpoint, json={"query": invalid_query})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json["errors"][0]["message"],
+                             'Cannot query field "not_a_field" on type "AppointmentsSchema".')
+
+        stats_after = self.app.get(f'{TestConfig.API_DOMAIN}/graphql/document-cache').json
+        self.assertEqual(stats_after["misses"] - stats_before["misses"], 2)
+        self.assertEqual(stats_after["hits"] - stats_before["hits"], 4)
+
 
 class API_Acceptance_Tests(unittest.TestCase):
 
@@ -715,6 +732,31 @@ class API_Acceptance_Tests(unittest.TestCase):
             }
         })
 
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_appointment_mutate_rejects_missing_or_null_key_columns(self, *args):
+        endpoint = f'{TestConfig.API_DOMAIN}/graphql'
+        appointment_count = Appointment.query.count()
+        null_therapist = """
+            mutation ($therapistId: Int) {
+              appointment(therapistId: $therapistId, startTimeUnixSeconds: 1644874120, durationSeconds: 3600,
+                          type: "one-off") { appointment { appointmentId } }
+            }
+        """
+        missing_duration = """
+            mutation {
+              appointment(therapistId: 1, startTimeUnixSeconds: 1644874120, type: "one-off") {
+                appointment { appointmentId }
+              }
+            }
+        """
+        for query in (null_therapist, missing_duration):
+            # sent twice - the unique index can't deduplicate NULLs so neither may be created
+            for _ in range(2):
+                response = self.app.post(endpoint, json={"query": query, "variables": {"therapistId": None}})
+                self.assertIn("errors", response.json)
+        self.assertEqual(Appointment.query.count(), appointment_count)
+
     @mock.patch('API.authentication.decorators.get_token_auth_header')
     @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
     def test_appointment_mutate_on_graphql_endpoint_idempotent_on_multiple_calls(self, *args):
@@ -1041,5 +1083,53 @@ class API_Acceptance_Tests(unittest.TestCase):
         })
 
 
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_nested_therapist_and_specialism_fields_use_constant_number_of_queries(self, *args):
+        """
+        Checks that therapists + specialisms are batch loaded per request by our DataLoaders. The number of SQL
+        statements issued should not grow with the number of appointments returned
+        """
+        endpoint = f'{TestConfig.API_DOMAIN}/graphql'
+        query = """
+            {
+              appointments {
+                edges {
+                  node {
+                    therapists {
+                      firstName
+                      specialisms {
+                        edges {
+                          node {
+                            specialismName
+                          }
+                        }
+                      }
+                    }
+                  }
+                }
+              }
+            }
+        """
+
+        with recording_statements(db.engine) as statements:
+            response = self.app.post(endpoint, json={"query": query})
+            statements_for_two_appointments = len(statements)
+
+            mock_data_generation.generate_nine_unique_appointments_for_testing_filter_combinations(db)
+            # rows inserted outside of the API aren't seen by the cache until its entries expire
+            get_appointments_cache().clear()
+            statements.clear()
+
+            response_2 = self.app.post(endpoint, json={"query": query})
+            statements_for_eleven_appointments = len(statements)
+
+        self.assertEqual(len(response.json["data"]["appointments"]["edges"]), 2)
+        self.assertEqual(len(response_2.json["data"]["appointments"]["edges"]), 11)
+        self.assertEqual(statements_for_two_appointments, statements_for_eleven_appointments)
+        self.assertEqual(response_2.json["data"]["appointments"]["edges"][2], {"node": {"therapists": {
+            "firstName": "charlie", "specialisms": {"edges": [{"node": {"specialismName": "ADHD"}}]}}}})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from unittest import mock
+
+from API import create_app, db
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+
+class API_Specialism_Filter_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        self.app = self.app.test_client()
+        db.create_all()
+        # jeff (appointment 1) holds Addiction + ADHD, jane (appointment 2) holds CBT + Divorce + Sexuality
+        mock_data_generation.insert_appointments_and_therapists(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def appointment_ids(self, filters, first=10):
+        endpoint = f'{TestConfig.API_DOMAIN}/graphql'
+        response = self.app.post(endpoint, json={"query": """
+            {
+              appointments(first: %d, filters: {%s}) {
+                pageInfo {
+                  hasNextPage
+                }
+                edges {
+                  node {
+                    appointmentId
+                  }
+                }
+              }
+            }
+        """ % (first, filters)})
+        appointments = response.json["data"]["appointments"]
+        return [edge["node"]["appointmentId"] for edge in appointments["edges"]], appointments["pageInfo"]
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_has_specialisms_returns_each_appointment_once(self, *args):
+        ids, _ = self.appointment_ids('hasSpecialisms: ["Addiction", "ADHD", "CBT"]')
+        self.assertEqual(ids, ["1", "2"])
+
+        # a page of one must not be filled by the same appointment matching two specialisms
+        ids, page_info = self.appointment_ids('hasSpecialisms: ["Addiction", "ADHD"]', first=1)
+        self.assertEqual(ids, ["1"])
+        self.assertFalse(page_info["hasNextPage"])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_has_all_specialisms_requires_every_specialism(self, *args):
+        self.assertEqual(self.appointment_ids('hasAllSpecialisms: ["Addiction", "ADHD"]')[0], ["1"])
+        self.assertEqual(self.appointment_ids('hasAllSpecialisms: ["CBT", "Divorce", "Sexuality", "CBT"]')[0], ["2"])
+        self.assertEqual(self.appointment_ids('hasAllSpecialisms: ["ADHD", "CBT"]')[0], [])
+        self.assertEqual(self.appointment_ids('hasAllSpecialisms: []')[0], ["1", "2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+
+import click
+
+from API import create_app, db
+import generate_schema
+from tests.helpers import TestConfig
+
+
+class API_Startup_Tests(unittest.TestCase):
+
+    def test_migrations_are_only_set_up_for_the_flask_cli(self):
+        self.assertNotIn("migrate", create_app(TestConfig).extensions)
+
+        with click.Context(click.Command("db")):
+            app = create_app(TestConfig)
+        self.assertIs(app.extensions["migrate"].db, db)
+
+    def test_schema_snapshot_is_up_to_date(self):
+        self.assertEqual(generate_schema.main(["--check"]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
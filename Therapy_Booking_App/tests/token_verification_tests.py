@@ -0,0 +1,87 @@
+import time
+import unittest
+from unittest import mock
+
+from API import create_app, db
+from API.authentication import get_token_cache
+from API.authentication.decorators import verify_jwt_in_argument, VerifiedTokenCache
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+
+class API_Token_Verification_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+        mock_data_generation.insert_api_users(db)
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    # two protected fields in one operation
+    query = """
+        {
+          first: appointments(first: 1) { edges { node { appointmentId } } }
+          second: appointments(first: 2) { edges { node { appointmentId } } }
+        }
+    """
+
+    def access_token(self):
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": """
+            mutation{auth(password:"password",username:"test_user"){
+              accessToken}
+            }
+        """})
+        return response.json['data']['auth']['accessToken']
+
+    def post_query(self, token):
+        return self.app.post(f'{TestConfig.API_DOMAIN}/graphql', headers={"authorization": f"Bearer {token}"},
+                             json={"query": self.query})
+
+    def test_token_is_verified_once_per_request_and_then_served_from_cache(self):
+        token = self.access_token()
+
+        with mock.patch('API.authentication.decorators.verify_jwt_in_argument',
+                        wraps=verify_jwt_in_argument) as verify:
+            response = self.post_query(token)
+            self.assertEqual(len(response.json["data"]["second"]["edges"]), 2)
+            self.assertEqual(verify.call_count, 1)
+
+            response = self.post_query(token)
+            self.assertNotIn("errors", response.json)
+            self.assertEqual(verify.call_count, 1)
+
+        self.assertEqual(get_token_cache().hits, 1)
+
+    def test_invalid_tokens_are_not_cached(self):
+        for _ in range(2):
+            response = self.post_query(self.access_token() + "tampered")
+            self.assertEqual(response.json["errors"][0]["message"],
+                             str({"code": "Invalid Token", "description": "Your Token Could Not Be Validated"}))
+        self.assertEqual(len(get_token_cache()), 0)
+
+    def test_expired_tokens_are_not_returned_from_cache(self):
+        token_cache = VerifiedTokenCache(max_entries=2)
+        token_cache.set("live", {"exp": time.time() + 60})
+        token_cache.set("expired", {"exp": time.time() - 1})
+
+        self.assertIsNotNone(token_cache.get("live"))
+        self.assertIsNone(token_cache.get("expired"))
+        self.assertEqual(len(token_cache), 1)
+
+        # least recently used tokens are evicted once the cache is full
+        token_cache.set("newer", {"exp": time.time() + 60})
+        token_cache.set("newest", {"exp": time.time() + 60})
+        self.assertIsNone(token_cache.get("live"))
+        self.assertEqual(len(token_cache), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import io
+import unittest
+from unittest import mock
+
+import sentry_sdk
+
+from API import create_app, db
+from API.monitoring import init_sentry, TraceSampler
+import mock_data_generation as mock_data_generation
+from tests.helpers import TestConfig
+
+
+class TestSentryConfig(TestConfig):
+    SENTRY_DSN = 'https://public@sentry.example.com/1'
+    SENTRY_TRANSPORT = 'API.monitoring_transport.RecordingTransport'
+    SENTRY_TRACES_SAMPLE_RATE = 0.0
+    SENTRY_TRACES_SAMPLE_RATES = {"mutation": 1.0, "query": 0.0, "EveryAppointment": 1.0}
+    SENTRY_SLOW_REQUEST_SECONDS = 60
+    SENTRY_TRACES_HEAD_SAMPLE_RATE = 1.0
+
+
+class StubTransaction(object):
+
+    def __init__(self, spans):
+        self.sampled = True
+        self._span_recorder = mock.Mock(spans=[object()] * spans)
+        self.tags = {}
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+
+class API_Trace_Sampling_Tests(unittest.TestCase):
+
+    def setUp(self):
+        self.flask_app = create_app(TestSentryConfig)
+        self.app_context = self.flask_app.app_context()
+        self.app_context.push()
+        self.app = self.flask_app.test_client()
+        db.create_all()
+        mock_data_generation.insert_appointments_and_therapists(db)
+        self.assertTrue(init_sentry(self.flask_app))
+        self.transport = sentry_sdk.Hub.current.client.transport
+        self.sampler = self.flask_app.extensions["trace_sampler"]
+
+    def tearDown(self):
+        sentry_sdk.Hub.current.client.close()
+        sentry_sdk.Hub.current.bind_client(None)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def sampling_reasons(self):
+        return [transaction["tags"].get("sampling_reason") for transaction in self.transport.transactions]
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_operations_are_sampled_at_their_configured_rate(self, *args):
+        query = "{ appointments { edges { node { appointmentId } } } }"
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+        self.assertEqual(self.sampling_reasons(), [])
+
+        # operation names take precedence over operation types
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": "query EveryAppointment " + query})
+        self.assertEqual(self.sampling_reasons(), ["rate"])
+
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": """
+            mutation {
+              appointment(therapistId: 2, startTimeUnixSeconds: 1644874120, durationSeconds: 3600, type: "one-off") {
+                appointment { appointmentId }
+              }
+            }
+        """})
+        self.assertEqual(self.sampling_reasons(), ["rate", "rate"])
+        # the kept mutation is sent with its SQL spans
+        self.assertGreater(len(self.transport.transactions[-1]["spans"]), 0)
+
+    def test_errors_are_always_sampled(self):
+        # no Authorization header
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql',
+                                 json={"query": "{ appointments { edges { node { appointmentId } } } }"})
+        self.assertIn("errors", response.json)
+        self.assertEqual(self.sampling_reasons(), ["error"])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_slow_requests_are_always_sampled(self, *args):
+        self.sampler.slow_request_seconds = 0
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql',
+                      json={"query": "{ appointments { edges { node { appointmentId } } } }"})
+        self.assertEqual(self.sampling_reasons(), ["slow"])
+
+    @mock.patch('API.authentication.decorators.get_token_auth_header')
+    @mock.patch('API.authentication.decorators.verify_jwt_in_argument')
+    def test_only_mutations_and_the_head_sample_are_recorded(self, *args):
+        self.sampler.head_rate = 0.0
+        self.sampler.slow_request_seconds = 0
+        query = "{ appointments { edges { node { appointmentId } } } }"
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": "query EveryAppointment " + query})
+        # not recorded when it started - kept for being slow but sent without spans
+        self.assertEqual(self.sampling_reasons(), ["slow"])
+        self.assertEqual(self.transport.transactions[-1]["spans"], [])
+
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": """
+            mutation {
+              appointment(therapistId: 2, startTimeUnixSeconds: 1644874120, durationSeconds: 3600, type: "one-off") {
+                appointment { appointmentId }
+              }
+            }
+        """})
+        # the body read by the sampler is still there for the app
+        self.assertNotIn("errors", response.json)
+        self.assertEqual(self.sampling_reasons(), ["slow", "slow"])
+        self.assertGreater(len(self.transport.transactions[-1]["spans"]), 0)
+
+        self.sampler.head_rate = 0.5
+        with mock.patch('API.monitoring.random.random', return_value=0.25):
+            self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+        self.assertEqual(self.sampling_reasons(), ["slow", "slow", "slow"])
+        self.assertGreater(len(self.transport.transactions[-1]["spans"]), 0)
+
+        # fast unrecorded requests are dropped
+        self.sampler.head_rate = 0.0
+        self.sampler.slow_request_seconds = 60
+        self.app.post(f'{TestConfig.API_DOMAIN}/graphql', json={"query": query})
+        self.assertEqual(len(self.transport.transactions), 3)
+
+    def test_unrecorded_errors_are_always_sampled(self):
+        self.sampler.head_rate = 0.0
+        # no Authorization header
+        response = self.app.post(f'{TestConfig.API_DOMAIN}/graphql',
+                                 json={"query": "{ appointments { edges { node { appointmentId } } } }"})
+        self.assertIn("errors", response.json)
+        self.assertEqual(self.sampling_reasons(), ["error"])
+        self.assertEqual(self.transport.transactions[0]["spans"], [])
+
+    def test_operation_rates_are_a_share_of_every_request(self):
+        sampler = TraceSampler(default_rate=0.0, operation_rates={"query": 0.05, "mutation": 0.5},
+                               slow_request_seconds=60, max_spans_per_second=10, ignored_paths=(), head_rate=0.1)
+        # queries were recorded at the head rate, mutations always
+        self.assertAlmostEqual(sampler.recorded_rate([("query", None)]), 0.5)
+        self.assertEqual(sampler.recorded_rate([("mutation", None)]), 0.5)
+        self.assertEqual(sampler.recorded_rate([("query", None), ("mutation", None)]), 0.5)
+
+        environ = {"PATH_INFO": "/graphql", "REQUEST_METHOD": "POST", "CONTENT_LENGTH": "12",
+                   "wsgi.input": io.BytesIO(b"mutation { }")}
+        with mock.patch('API.monitoring.random.random', return_value=0.99):
+            self.assertEqual(sampler({"wsgi_environ": environ}), 1.0)
+            self.assertEqual(environ["wsgi.input"].read(), b"mutation { }")
+            self.assertEqual(sampler({"wsgi_environ": {"PATH_INFO": "/graphql", "REQUEST_METHOD": "GET"}}), 0)
+
+            # a chunked body (no Content-Length) is left for the app to read
+            chunked = io.BytesIO(b'{"query": "{ appointments { totalCount } }"}')
+            environ = {"PATH_INFO": "/graphql", "REQUEST_METHOD": "POST", "CONTENT_LENGTH": "",
+                       "HTTP_TRANSFER_ENCODING": "chunked", "wsgi.input": chunked}
+            self.assertEqual(sampler({"wsgi_environ": environ}), 1.0)
+            self.assertIs(environ["wsgi.input"], chunked)
+            self.assertEqual(chunked.read(), b'{"query": "{ appointments { totalCount } }"}')
+            del environ["CONTENT_LENGTH"]
+            self.assertEqual(sampler({"wsgi_environ": environ}), 1.0)
+            self.assertIs(environ["wsgi.input"], chunked)
+
+    def test_health_checks_are_never_traced(self):
+        self.sampler.slow_request_seconds = 0
+        self.app.get(f'{TestConfig.API_DOMAIN}/healthz')
+        self.app.get(f'{TestConfig.API_DOMAIN}/readyz')
+        self.assertEqual(self.sampling_reasons(), [])
+
+    def test_spans_per_second_are_capped(self):
+        sampler = TraceSampler(default_rate=1.0, operation_rates={}, slow_request_seconds=60,
+                               max_spans_per_second=10, ignored_paths=())
+
+        kept = StubTransaction(spans=5)
+        self.assertEqual(sampler.finish_transaction(kept, [("query", None)], failed=False, seconds=0.1), "rate")
+        self.assertTrue(kept.sampled)
+        self.assertEqual(kept.tags, {"sampling_reason": "rate"})
+
+        # 6 spans left in the budget - not enough for 5 spans plus the transaction itself
+        dropped = StubTransaction(spans=6)
+        self.assertIsNone(sampler.finish_transaction(dropped, [("query", None)], failed=True, seconds=0.1))
+        self.assertFalse(dropped.sampled)
+        # nothing more is recorded until the budget refills
+        self.assertTrue(sampler.budget.available())
+        sampler.budget.spend(4)
+        self.assertFalse(sampler.budget.available())
+        self.assertEqual(sampler({"wsgi_environ": {"PATH_INFO": "/graphql"}}), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()